@@ -0,0 +1,643 @@
+'''
+Helper functions for ensemble statistics across realizations (metrics folder), including an out-of-core reducer that
+streams realization files in spatial tiles, so that peak memory is capped and does not grow with ensemble size.
+Does not need to be run.
+'''
+
+import numpy as np
+import xarray as xr
+import datetime
+import gc
+from config_stats import quantile_reduce, _lerp, write_summary
+
+ensemble_quantiles = [0.10, 0.50, 0.90]
+ensemble_data_types = ['absolute', 'delta', 'percent_delta'] # values, and differences from 1971-2000
+
+def ensemble_percentiles(alldat, skipna=True):
+    '''
+    Ensemble 10th, 50th and 90th percentiles and ensemble mean across realizations, along new dim 'ensemble_statistic'
+    (labelled 'quantile:0.1', 'quantile:0.5', 'quantile:0.9', 'mean').
+
+    Parameters
+    ----------
+    alldat : xarray dataset
+        Data for all realizations, with dim 'realization'.
+    skipna : bool, optional
+        If False, stats are NaN for any cell where NaNs exist in ANY ensemble member. The default is True.
+
+    Returns
+    -------
+    ens : xarray dataset
+        Ensemble statistics.
+    '''
+    ens = xr.merge([quantile_reduce(alldat, ensemble_quantiles, dim='realization', skipna=skipna, keep_attrs=True).rename({'quantile':'ensemble_statistic'}),
+                    alldat.mean(dim='realization', skipna=skipna, keep_attrs=True).assign_coords({'ensemble_statistic': 'mean'}).expand_dims('ensemble_statistic')])
+    ens['ensemble_statistic'] = [f'quantile:{q}' for q in ens.ensemble_statistic.values[:3]] + ['mean'] # relabel quantiles in ensemble_statistic dim to be more transparent
+    return ens
+
+def ensemble_statistics(alldat):
+    '''
+    Ensemble percentiles and mean (see ensemble_percentiles) of absolute values, deltas and percent deltas from 1971-2000.
+
+    Parameters
+    ----------
+    alldat : xarray dataset
+        30-year climatologies of all realizations, with dims 'realization' and 'period'.
+
+    Returns
+    -------
+    stats : dict
+        Ensemble statistics for each data type ('absolute', 'delta', 'percent_delta').
+    '''
+    if 'quantile' in alldat.coords: # for MJJAS quantile metric, rename quantile dims if they exist
+        alldat = alldat.rename({'quantile': 'annual_quantiles'})
+
+    # get ref period data, to calculate deltas
+    ref_period = alldat.sel(period='1971-2000').squeeze().drop_vars('period')
+
+    # Calculate ensemble mean and ensemble percentiles, along a new ensemble_statistic dim
+    ens_percentiles = ensemble_percentiles(alldat)
+
+    # Calculate deltas from the 1971-2000 period. Then repeat the above
+    delta_ens_percentiles = ensemble_percentiles(alldat - ref_period)
+
+    # Calculate percentage deltas from the 1971-2000 period. Then repeat the above
+    percent_alldat_deltas = 100 * (alldat - ref_period) / ref_period
+    # check for infinites (number/0 in the above eqn). Where infinite=True, replace with NaNs.
+    # Zero divide by zero above will return NaN. Zeros exist in the historical period when there is no fire season, or no exceedances of the set threshold
+    percent_alldat_deltas = xr.where(np.isinf(percent_alldat_deltas), np.nan, percent_alldat_deltas)
+    # Since NaNs exist for these data, set skipna=False to not take ens. stats for any locations where NaNs exist in ANY ensemble member
+    percent_delta_ens_percentiles = ensemble_percentiles(percent_alldat_deltas, skipna=False)
+
+    if 'warming_level' in ens_percentiles.coords: # re-add WL info lost in calcs
+        delta_ens_percentiles = delta_ens_percentiles.assign_coords({'warming_level': ("period", ens_percentiles.warming_level.values)})
+        percent_delta_ens_percentiles = percent_delta_ens_percentiles.assign_coords({'warming_level': ("period", ens_percentiles.warming_level.values)})
+    return {'absolute': ens_percentiles, 'delta': delta_ens_percentiles, 'percent_delta': percent_delta_ens_percentiles}
+
+def save_ensemble_statistics(stats, test_stat, rcp, outpath, var_attrs, mask, history, git_id):
+    '''
+    Add file and variable attrs to ensemble statistics (see ensemble_statistics), trim to Canada domain and save.
+
+    Parameters
+    ----------
+    stats : dict
+        Ensemble statistics for each data type ('absolute', 'delta', 'percent_delta').
+    test_stat : String
+        The metric, e.g. 'MJJAS_mean_fillna'.
+    rcp : String
+        'RCP85', 'constructed_RCP26' or 'constructed_RCP45'.
+    outpath : String
+        Output directory.
+    var_attrs : dict
+        Attrs of each variable in the input (realization) data.
+    mask : xarray dataarray
+        Canada mask (CanLEAD_FWI_mask), cells equal to 100 are kept.
+    history : String
+        History attr, e.g. f'Generated by {sys.argv[0]}'.
+    git_id : String
+        Git hash of code used.
+
+    Returns
+    -------
+    None.
+    '''
+    encoding = {var: {'zlib': True, 'complevel': 4} for var in var_attrs}
+    for var in ['lat','lon']:
+        encoding[var] = {'dtype': 'float64', '_FillValue': None}
+
+    # update/add dataset attrs and variable attrs
+    ens_percentiles = add_attrs(stats['absolute'], rcp, history, git_id)
+    ens_percentiles = add_var_attrs(ens_percentiles, data_type='absolute', test_stat=test_stat, var_attrs=var_attrs)
+
+    delta_ens_percentiles = stats['delta']
+    delta_ens_percentiles.attrs = ens_percentiles.attrs # add universal attrs back that are lost during subtract
+    delta_ens_percentiles = add_var_attrs(delta_ens_percentiles, data_type='delta', test_stat=test_stat, var_attrs=var_attrs)
+
+    percent_delta_ens_percentiles = stats['percent_delta']
+    percent_delta_ens_percentiles.attrs = ens_percentiles.attrs # add universal attrs back that are lost during subtract
+    percent_delta_ens_percentiles = add_var_attrs(percent_delta_ens_percentiles, data_type='percent_delta', test_stat=test_stat, var_attrs=var_attrs)
+
+    # trim to Canada domain and save, packed if the realization files are packed
+    write_summary(ens_percentiles, f'{outpath}{test_stat}_{rcp}_30yr_mean_ensemble_percentiles.nc', mask, encoding)
+    write_summary(delta_ens_percentiles, f'{outpath}{test_stat}_{rcp}_30yr_mean_delta_1971_2000_ensemble_percentiles.nc', mask, encoding)
+    write_summary(percent_delta_ens_percentiles, f'{outpath}{test_stat}_{rcp}_30yr_mean_percent_delta_1971_2000_ensemble_percentiles.nc', mask, encoding)
+
+def add_attrs(ds, rcp, history, git_id):
+    '''
+    Add file attrs to ensemble statistics of CanLEAD-FWI metrics.
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        Ensemble statistics, with attrs of the (daily) realization files.
+    rcp : String
+        'RCP85', 'constructed_RCP26' or 'constructed_RCP45'.
+    history : String
+        History attr, e.g. f'Generated by {sys.argv[0]}'.
+    git_id : String
+        Git hash of code used.
+
+    Returns
+    -------
+    ds : xarray dataset
+        Dataset with updated attrs.
+    '''
+    ds.attrs['creation_date'] = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    ds.attrs['institution'] = 'Canadian Centre for Climate Services, Environment and Climate Change Canada'
+    ds.attrs['institute_id'] = 'CCCS/ECCC'
+    ds.attrs['domain'] = 'Canada land areas, excluding the Northern Arctic'
+    ds.attrs['history'] = history
+    ds.attrs['git_id'] = git_id
+    ds.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/'
+    ds.attrs['title'] = 'Canadian Forest Fire Weather Index (FWI) System projections based on CanLEAD-CanRCM4-EWEMBI'
+    ds.attrs['references'] =  'Van Vliet, L. et al. In review. Developing user-informed fire weather projections for Canada. Climate Services. \n'\
+                              +'Natural Resources Canada (NRCan). [no date]. Background Information: Canadian Forest Fire Weather '\
+                              +'Index (FWI) System. Accessed on: 2023-04-27. '\
+                              +'Available at: https://cwfis.cfs.nrcan.gc.ca/background/summary/fwi.'
+    ds.attrs['index_package_information'] = 'FWI System outputs calculated using xclim 0.39.0 indices.fwi.fire_weather_ufunc '\
+                                            +'and indices.fwi.fire_season. Reference: Logan, Travis, et al. Ouranosinc/xclim: '\
+                                            +'V0.39.0. v0.39.0, Zenodo, 2 Nov. 2022, p., doi:10.5281/zenodo.7274811.'
+    # delete some repetitive attrs from daily files
+    for attr in ['CanLEAD_CanRCM4_bc_method_id', 'CanLEAD_CanRCM4_bc_info', 'CanLEAD_CanRCM4_bc_observation_id']:
+        ds.attrs.pop(attr, None)
+    # add RCP as an attr
+    if rcp == 'RCP85':
+        ds.attrs['rcp'] = 'RCP8.5'
+    elif rcp == 'constructed_RCP26':
+        ds.attrs['rcp'] = 'Constructed RCP2.6'
+    elif rcp == 'constructed_RCP45':
+        ds.attrs['rcp'] = 'Constructed RCP4.5'
+    return ds
+
+def add_var_attrs(ds, data_type, test_stat, var_attrs):
+    '''
+    Parameters
+    ----------
+    ds : DATASET
+        Dataset to which to add attrs, ensemble statistics should already be applied.
+    data_type : One of "absolute", "delta", or "percent_delta."
+        Defines the units which will get added based on the type of data.
+    test_stat : the metric, to determine which attrs are updated
+    var_attrs : dict of attrs of each variable in the input (realization) data, e.g. {var: alldat[var].attrs for var in alldat.data_vars}
+
+    Returns
+    -------
+    Dataset with updated variable attrs.
+    '''
+    # set cell methods, long and short variable names for each data type
+    method_cell = {"absolute": "",
+                   'delta': ' time: difference from 1971-2000',
+                   'percent_delta': ' time: percent difference from 1971-2000'}
+    method_short = {"absolute": "",
+                    'delta': '_delta_1971_2000',
+                    'percent_delta': '_percent_delta_1971_2000'}
+    method_long = {"absolute": "",
+                   'delta': ', difference from 1971-2000',
+                   'percent_delta': ', percent difference from 1971-2000'}
+
+    # add variable attrs
+    for var in ds.data_vars:
+        # set all var attrs to those from input data, lost during processing for delta and percent delta
+        ds[var].attrs = dict(var_attrs[var])
+        # then, update as needed
+        if test_stat == 'MJJAS_mean_fillna': # update long and short name and cell methods
+            ds[var].attrs['long_name'] = f'{ds[var].attrs["long_name"]}: May to September mean value (NaNs filled with zeroes)'
+            ds[var].attrs['short_name'] = f'{ds[var].attrs["short_name"]}_MJJAS_fillna_mean'
+            ds[var].attrs['cell_methods'] = 'time: mean over MJJAS (interval: 1 day) time: mean over years'
+        elif test_stat == 'MJJAS_quantile_fillna': # update long and short name and cell methods
+            ds[var].attrs['long_name'] = f'{ds[var].attrs["long_name"]}: May to September (annual) quantile value (NaNs filled with zeroes)'
+            ds[var].attrs['short_name'] = f'{ds[var].attrs["short_name"]}_MJJAS_fillna_quantile'
+        elif test_stat == 'exceedances_1971_2000_MJJASp95_fillna':
+            ds[var].attrs['long_name'] = ds[var].attrs['long_name'].split(':')[0] + ': Count of days that exceed the 95th percentile May to September value (NaNs filled with zeroes) in 1971-2000'
+            ds[var].attrs['short_name'] = ds[var].attrs['short_name'] + '_fillna'
+
+        # update cell methods with climological stats interval (1 year) and data_type methods for all vars and metrics
+        ds[var].attrs['cell_methods'] = ds[var].attrs['cell_methods'] + f' (interval: 1 year){method_cell[data_type]}'
+        # update short and long name with delta methods
+        ds[var].attrs['short_name'] = f'{ds[var].attrs["short_name"]}{method_short[data_type]}'
+        ds[var].attrs['long_name'] = f'{ds[var].attrs["long_name"]}{method_long[data_type]}'
+        if test_stat == 'fire_season_length': # update metric description for fire season length
+            ds['fire_season'].attrs['description'] = 'Number of days in the annual fire season based on temperature thresholds '\
+                                                     +'(when there is measurable fire danger and fire weather calculations are turned on).'
+        else: # add reference to other description
+            ds[var].attrs['description'] = f'{var}: "{ds[var].attrs["description"].split(" (")[0]}." (NRCan n.d.)'
+
+        # set units based on data type
+        if data_type == 'percent_delta':
+            ds[var].attrs['units'] = 'percent'
+        elif data_type in ["absolute", 'delta']:
+            # set units to days for selected vars. For MJJAS_mean and MJJAS_quantile, units are already set to "" (dimensionless)
+            if test_stat in ['exceedances_extreme', 'exceedances_high', 'exceedances_very_high', 'fire_season_length', 'exceedances_1971_2000_MJJASp95_fillna']:
+                ds[var].attrs['units'] = 'days'
+    return ds
+
+def tile_size(ds, nmembers, max_memory, copies=4):
+    '''
+    Size (number of lat and lon cells) of square spatial tiles, so that data for all members in a tile,
+    plus 'copies' working copies (e.g., deltas, percent deltas and sorted values), fits in max_memory bytes.
+    Tiles get smaller as members are added, so that peak memory does not depend on the size of the ensemble.
+    For packed data (see pack_cells in config_stats.py), tiles are blocks of n x n cells along 'cell'.
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        Data of one member, with lat and lon dims, or a cell dim.
+    nmembers : int
+        Number of members (realization files).
+    max_memory : float
+        Memory budget, in bytes.
+    copies : int, optional
+        Number of copies of the tile data held at once. The default is 4.
+
+    Returns
+    -------
+    n : int
+        Number of cells along lat and lon of each tile.
+    '''
+    if 'cell' in ds.dims:
+        ncell = ds.sizes['cell']
+        data_vars = [var for var in ds.data_vars if 'cell' in ds[var].dims]
+        largest = np.ceil(np.sqrt(ncell))
+    else:
+        ncell = ds.sizes['lat'] * ds.sizes['lon']
+        data_vars = list(ds.data_vars)
+        largest = max(ds.sizes['lat'], ds.sizes['lon'])
+    bytes_per_cell = sum(8 * ds[var].size / ncell for var in data_vars) # values are handled as float64
+    cells = max_memory / (nmembers * (1 + copies) * bytes_per_cell)
+    return int(max(1, min(np.floor(np.sqrt(cells)), largest)))
+
+def iter_tiles(sizes, n):
+    # spatial tiles of n x n cells (smaller at the edges), as dicts of slices for isel
+    if 'cell' in sizes: # packed data, blocks of n x n cells
+        for i in range(0, sizes['cell'], n*n):
+            yield dict(cell=slice(i, i+n*n))
+        return
+    for i in range(0, sizes['lat'], n):
+        for j in range(0, sizes['lon'], n):
+            yield dict(lat=slice(i, i+n), lon=slice(j, j+n))
+
+def stream_ensemble(files, tile_func, preprocess=None, max_memory=2e9):
+    '''
+    Out-of-core ensemble reduction. For each spatial tile, read the tile from every realization file, concatenate along
+    'realization', and pass the tile to tile_func. Only one tile of all members is held in memory at once, and tile
+    size is set so that this fits in max_memory (see tile_size). Outputs of all tiles are then put back together.
+
+    Parameters
+    ----------
+    files : list
+        Realization files, each with a 'realization' dim (or coordinate) and lat and lon dims, or packed along a 'cell' dim
+        (see pack_cells in config_stats.py).
+    tile_func : function
+        Function taking the tile of all members (xarray dataset with dim 'realization'), and returning a dict of
+        xarray datasets, e.g. {'absolute': ..., 'delta': ...}. Outputs must keep lat and lon dims (or the cell dim).
+    preprocess : function, optional
+        Function applied (lazily) to each realization dataset on opening, e.g. to select a period. The default is None.
+    max_memory : float, optional
+        Memory budget for one tile of all members, in bytes. The default is 2e9.
+
+    Returns
+    -------
+    out : dict
+        Outputs of tile_func, for the full domain.
+    '''
+    def open_member(fl, chunks):
+        ds = xr.open_dataset(fl, chunks=chunks, decode_timedelta=False)
+        if preprocess is not None:
+            ds = preprocess(ds)
+        if 'realization' not in ds.dims:
+            ds = ds.expand_dims('realization')
+        return ds
+
+    first = open_member(files[0], chunks={})
+    n = tile_size(first, len(files), max_memory)
+    sizes = dict(first.sizes)
+    first.close()
+    chunks = {'cell': n*n} if 'cell' in sizes else {'lat': n, 'lon': n}
+    members = [open_member(fl, chunks=chunks) for fl in files] # tiles line up with chunks, so only the tile is read
+
+    rows = {} # lat tile start: {output name: [tiles along lon]}
+    for tile in iter_tiles(sizes, n):
+        data = xr.concat([ds.isel(**tile) for ds in members], dim='realization').load() # one tile, all members
+        for name, out in tile_func(data).items():
+            rows.setdefault(tile['lat'].start if 'lat' in tile else 0, {}).setdefault(name, []).append(out)
+        del(data)
+        gc.collect()
+    for ds in members:
+        ds.close()
+
+    # put tiles back together, first along lon then lat
+    names = rows[0].keys()
+    if 'cell' in sizes:
+        return {name: xr.concat(rows[0][name], dim='cell') for name in names}
+    return {name: xr.concat([xr.concat(row[name], dim='lon') for _, row in sorted(rows.items())], dim='lat')
+            for name in names}
+
+#%% Incremental ensemble statistics, for adding, removing or replacing members without re-reading the others
+
+def member_data(ds):
+    '''
+    Absolute values, deltas and percent deltas from 1971-2000 of one ensemble member, along new dim 'data_type',
+    found as in ensemble_statistics.
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        30-year climatologies of one realization (e.g. *_30yr_mean.nc), with dims 'realization' (length 1) and 'period'.
+
+    Returns
+    -------
+    label : String
+        Realization label.
+    data : xarray dataset
+        Member data along dim 'data_type' (see ensemble_data_types), as float32.
+    wl : numpy array or None
+        Warming level of each period, for constructed RCPs. None if not in the file (RCP8.5).
+    '''
+    label = str(ds.realization.values[0])
+    wl = None
+    if 'warming_level' in ds.variables: # extract only numeric warming level, as in return_wl
+        wl = np.array([float(i.split(':')[1][:4]) for i in ds.warming_level.values])
+    # drop constructed RCP vars which conflict between realizations, as in reassign_wl
+    ds = ds.drop_vars(['source_rcp_period', 'source_rcp_period_first_year', 'warming_level'], errors='ignore').squeeze('realization', drop=True)
+    if 'quantile' in ds.coords: # for MJJAS quantile metric, rename quantile dims if they exist
+        ds = ds.rename({'quantile': 'annual_quantiles'})
+    ref_period = ds.sel(period='1971-2000', drop=True)
+    percent_deltas = 100 * (ds - ref_period) / ref_period
+    percent_deltas = xr.where(np.isinf(percent_deltas), np.nan, percent_deltas) # replace infinites (number/0) with NaN
+    data = xr.concat([ds, ds - ref_period, percent_deltas], dim='data_type', coords='minimal', compat='override').astype('float32')
+    data = data.assign_coords(data_type=ensemble_data_types).transpose('data_type', 'period', ...)
+    data.attrs = ds.attrs
+    for var in data.data_vars:
+        data[var].attrs = ds[var].attrs
+    return label, data, wl
+
+def _insert_sorted(values, members, x, k):
+    # insert x (values of member k) into values sorted along the last axis (NaN last), and members (index of member of each value)
+    n = values.shape[-1]
+    if n == 0:
+        return x[..., None], np.full(x.shape + (1,), k, dtype='int16')
+    pos = np.where(np.isnan(x), n, np.sum(values < x[..., None], axis=-1))[..., None] # rank of x in new sorted values
+    j = np.arange(n + 1)
+    src = np.clip(np.where(j < pos, j, j - 1), 0, n - 1) # rank in old sorted values, for all ranks except pos
+    values = np.where(j == pos, x[..., None], np.take_along_axis(values, src, axis=-1))
+    members = np.where(j == pos, k, np.take_along_axis(members, src, axis=-1)).astype('int16')
+    return values, members
+
+def _remove_sorted(values, members, k):
+    # remove values of member k from values sorted along the last axis. Each cell has one value of member k, so order is kept
+    keep = members != k
+    shape = values.shape[:-1] + (values.shape[-1] - 1,)
+    x = values[~keep].reshape(values.shape[:-1])
+    members = members[keep].reshape(shape)
+    return values[keep].reshape(shape), np.where(members > k, members - 1, members).astype('int16'), x
+
+def _welford_add(count, mean, m2, x):
+    # add x to running count, mean and sum of squared deviations from the mean (Welford), skipping NaN
+    valid = ~np.isnan(x)
+    x = x.astype('float64')
+    count = count + valid
+    delta = np.where(valid, x - mean, 0)
+    mean = mean + delta / np.maximum(count, 1)
+    m2 = m2 + np.where(valid, delta * (x - mean), 0)
+    return count.astype('int16'), mean, m2
+
+def _welford_remove(count, mean, m2, x):
+    # remove x from running count, mean and sum of squared deviations from the mean (Welford), skipping NaN
+    valid = ~np.isnan(x)
+    x = x.astype('float64')
+    count = count - valid
+    delta = np.where(valid, x - mean, 0)
+    new_mean = np.where(count > 0, mean - delta / np.maximum(count, 1), 0)
+    m2 = np.where(count > 0, m2 - np.where(valid, delta * (x - new_mean), 0), 0)
+    return count.astype('int16'), new_mean, m2
+
+def sorted_quantile(values, count, q, skipna=True):
+    '''
+    Quantiles of values sorted along the last axis (NaN last), with count valid values per cell. Same as partition_quantile
+    (linear method) in config_stats.py, without sorting.
+
+    Parameters
+    ----------
+    values : numpy array
+        Sorted values.
+    count : numpy array
+        Number of valid (non-NaN) values, with shape values.shape[:-1].
+    q : list
+        Quantiles, from 0 to 1.
+    skipna : bool, optional
+        If False, quantiles are NaN for any cell with a NaN. The default is True.
+
+    Returns
+    -------
+    out : numpy array
+        Quantiles, with shape (len(q),) + values.shape[:-1].
+    '''
+    n = values.shape[-1]
+    count = count.astype(np.int64)
+    valid = count > 0 if skipna else (count == n) & (n > 0)
+    out = np.full((len(q),) + values.shape[:-1], np.nan)
+    if n == 0:
+        return out
+    for i, qi in enumerate(q):
+        h = (np.maximum(count, 1) - 1) * qi # rank (from 0) of quantile in sorted data
+        lower = np.floor(h).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(count, 1) - 1)
+        t = np.where(upper > lower, h - lower, 0) # no interpolation at the last rank, or for exact ranks
+        a = np.take_along_axis(values, lower[..., None], axis=-1)[..., 0].astype(np.float64)
+        b = np.take_along_axis(values, upper[..., None], axis=-1)[..., 0].astype(np.float64)
+        out[i] = np.where(valid, _lerp(a, b, t), np.nan)
+    return out
+
+class EnsembleState:
+    '''
+    Persistent state of ensemble statistics, so that members can be added, removed or replaced (e.g. when a realization
+    is reprocessed) without re-reading all other members. For each variable, with dim 'data_type' (see ensemble_data_types):
+        {var} : member values sorted along dim 'rank' for each cell (NaN last), for quantiles. Kept as float32, as in
+                the 30-year mean files, so that quantiles are the same as from all members.
+        {var}_member : index (along dim 'member') of the member of each sorted value, to remove a member.
+        {var}_count, {var}_mean, {var}_m2 : running count, mean and sum of squared deviations from the mean (Welford),
+                for the ensemble mean and standard deviation.
+    Warming levels of each member are kept for constructed RCPs, since the ensemble warming level is their mean.
+    Only the values of the changed member are read, and each update is linear in the number of members for each cell.
+
+    Parameters
+    ----------
+    state : xarray dataset, optional
+        State saved with save (see open). The default is None, for an ensemble with no members.
+    '''
+    def __init__(self, state=None):
+        self.state = state
+
+    @classmethod
+    def open(cls, path):
+        with xr.open_dataset(path, decode_timedelta=False) as ds:
+            return cls(ds.load())
+
+    @classmethod
+    def from_files(cls, files):
+        # build state by adding members one at a time, each file is read once
+        state = cls()
+        for fl in files:
+            with xr.open_dataset(fl, decode_timedelta=False) as ds:
+                state.add(ds)
+        return state
+
+    def save(self, path):
+        encoding = {var: {'zlib': True, 'complevel': 4} for var in self.state.data_vars}
+        self.state.to_netcdf(path, encoding=encoding)
+
+    @property
+    def members(self):
+        return [] if self.state is None else [str(m) for m in self.state.member.values]
+
+    @property
+    def variables(self):
+        return [var for var in self.state.data_vars if 'rank' in self.state[var].dims and not var.endswith('_member')]
+
+    def _update(self, arrays, members, wl, template):
+        # rebuild state from numpy arrays, with coords and attrs of template (member data or previous state)
+        state = xr.Dataset(attrs=template.attrs)
+        for var in arrays:
+            if var.endswith(('_member', '_count', '_mean', '_m2')):
+                continue
+            dims = template[var].dims if 'rank' not in template[var].dims else template[var].dims[:-1]
+            coords = {dim: template[dim] for dim in dims if dim in template.coords}
+            state[var] = xr.DataArray(arrays[var], dims=dims + ('rank',), coords=coords, attrs=template[var].attrs)
+            state[f'{var}_member'] = xr.DataArray(arrays[f'{var}_member'], dims=dims + ('rank',), coords=coords)
+            for stat in ['count', 'mean', 'm2']:
+                state[f'{var}_{stat}'] = xr.DataArray(arrays[f'{var}_{stat}'], dims=dims, coords=coords)
+        state = state.assign_coords(member=members, rank=np.arange(len(members)))
+        if wl is not None:
+            state['warming_level'] = xr.DataArray(wl, dims=('member', 'period'))
+        self.state = state
+
+    def add(self, ds):
+        '''
+        Add a member (30-year climatologies of one realization, see member_data).
+        '''
+        label, data, wl = member_data(ds)
+        if label in self.members:
+            raise ValueError(f'{label} is already in the ensemble, use replace')
+        k = len(self.members)
+        arrays = {}
+        for var in data.data_vars:
+            x = data[var].values
+            if self.state is None: # first member
+                values, members = np.empty(x.shape + (0,), dtype='float32'), np.empty(x.shape + (0,), dtype='int16')
+                count, mean, m2 = np.zeros(x.shape, dtype='int16'), np.zeros(x.shape), np.zeros(x.shape)
+            else:
+                values, members = self.state[var].values, self.state[f'{var}_member'].values
+                count, mean, m2 = (self.state[f'{var}_{stat}'].values for stat in ['count', 'mean', 'm2'])
+            arrays[var], arrays[f'{var}_member'] = _insert_sorted(values, members, x, k)
+            arrays[f'{var}_count'], arrays[f'{var}_mean'], arrays[f'{var}_m2'] = _welford_add(count, mean, m2, x)
+        if wl is not None:
+            wl = wl[None] if self.state is None else np.concatenate([self.state['warming_level'].values, wl[None]])
+        self._update(arrays, self.members + [label], wl, data if self.state is None else self.state)
+
+    def remove(self, label):
+        '''
+        Remove a member, by realization label.
+        '''
+        if label not in self.members:
+            raise ValueError(f'{label} is not in the ensemble')
+        k = self.members.index(label)
+        arrays = {}
+        for var in self.variables:
+            arrays[var], arrays[f'{var}_member'], x = _remove_sorted(self.state[var].values, self.state[f'{var}_member'].values, k)
+            count, mean, m2 = (self.state[f'{var}_{stat}'].values for stat in ['count', 'mean', 'm2'])
+            arrays[f'{var}_count'], arrays[f'{var}_mean'], arrays[f'{var}_m2'] = _welford_remove(count, mean, m2, x)
+        wl = np.delete(self.state['warming_level'].values, k, axis=0) if 'warming_level' in self.state else None
+        self._update(arrays, [m for m in self.members if m != label], wl, self.state)
+
+    def replace(self, ds):
+        '''
+        Replace a member by new data of the same realization (e.g. after reprocessing).
+        '''
+        label = str(ds.realization.values[0])
+        self.remove(label)
+        self.add(ds)
+
+    def statistics(self, wl_string=None):
+        '''
+        Ensemble percentiles and mean of absolute values, deltas and percent deltas, as from ensemble_statistics.
+
+        Parameters
+        ----------
+        wl_string : list, optional
+            Warming level labels of each period. The default is None, for labels from the mean warming level of 
+            members (constructed RCPs), or no labels if the state has no warming levels (RCP8.5).
+
+        Returns
+        -------
+        stats : dict
+            Ensemble statistics for each data type ('absolute', 'delta', 'percent_delta').
+        '''
+        if wl_string is None and 'warming_level' in self.state:
+            wl_string = [f'GWL:{wl:.2f}Cvs1850-1900' for wl in self.state['warming_level'].mean(dim='member').values]
+        labels = [f'quantile:{q}' for q in ensemble_quantiles] + ['mean']
+        stats = {}
+        for data_type in ensemble_data_types:
+            skipna = data_type != 'percent_delta' # as in ensemble_statistics
+            ens = xr.Dataset(attrs=self.state.attrs)
+            state = self.state.sel(data_type=data_type, drop=True)
+            for var in self.variables:
+                count, mean = state[f'{var}_count'].values, state[f'{var}_mean'].values
+                mean = np.where(count > 0 if skipna else count == len(self.members), mean, np.nan)
+                out = np.concatenate([sorted_quantile(state[var].values, count, ensemble_quantiles, skipna=skipna), mean[None]])
+                ens[var] = xr.concat([state[f'{var}_mean'].copy(data=values) for values in out], dim='ensemble_statistic')
+                ens[var].attrs = self.state[var].attrs
+            ens['ensemble_statistic'] = labels
+            if wl_string is not None:
+                ens = ens.assign_coords({'warming_level': ("period", wl_string)})
+            stats[data_type] = ens
+        return stats
+
+    def std(self, period='1971-2000'):
+        '''
+        Standard deviation across members (ddof=0, NaN if any member is NaN) of absolute values in period, as in ensemble_std.py.
+        '''
+        state = self.state.sel(data_type='absolute', period=period, drop=True).assign_coords(period=period)
+        std = xr.Dataset(attrs=self.state.attrs)
+        for var in self.variables:
+            count = state[f'{var}_count']
+            std[var] = np.sqrt(np.maximum(state[f'{var}_m2'], 0) / count).where(count == len(self.members))
+            std[var].attrs = self.state[var].attrs
+        return std
+
+    def verify(self, files, wl_string=None, max_memory=2e9, rtol=1e-5, atol=1e-3):
+        '''
+        Check statistics of the state against a full recompute from all member files (see ensemble_statistics and stream_ensemble).
+        Prints the maximum absolute difference for each data type and variable. Quantiles are the same; means and standard
+        deviations differ by rounding, since the full recompute sums float32 values (hence atol, for means close to zero).
+
+        Returns
+        -------
+        ok : bool
+            True if all statistics are close (np.allclose, with NaN in the same cells).
+        '''
+        members = []
+        for fl in files:
+            with xr.open_dataset(fl) as ds: # closed after reading the label, one file open at a time
+                members.append(str(ds.realization.values[0]))
+        if sorted(members) != sorted(self.members):
+            print('Members of state and files differ')
+            return False
+
+        def full_statistics(alldat):
+            alldat = alldat.drop_vars(['source_rcp_period', 'source_rcp_period_first_year', 'warming_level'], errors='ignore')
+            stats = ensemble_statistics(alldat)
+            ref_period = alldat.rename({'quantile': 'annual_quantiles'}) if 'quantile' in alldat.coords else alldat
+            stats['std'] = ref_period.sel(period='1971-2000').std(dim='realization', skipna=False)
+            return stats
+
+        full = stream_ensemble(files, full_statistics, max_memory=max_memory)
+        incremental = dict(self.statistics(wl_string), std=self.std())
+        ok = True
+        for name in full:
+            for var in self.variables:
+                a = incremental[name][var].transpose(*full[name][var].dims).values
+                b = full[name][var].values
+                close = np.allclose(a, b, rtol=rtol, atol=atol, equal_nan=True)
+                print(f'{name} {var}: max difference {np.nanmax(np.abs(a - b)) if np.any(np.isfinite(a - b)) else 0:.3g}' + ('' if close else ' (NOT CLOSE)'))
+                ok = ok and close
+        return ok
@@ -0,0 +1,236 @@
+'''
+Helper functions for global warming level (GWL) windows and GWL-conditioned climatologies (metrics folder). A window index
+of the RCP8.5 30-year window of each realization closest to any GWL is found once from the CanESM2 temperature anomalies
+and saved as a csv, so that climatologies at new warming levels are taken directly from the annual files.
+Does not need to be run.
+'''
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from config_stats import PrefixClimatology
+
+tas_baseline_period = '1850-1900'
+tas_window = 30
+cmip5_columns = ['PI_1850-1900=13.66_degC', 'CanESM2_CMIP5_r1i1p1', 'CanESM2_CMIP5_r2i1p1', 'CanESM2_CMIP5_r3i1p1',
+                 'CanESM2_CMIP5_r4i1p1','CanESM2_CMIP5_r5i1p1']
+
+def read_tas_anomalies(fl):
+    '''
+    CanESM2-LE global warming levels (temp anomaly from PI) for RCP85, available with CanLEAD ensemble, e.g.
+    tasAnom_PI_Ayr_CanESM2_historical-rcp85_185001-210012.csv. Returns a dataframe with a row for each year and a column
+    for each of the 50 realizations, labelled as realization labels shortened to a common length (e.g. r1_r4i or r2_r10).
+    '''
+    tas = pd.read_csv(fl, index_col=1) # open CSV, 55 realizations of temp, each as a separate column
+    tas = tas.drop(columns=cmip5_columns) # Drop 5 CMIP5 runs, separate from the CanESM2 LE
+    return tas.rename(columns={col_old: col_old[11:17] for col_old in tas.columns}) # rename columns to realization labels
+
+def target_gwl(gwl_path):
+    '''
+    Target GWL of RCPs 2.6, 4.5 and 8.5, as 30-year climatologies by center year. Global GSAT by ensemble member (5 for each
+    RCP, from area-weighted monthly average CanESM2 data) is converted to GWL and averaged across members.
+
+    Parameters
+    ----------
+    gwl_path : String
+        Directory of GSAT csv files, e.g. f'{fwipaths.working_data}/GWL/'.
+
+    Returns
+    -------
+    target_GWL : pandas dataframe
+        30-year mean GWL for each RCP (columns), by center year.
+    '''
+    GWL = pd.DataFrame() # initialize dataframe to hold global warming levels
+    gsat_hist = pd.read_csv(f'{gwl_path}/historical_annual_mean_GSAT_area_weighted_mon.csv', index_col=0) # historical period, which is the same for all RCPs
+    for rcp in ['rcp26','rcp45','rcp85']: # for each RCP available from CanESM2
+        gsat_fut = pd.read_csv(f'{gwl_path}/{rcp}_annual_mean_GSAT_area_weighted_mon.csv', index_col=0)
+        gsat_df = pd.concat([gsat_hist, gsat_fut]) # merge historical and future periods
+        baseline_temp = gsat_df.loc[1850:1900].mean() # calculate average temperature in the preindustrial (PI; 1950-1900) baseline period
+        gwl = gsat_df - baseline_temp # calculate the global warming levels compared to the PI average
+        GWL[rcp] = gwl.mean(axis=1) # take average across realizations (5 for each RCPs), then add to GWL dataframe
+    # take rolling mean of GWL to get the climatological averages, shift(-1) to duplicate xscen and IPCC
+    # from xscen: 'rolling defines the window as [n-10,n+9], but the the IPCC defines it as [n-9,n+10], where n is the center year'
+    # https://xscen.readthedocs.io/en/latest/_modules/xscen/extract.html#get_warming_level'
+    return GWL.rolling(30, center=True).mean().shift(-1)
+
+def window_climatologies(tas, window_length=tas_window):
+    # climatological GWL of each window, by center year, for all realizations at once. shift(-1) to duplicate xscen and IPCC,
+    # from xscen: 'rolling defines the window as [n-10,n+9], but the the IPCC defines it as [n-9,n+10], where n is the center year'
+    return tas.rolling(window_length, center=True, min_periods=1).mean().shift(-1)
+
+def find_nearest(base_rcp_timeseries, dT, window_length, return_option='window'):
+    '''
+    Return a window or central index, in years, representing the time at which a specific
+    GWL ('of the GWL, centered around the nearest value to the base rcp sample array
+
+    Parameters
+    ----------
+    base_rcp_timeseries : pandas series
+        Pandas series of annual global warming level with respect to your specified baseline, with a row for each year, where the index is the year.
+    dT : float
+       Warming level, e.g., 3 for a global warming level of +3 degree Celsius with respect to your specified baseline.
+    window_length : int
+       Size of the rolling window to compute the warming level, in years.
+    return_option : string, optional
+        Whether to return the central index of the sample ('central'), or the range (in years) for the climatoligical window ('window').
+        The default is 'window'.
+
+    Returns
+    -------
+    Object.
+        Returns the label (years, if input series is correctly formatted) of the central index of
+        the window ('central') or a tuple of the range of the climatological window ('window').
+
+    '''
+    window = nearest_windows(base_rcp_timeseries.to_frame(), [dT], window_length).iloc[0]
+    assert window['complete'], f'Window length = {window["last_year"]-window["first_year"]+1}, not {window_length}. Window: {window["first_year"]}, {window["last_year"]}'
+    if return_option=='central':
+        return window['central_year'] # return central sample
+    elif return_option=='window':
+        return (str(window['first_year']), str(window['last_year'])) # return index range for whole window
+
+def nearest_windows(tas, gwls, window_length=tas_window):
+    '''
+    Window of each realization (column of tas) with the climatological GWL closest to each of gwls, for all realizations
+    and GWLs at once. The first (earliest) window is returned if several are equally close. Same windows as find_nearest.
+
+    Parameters
+    ----------
+    tas : pandas dataframe
+        Annual global warming level with respect to the baseline, with a row for each year (index) and a column for each realization.
+    gwls : list
+        Warming levels, e.g. [1.5, 2, 3, 4].
+    window_length : int, optional
+        Size of the rolling window to compute the warming level, in years. The default is 30.
+
+    Returns
+    -------
+    windows : pandas dataframe
+        One row for each (realization, gwl), with the central, first and last year of the window, the GWL of the window
+        (source_gwl), and whether the window has window_length years (complete). Windows of GWLs which are not reached
+        by the end of the series are cut off at the last year (not complete).
+    '''
+    climatologies = window_climatologies(tas, window_length)
+    years = climatologies.index.values
+    gwls = np.asarray(gwls, dtype=float)
+    delta = np.abs(climatologies.values[None, :, :] - gwls[:, None, None]) # (gwl, year, realization)
+    central = np.argmin(np.where(np.isnan(delta), np.inf, delta), axis=1) # NaN are skipped, as in pandas argmin
+    window_half_length = int(np.floor(window_length/2)) #e.g. a 30 or 31 year window -> 15; 10 year windw -> 5
+    # If an even climo period requested, pad minimum index by 1 (e.g. 1971-2000, for a 30 year period). Else, include minimum value.
+    minval = np.maximum(0, central - window_half_length + (window_length % 2 == 0))
+    maxval = np.minimum(len(years) - 1, central + window_half_length)
+    reals = np.broadcast_to(np.asarray(climatologies.columns)[None, :], central.shape)
+    return pd.DataFrame({'realization': reals.ravel(),
+                         'gwl': np.repeat(gwls, central.shape[1]),
+                         'central_year': years[central].ravel(),
+                         'first_year': years[minval].ravel(),
+                         'last_year': years[maxval].ravel(),
+                         'source_gwl': np.take_along_axis(climatologies.values, central, axis=0).ravel(),
+                         'complete': (maxval - minval == window_length - 1).ravel()})
+
+def window_index(index_file, tas_file, gwls, window_length=tas_window):
+    '''
+    Persisted index of the RCP8.5 window of each realization closest to each GWL (see nearest_windows). The csv index_file
+    is read if it exists and is newer than tas_file, and windows for any GWL not yet in the index are added and saved.
+
+    Parameters
+    ----------
+    index_file : String
+        Csv file of the index, e.g. f'{fwipaths.working_data}GWL/gwl_window_index.csv'.
+    tas_file : String
+        Csv file of CanESM2-LE temperature anomalies (see read_tas_anomalies).
+    gwls : list
+        Warming levels needed, e.g. [1.5, 2, 3, 4].
+    window_length : int, optional
+        Size of the window, in years. The default is 30.
+
+    Returns
+    -------
+    index : pandas dataframe
+        Windows of all GWLs in the index, see nearest_windows.
+    '''
+    saved = None
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(tas_file):
+        saved = pd.read_csv(index_file, float_precision='round_trip') # GWL is read back exactly, to match by value
+    index = saved[saved['window_length'] == window_length] if saved is not None else None
+    missing = [gwl for gwl in np.unique(np.asarray(gwls, dtype=float)) if index is None or gwl not in index['gwl'].values]
+    if missing:
+        new = nearest_windows(read_tas_anomalies(tas_file), missing, window_length).assign(window_length=window_length)
+        saved = new if saved is None else pd.concat([saved, new], ignore_index=True)
+        saved.to_csv(index_file, index=False)
+        index = saved[saved['window_length'] == window_length]
+    return index.drop(columns='window_length').reset_index(drop=True)
+
+def lookup_windows(index, reals, gwls, dims=('realization', 'gwl')):
+    '''
+    Windows of the index for realizations reals and warming levels gwls, as dataarrays of (reals, gwls), for
+    PrefixClimatology.select_mean. Raises a ValueError for GWLs which are not reached in a realization.
+    '''
+    windows = index.set_index(['realization', 'gwl']).loc[[(real, gwl) for real in reals for gwl in gwls]]
+    if not windows['complete'].all():
+        raise ValueError(f'No complete {tas_window} year window for: {list(windows.index[~windows["complete"].values])}')
+    return xr.Dataset({var: (dims, windows[var].values.reshape(len(reals), len(gwls)))
+                       for var in ['central_year', 'first_year', 'last_year', 'source_gwl']})
+
+def stack_realizations(files):
+    '''
+    Stack annual files of all realizations into one (lazy) cube along 'realization', with one chunk along time.
+    Returns the cube and the file attrs of each realization, which differ by realization.
+    '''
+    members = [xr.open_dataset(fl) for fl in files]
+    member_attrs = [ds.attrs for ds in members]
+    chunks = {'time':-1, 'cell':100} if 'cell' in members[0].dims else {'time':-1, 'lat':10, 'lon':10}
+    cube = xr.concat([ds.chunk(chunks) for ds in members], dim='realization', data_vars='minimal', coords='minimal',
+                     compat='override', combine_attrs='override')
+    if 'quantile' in cube.coords:
+        cube = cube.rename({'quantile': 'annual_quantiles'})
+    return cube, member_attrs
+
+def window_means(cube, first_years, last_years, frequency='annual'):
+    '''
+    Climatological means of the cube over the window of years of each realization (and any other dims of first_years and
+    last_years, e.g. rcp and period), from cumulative sums over years (see PrefixClimatology.select_mean). Mean is appended
+    to cell_methods, as in take_climatological_mean_pseudo_rcps.
+    '''
+    out = PrefixClimatology(cube, frequency).select_mean(first_years, last_years)
+    for var in out.data_vars: # append climatological mean as method in attrs
+        out[var].attrs['cell_methods'] = out[var].attrs['cell_methods'] + ' time: mean over years' # in format: time: method1 within years time: method2 over years
+        if cube[var].dtype.kind == 'f': # sums are in float64, keep dtype of the data
+            out[var] = out[var].astype(cube[var].dtype)
+    return out
+
+def gwl_climatology(annual, gwls, index, frequency='annual'):
+    '''
+    Climatological (30-year) means of a metric at any global warming levels, for all realizations, from the RCP8.5 window
+    of each realization closest to each GWL (see window_index).
+
+    Parameters
+    ----------
+    annual : list or xarray dataset
+        Annual (or seasonal, monthly) files of the metric for all realizations, or these stacked along 'realization'
+        (see stack_realizations).
+    gwls : list
+        Warming levels, e.g. [1.5, 2, 3, 4].
+    index : pandas dataframe
+        Window index, with all of gwls (see window_index).
+    frequency : String, optional
+        "annual", "seasonal" or "monthly". The default is 'annual'.
+
+    Returns
+    -------
+    ds : xarray dataset
+        Climatologies with dims (realization, gwl, ...), and the source RCP8.5 window and its GWL as coordinates.
+    '''
+    cube = stack_realizations(annual)[0] if isinstance(annual, list) else annual
+    gwls = [float(gwl) for gwl in gwls]
+    reals = [real[:6] for real in cube.realization.values] # realization labels, shortened to match the index
+    windows = lookup_windows(index, reals, gwls).assign_coords(realization=cube.realization.values, gwl=gwls)
+    ds = window_means(cube, windows['first_year'], windows['last_year'], frequency)
+    source_rcp_period = np.char.add(np.char.add(windows['first_year'].values.astype(str), '-'), windows['last_year'].values.astype(str))
+    ds = ds.assign_coords({'warming_level': ('gwl', [f'GWL:{gwl:.2f}Cvs{tas_baseline_period}' for gwl in gwls]),
+                           'source_rcp_period': (('realization', 'gwl'), source_rcp_period), # source RCP8.5 window of each realization (string)
+                           'source_gwl': (('realization', 'gwl'), windows['source_gwl'].values)}) # GWL of the source window
+    ds['gwl'].attrs = {'long_name': 'Global warming level', 'units': 'degC',
+                       'description': f'Global warming level relative to {tas_baseline_period}, as a {tas_window} year mean'}
+    return ds
@@ -0,0 +1,359 @@
+'''
+Helper functions shared by the noontime estimate scripts (noontime_estimates folder). Does not need to be run.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import xarray as xr
+import scipy
+from scipy.spatial import cKDTree
+try:
+    import xesmf as xe
+except ImportError: # ESMF is not available on all systems, use NearestNeighbourRegridder instead
+    xe = None
+
+def broadcast_climatology(clim, time, group='month', chunks=None):
+    '''
+    Lazily broadcast a climatological parameter indexed by month (or day of year) onto a daily time axis,
+    by indexing the climatology with the month (or day of year) of each time step. Replaces tiling of
+    the climatology into a full-length daily file.
+
+    Parameters
+    ----------
+    clim : xarray dataarray or dataset
+        Climatological values, with dimension 'group' (e.g., 'month' with values 1 to 12, or 'dayofyear').
+    time : xarray dataarray
+        Time coordinate onto which the climatology will be broadcast (e.g., ds.time).
+    group : String, optional
+        Time component by which the climatology is indexed, any valid .dt accessor. The default is 'month'.
+    chunks : dict, optional
+        Chunks of the output. If None, output is returned with a single chunk along time.
+
+    Returns
+    -------
+    out : xarray dataarray or dataset
+        Dask-backed climatology on the time axis of 'time'. No values are computed until needed.
+    '''
+    clim = clim.drop_vars('time', errors='ignore') # drop any scalar time coordinate left from regridding, would conflict with new time dim
+    index = getattr(time.dt, group) # e.g., month of each time step, with time as dimension
+    out = clim.chunk({group: -1}).sel({group: index}) # one chunk along group dim, so that each output block reads only the (small) climatology
+    out = out.drop_vars(group) # remove month (or dayofyear) coordinate along time, keep time only
+    if chunks is not None:
+        out = out.chunk(chunks)
+    return out
+
+def source_state(files):
+    # size and modification time of each source file, to check if a cache is still valid
+    return {os.path.abspath(f): [os.path.getsize(f), os.path.getmtime(f)] for f in sorted(files)}
+
+def static_cache_valid(cache_dir, sources):
+    '''
+    Check if parameters cached with cache_static_parameters are complete and were made from the current source files 
+    (same files, sizes and modification times as recorded in the manifest of the cache).
+
+    Parameters
+    ----------
+    cache_dir : String
+        Folder containing cache.
+    sources : list
+        Files the cached parameters were read from.
+
+    Returns
+    -------
+    valid : bool
+        False if the cache is missing, incomplete, or any source file was added, removed or changed.
+    '''
+    manifest = f'{cache_dir}_manifest.json'
+    if not os.path.exists(manifest):
+        return False
+    with open(manifest) as fl:
+        return json.load(fl) == source_state(sources)
+
+def cache_static_parameters(ds, cache_dir, time_block=2555, sources=None):
+    '''
+    Write the data variables of a (static) parameter dataset to uncompressed .npy files, one per variable, so that
+    they can be opened as read-only memory maps (see open_static_parameters) and shared between worker processes
+    without each worker re-reading and re-chunking the netCDF input. Coordinates and attributes are saved to 
+    'coords.nc' in the same folder. Variables are filled in blocks along their first dimension to limit memory use.
+    The size and modification time of the source files are saved to '_manifest.json', so that the cache can be 
+    checked with static_cache_valid and rebuilt when the sources change. The cache is written to a temporary folder and 
+    then moved in place, so that a cache being written (e.g. by another run) is never read.
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        Parameters to cache (e.g., time of sunrise and solar noon, or monthly temperature offsets).
+    cache_dir : String
+        Folder to write cache to, ending in '/'. Replaced if it exists.
+    time_block : int, optional
+        Number of steps along the first dimension of each variable to compute and write at once. The default is 2555.
+    sources : list, optional
+        Files ds was read from, recorded in the manifest. The default is None, for no manifest (cache is never valid).
+
+    Returns
+    -------
+    None.
+    '''
+    final_dir = cache_dir
+    cache_dir = f'{final_dir.rstrip("/")}_tmp{os.getpid()}/' # written in full, then moved in place of any previous cache
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    meta = ds.drop_vars(list(ds.data_vars)) # coords and global attrs only
+    for var, da in ds.data_vars.items():
+        out = np.lib.format.open_memmap(f'{cache_dir}{var}.npy', mode='w+', dtype=da.dtype, shape=da.shape)
+        if da.ndim == 0:
+            out[...] = da.values
+        else: 
+            for start in range(0, da.shape[0], time_block):
+                out[start:start+time_block] = da[start:start+time_block].values
+        out.flush()
+        del out
+        # keep variable attrs and dims in a scalar placeholder
+        meta[var] = xr.DataArray(0, attrs={**da.attrs, 'cache_dims': ' '.join(da.dims)}) 
+    meta.to_netcdf(f'{cache_dir}coords.nc')
+    if sources is not None:
+        with open(f'{cache_dir}_manifest.json', 'w') as fl:
+            json.dump(source_state(sources), fl)
+    shutil.rmtree(final_dir, ignore_errors=True) # open memory maps of a previous cache stay valid until closed
+    os.replace(cache_dir, final_dir.rstrip('/'))
+
+def open_static_parameters(cache_dir, chunks=None):
+    '''
+    Open parameters cached with cache_static_parameters as a dataset backed by read-only memory maps. Pages are 
+    shared between all processes that open the same cache, and only the parts needed are read from disk.
+
+    Parameters
+    ----------
+    cache_dir : String
+        Folder containing cache.
+    chunks : dict, optional
+        Chunks to apply to output (dask arrays read lazily from the memory maps). If None, output is numpy backed.
+
+    Returns
+    -------
+    ds : xarray dataset
+        Cached parameters, with original coordinates and attributes.
+    '''
+    with xr.open_dataset(f'{cache_dir}coords.nc') as meta:
+        meta = meta.load()
+    ds = meta.drop_vars(list(meta.data_vars))
+    for var, da in meta.data_vars.items():
+        attrs = dict(da.attrs)
+        dims = attrs.pop('cache_dims').split()
+        ds[var] = xr.DataArray(np.load(f'{cache_dir}{var}.npy', mmap_mode='r'), dims=dims, attrs=attrs)
+    if chunks is not None:
+        ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+    return ds
+
+class CircularMeanAccumulator:
+    '''
+    Running circular mean, kept as sums of sines and cosines of the samples, optionally by group (e.g., by month).
+    Samples can be added in any number of pieces (e.g., one year of data at a time, or one realization at a time), 
+    and the result is the same as scipy.stats.circmean over all samples, with nan_policy='propagate'.
+    
+    Works on xarray dataarrays and datasets. State can be saved with to_dataset() and reloaded with from_dataset(),
+    so that samples can be added later without re-reading earlier inputs.
+    
+    Parameters
+    ----------
+    high : float, optional
+        High boundary for the circular range (e.g., 24 for hours). The default is 24.
+    low : float, optional
+        Low boundary for the circular range. The default is 0.
+    group : String, optional
+        Time component by which samples are grouped, any valid .dt accessor (e.g., 'month'). If None, 
+        samples are not grouped. The default is None.
+    '''
+    terms = ['sin_sum', 'cos_sum', 'nan_count', 'count']
+    
+    def __init__(self, high=24, low=0, group=None):
+        self.high = high
+        self.low = low
+        self.group = group
+        self.sums = None # dictionary of running sums, one item per term
+    
+    def add(self, samples, dim=None):
+        '''
+        Add samples to the running sums. 
+        
+        Parameters
+        ----------
+        samples : xarray dataarray or dataset
+            Values to add, on the circular range [low, high). 
+        dim : String, optional
+            Dimension along which samples are taken (e.g., 'time', or 'nens' for realizations). If None, 
+            samples are a single sample per cell (e.g., the mean of one realization). The default is None.
+        '''
+        angles = (samples - self.low) * 2 * np.pi / (self.high - self.low) # convert to radians
+        new = {'sin_sum': np.sin(angles).fillna(0),
+               'cos_sum': np.cos(angles).fillna(0),
+               'nan_count': samples.isnull().astype('int32'),
+               'count': samples.notnull().astype('int32')}
+        for term in self.terms:
+            if dim is None:
+                pass # single sample, nothing to reduce
+            elif self.group is not None:
+                new[term] = new[term].groupby(f'{dim}.{self.group}').sum(dim=dim) # sum by group, e.g. by month
+            else:
+                new[term] = new[term].sum(dim=dim)
+        if self.sums is None:
+            self.sums = new
+        else: # add to existing sums, groups not yet seen (e.g., months) start from zero
+            for term in self.terms:
+                old, add = xr.align(self.sums[term], new[term], join='outer', fill_value=0)
+                self.sums[term] = old + add
+        return self
+    
+    def load(self):
+        '''Compute the running sums, so that memory use does not grow with the number of samples added.'''
+        self.sums = {term: val.load() for term, val in self.sums.items()}
+        return self
+    
+    def result(self):
+        '''
+        Return the circular mean of all samples added, on the range [low, high). Cells (and groups) with any NaN 
+        sample, or without samples, are NaN.
+        '''
+        res = xr.apply_ufunc(np.arctan2, self.sums['sin_sum'], self.sums['cos_sum'], dask='allowed')
+        res = xr.where(res < 0, res + 2 * np.pi, res) # as in scipy.stats.circmean, angles from 0 to 2pi
+        res = res * (self.high - self.low) / (2 * np.pi) + self.low
+        return res.where((self.sums['nan_count'] == 0) & (self.sums['count'] > 0))
+    
+    def to_dataset(self):
+        '''Return running sums as a dataset (or dataarray), with the sums along the new dimension 'circmean_term'.'''
+        out = xr.concat([self.sums[term] for term in self.terms], dim='circmean_term')
+        out = out.assign_coords(circmean_term=self.terms)
+        out.attrs = dict(circmean_high=self.high, circmean_low=self.low, circmean_group=str(self.group))
+        return out
+    
+    @classmethod
+    def from_dataset(cls, ds):
+        '''Create accumulator from running sums saved with to_dataset().'''
+        group = ds.attrs['circmean_group']
+        acc = cls(high=ds.attrs['circmean_high'], low=ds.attrs['circmean_low'], group=None if group == 'None' else group)
+        acc.sums = {term: ds.sel(circmean_term=term).drop_vars('circmean_term') for term in cls.terms}
+        return acc
+
+#%% Regridding, with weights saved for re-use
+
+def grid_hash(ds):
+    '''
+    Short hash identifying the horizontal grid (lat and lon values) and mask (variable 'mask', if present) of a dataset.
+    Used to key saved regridding weights to the grids and masks they were generated with.
+    '''
+    sha = hashlib.sha1()
+    for var in ['lat', 'lon', 'mask']:
+        if var in ds.variables:
+            vals = np.ascontiguousarray(ds[var].values, dtype='float64' if var != 'mask' else 'int8')
+            sha.update(var.encode())
+            sha.update(str(vals.shape).encode())
+            sha.update(vals.tobytes())
+    return sha.hexdigest()[:12]
+
+def _lat_lon_2d(ds):
+    '''Return 2D lat and lon arrays, and the names of horizontal dimensions, for regular (1D lat-lon) or curvilinear (2D) grids.'''
+    if ds['lat'].ndim == 1: # regular lat-lon grid
+        lon, lat = np.meshgrid(ds['lon'].values, ds['lat'].values)
+        return lat, lon, ('lat', 'lon')
+    return ds['lat'].values, ds['lon'].values, ds['lat'].dims # e.g., rotated pole grid, with dims (rlat, rlon)
+
+def _to_xyz(lat, lon):
+    '''Convert lat-lon in degrees to cartesian coordinates on the unit sphere, so that nearest neighbours are found by great circle distance.'''
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+class NearestNeighbourRegridder:
+    '''
+    Nearest neighbour regridding ('nearest source to destination') using a KD-tree (scipy.spatial.cKDTree), 
+    for use where ESMF (xesmf) is unavailable. Follows xesmf conventions: masks are read from the variable 'mask' 
+    of ds_in and ds_out (1 = consider, 0 = do not consider). Each unmasked destination cell takes the value of the 
+    nearest unmasked source cell. Masked destination cells are set to zero (as xesmf), or NaN if unmapped_to_nan=True. 
+    
+    Parameters
+    ----------
+    ds_in : xarray dataset
+        Defines the input grid (lat and lon) and mask.
+    ds_out : xarray dataset
+        Defines the output grid (lat and lon) and mask.
+    unmapped_to_nan : boolean, optional
+        Set masked destination cells to NaN instead of zero. The default is False.
+    filename : String, optional
+        Path to weights (nearest neighbour indices) saved with to_netcdf(). If provided, the KD-tree is not rebuilt.
+    '''
+    method = 'nearest_s2d'
+    
+    def __init__(self, ds_in, ds_out, unmapped_to_nan=False, filename=None):
+        lat_in, lon_in, self.in_dims = _lat_lon_2d(ds_in)
+        lat_out, lon_out, self.out_dims = _lat_lon_2d(ds_out)
+        self.out_shape = lat_out.shape
+        self.out_coords = {var: ds_out[var] for var in ['lat', 'lon']}
+        self.unmapped_to_nan = unmapped_to_nan
+        if filename is not None: # load saved indices instead of rebuilding tree
+            weights = xr.open_dataset(filename).load()
+            self.index, self.valid = weights['index'].values, weights['valid'].values.astype(bool)
+            return
+        mask_in = ds_in['mask'].values.astype(bool).ravel() if 'mask' in ds_in else np.ones(lat_in.size, dtype=bool)
+        self.valid = ds_out['mask'].values.astype(bool).ravel() if 'mask' in ds_out else np.ones(lat_out.size, dtype=bool)
+        tree = cKDTree(_to_xyz(lat_in.ravel()[mask_in], lon_in.ravel()[mask_in])) # only unmasked source cells can be selected
+        _, nearest = tree.query(_to_xyz(lat_out.ravel(), lon_out.ravel()))
+        self.index = np.flatnonzero(mask_in)[nearest] # flat index of nearest source cell, for each destination cell
+    
+    def to_netcdf(self, filename):
+        '''Save weights (nearest neighbour indices) to netCDF, for re-use.'''
+        xr.Dataset({'index': ('cell_out', self.index), 'valid': ('cell_out', self.valid.astype('int8'))},
+                   attrs={'regrid_method': self.method, 'description': 'Flat index of nearest unmasked source cell for each destination cell'}).to_netcdf(filename)
+    
+    def regrid_dataarray(self, da):
+        other_dims = [dim for dim in da.dims if dim not in self.in_dims]
+        da = da.transpose(*other_dims, *self.in_dims)
+        values = np.asarray(da.values).reshape(da.shape[:len(other_dims)] + (-1,)) # flatten horizontal dims
+        out = values[..., self.index]
+        fill = np.nan if self.unmapped_to_nan else 0
+        if fill is np.nan and out.dtype.kind in 'iub':
+            out = out.astype('float64')
+        out[..., ~self.valid] = fill
+        coords = {name: coord for name, coord in da.coords.items() if not set(coord.dims) & set(self.in_dims) and name not in ['lat', 'lon']}
+        coords.update(self.out_coords)
+        return xr.DataArray(out.reshape(out.shape[:-1] + self.out_shape), dims=other_dims + list(self.out_dims), 
+                            coords=coords, name=da.name)
+    
+    def __call__(self, obj):
+        '''Regrid dataarray, or all variables of a dataset with horizontal dimensions (as xesmf).'''
+        if isinstance(obj, xr.DataArray):
+            return self.regrid_dataarray(obj)
+        return xr.Dataset({var: self.regrid_dataarray(obj[var]) for var in obj.data_vars if set(self.in_dims) <= set(obj[var].dims)})
+
+def get_regridder(ds_in, ds_out, weights_dir, method='nearest_s2d', unmapped_to_nan=False):
+    '''
+    Return a regridder from the grid (and mask) of ds_in to the grid (and mask) of ds_out. Weights are saved in weights_dir,
+    keyed by method, regridder options (unmapped_to_nan) and a hash of the input and output grids and masks (see grid_hash), 
+    and loaded on later runs instead of being regenerated. Uses xesmf if available, otherwise NearestNeighbourRegridder 
+    (method 'nearest_s2d' only). Masked destination cells are set to zero, or NaN if unmapped_to_nan=True.
+    '''
+    if not os.path.exists(weights_dir):
+        os.makedirs(weights_dir)
+    package = 'xesmf' if xe is not None else 'kdtree'
+    options = dict(unmapped_to_nan=unmapped_to_nan) # all options that change the weights, so that runs with other options don't reuse them
+    key = '_'.join(f'{option}-{value}' for option, value in sorted(options.items()))
+    filename = os.path.join(weights_dir, f'{method}_{package}_{key}_{grid_hash(ds_in)}_{grid_hash(ds_out)}.nc')
+    reuse = os.path.exists(filename)
+    if xe is not None:
+        if reuse:
+            return xe.Regridder(ds_in, ds_out, method, reuse_weights=True, filename=filename, **options)
+        regridder = xe.Regridder(ds_in, ds_out, method, **options)
+    else:
+        assert method == 'nearest_s2d', f'Only nearest_s2d regridding is available without xesmf, not {method}'
+        if reuse:
+            return NearestNeighbourRegridder(ds_in, ds_out, filename=filename, **options)
+        regridder = NearestNeighbourRegridder(ds_in, ds_out, **options)
+    regridder.to_netcdf(filename) # save weights for next run
+    return regridder
+
+def regridder_info(regridder):
+    '''Description of the package and method used for regridding, to add to attrs.'''
+    if isinstance(regridder, NearestNeighbourRegridder):
+        return f'scipy {scipy.__version__} cKDTree. regrid_method: {regridder.method}.'
+    return f'xesmf {xe.__version__}. regrid_method: {regridder.method}.'
@@ -1,8 +1,34 @@
+import os
+import glob
 import numpy as np
 import xarray as xr
+from functools import lru_cache
 
 stats_chunks = {'lat': 10, 'lon': 32, 'time': 9186}
 
+# These are from national FWI System standard ratings, e.g.: https://cwfis.cfs.nrcan.gc.ca/ha/fwnormals?type=dsr&month=7
+dexceedance = { 'high': {'FFMC': 84,
+                            'DMC': 27, 
+                            'DC':  190,
+                            'ISI': 5,
+                            'BUI': 40,
+                            'FWI': 10,
+                            'DSR': 3},
+                'very_high': {'FFMC': 88,
+                         'DMC': 40, 
+                         'DC':  300,
+                         'ISI': 10,
+                         'BUI': 60,
+                         'FWI': 20,
+                         'DSR': 5},
+                'extreme': {'FFMC': 91,
+                            'DMC': 60, 
+                            'DC':  425,
+                            'ISI': 15,
+                            'BUI': 90,
+                            'FWI': 30,
+                            'DSR': 15} }
+
 def add_realization_dim(out_dataset):
     # get realization label from file attrs, which are standardized from CanLEAD
     realization_label = out_dataset.attrs['CanLEAD_CanRCM4_experiment_id'][-2:] + '_' + out_dataset.attrs['CanLEAD_CanRCM4_driving_model_ensemble_member']
@@ -15,60 +41,254 @@ def add_realization_dim(out_dataset):
     out_dataset['realization'].attrs = realization_attrs
     return out_dataset, realization_label
 
-def get_MJJAS_data(ds):
-    fire_seas = [5,6,7,8,9] # define central fire season
-    # create an dataset with an indentical time dimension to ds,
-    # but where the time dimension contains only the month instead of the full date
-    seasons = xr.full_like(ds.time.dt.month, fill_value='', dtype='U7')
-    seasons.name = 'season'
-    # if month is in MJJAS as defined in fire_seas, replace month with MJJAS flag
-    seasons[ds.time.dt.month.isin(fire_seas)] = 'MJJAS'
-    seasons[~ds.time.dt.month.isin(fire_seas)] = 'ONDJFMA' # else, replace with winter flag
-    out_MJJAS = ds.groupby(seasons)['MJJAS'] # grouby seasons, then select only the MJJAS group
+fire_season_months = (5, 6, 7, 8, 9) # central fire season, MJJAS
+noleap_month_lengths = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+@lru_cache(maxsize=None)
+def season_days(months=fire_season_months):
+    '''
+    Day of year indices (from 0) of the days in 'months', for a noleap (365 day) year. Cached.
+    Returns a slice if the months are consecutive within the year (e.g., MJJAS), so that selection is a view (no copy), 
+    otherwise a (read-only) integer array, e.g. for DJF, which returns days of Jan, Feb and Dec of the same year.
+    '''
+    month_of_day = np.repeat(np.arange(1, 13), noleap_month_lengths)
+    days = np.flatnonzero(np.isin(month_of_day, months))
+    if np.all(np.diff(days) == 1):
+        return slice(int(days[0]), int(days[-1]) + 1)
+    days.flags.writeable = False
+    return days
+
+@lru_cache(maxsize=None)
+def season_time_index(months=fire_season_months, nyears=151):
+    '''
+    Integer indices along a daily noleap time axis starting on Jan 1 (e.g., 1950 to 2100, 151 years) of all days in 'months'. 
+    Cached, so that it is found once and reused for every file.
+    '''
+    days = np.arange(365)[season_days(months)]
+    index = (np.arange(nyears)[:, None] * 365 + days[None, :]).ravel()
+    index.flags.writeable = False
+    return index
+
+def is_noleap_daily(time):
+    # True if time is a daily, noleap axis made up of whole years starting on Jan 1
+    return time.size % 365 == 0 and time.size > 0 and \
+           np.array_equal(time.dt.dayofyear.values, np.tile(np.arange(1, 366), time.size // 365))
+
+def get_MJJAS_data(ds, months=fire_season_months):
+    # select only days in the central fire season (MJJAS), with precomputed integer indices for daily noleap data
+    if is_noleap_daily(ds.time):
+        out_MJJAS = ds.isel(time=season_time_index(tuple(months), ds.time.size // 365))
+    else: # other calendars, select by month
+        out_MJJAS = ds.sel(time=ds.time.dt.month.isin(months))
     out_MJJAS = out_MJJAS.fillna(0) # fill nans with zeros, so that season length will remain the same over the 21st century
     # if NaNs are not filled with zeros, then season length will grow over time (as no values are returned in the FWI System
     # in the winter period). If not fixed, changing season length will affect stats (means and percentiles), skewing comparisons between future and historical
     return out_MJJAS
 
-def take_climatological_mean(ds, frequency):
+def season_reshape(ds, months=fire_season_months):
     '''
-    Takes climatological (30 year) mean of input dataset, and appends that to attributes
-    in 'cell_methods'. Input datasets contain the entire 150 years of data.
+    Reshape daily noleap data into (time, day) dims, with one row per year, and select the days of the season 'months' 
+    by slicing (no copy for consecutive months, see season_days). Seasonal values can then be found by reducing over 'day'
+    (e.g., .mean('day')), instead of with resample. Time is labelled with the first day of the season in each year (e.g., May 1 
+    for MJJAS), as with resample(time='AS', loffset='120D') used previously.
 
     Parameters
     ----------
-    ds : xarray dataset
-        Dataset containly values in MONTHLY or ANNUAL frequency.
-        This contains 150 years of data.
-    frequency : String
-        Valids values: "monthly" or "annual". Describes data frequency.
+    ds : xarray dataset or dataarray
+        Daily data, on a noleap calendar, of whole years starting on Jan 1.
+    months : tuple, optional
+        Months of season. The default is fire_season_months (MJJAS).
 
     Returns
     -------
+    out : xarray dataset or dataarray
+        Season data with dims (time, day, ...).
+    '''
+    if not is_noleap_daily(ds.time):
+        raise ValueError('season_reshape needs daily noleap data of whole years, starting on Jan 1')
+    days = season_days(tuple(months))
+    first_day = days.start if isinstance(days, slice) else int(days[0])
+    out = ds.coarsen(time=365).construct(time=('year', 'day')) # one row per year, each year is one chunk
+    labels = out.time.isel(day=first_day).dt.floor('D').values # first day of season, at midnight
+    out = out.drop_vars('time').isel(day=days).rename(year='time').assign_coords(time=labels)
+    out['time'].attrs = ds.time.attrs
+    return out
+
+def count_exceedances(ds, thresholds):
+    '''
+    Annual count of days with values greater than or equal to each of a set of thresholds, for all levels in one pass. 
+    Each day is binned once with np.digitize against the sorted thresholds of each variable, and the count for a level 
+    is the number of days in that bin or higher. NaNs are not counted. Same as xr.where(ds >= threshold, 1, 0).resample(time='AS').sum()
+    for each level.
+
+    Parameters
+    ----------
     ds : xarray dataset
-        Dataset, with annual or monthly values now as climatological means.
+        Daily data on a noleap calendar (see season_reshape).
+    thresholds : dict
+        Thresholds for each level and variable, {level: {var: threshold}}, e.g. dexceedance.
+
+    Returns
+    -------
+    out : xarray dataset
+        Annual counts with dims (time, level, ...), labelled on Jan 1 of each year. Attrs of ds are kept.
+    '''
+    levels = list(thresholds)
+    days = season_reshape(ds, months=tuple(range(1, 13))) # one row per year
+    out = xr.Dataset(attrs=ds.attrs)
+    for var in ds.data_vars:
+        edges = np.array([thresholds[level][var] for level in levels], dtype=np.float64)
+        order = np.argsort(edges, kind='stable')
+        rank = np.empty(len(levels), dtype=np.int64)
+        rank[order] = np.arange(1, len(levels) + 1) # bin index reached by values >= threshold of each level
+        def level_counts(x, edges=edges[order], rank=rank):
+            bins = np.digitize(np.where(np.isnan(x), -np.inf, x), edges) # NaN in lowest bin, not counted
+            return np.stack([np.sum(bins >= r, axis=-1) for r in rank], axis=-1)
+        out[var] = xr.apply_ufunc(level_counts, days[var], input_core_dims=[['day']], output_core_dims=[['level']],
+                                  dask='parallelized', output_dtypes=[np.int64], 
+                                  dask_gufunc_kwargs={'output_sizes': {'level': len(levels)}})
+    out = out.assign_coords(level=levels)
+    return out.transpose('time', 'level', ...)
 
+def _unstack_time(ds, frequency):
     '''
-    # If frequency is seasonal instead of annual, unstack the time dimension into
-    # year and season dims, then take climo mean of season only
-    if frequency == 'seasonal': # if the data is by month, not year
-        # assign year and month as coords, instead of time dim
+    Replace time dim with 'year' (annual data), or with 'year' and 'season' or 'month' dims (seasonal or monthly data), 
+    so that climatological means can be taken over years. Shared by climatological mean functions. Input is not modified.
+    '''
+    # If frequency is seasonal or monthly instead of annual, unstack the time dimension into
+    # year and season (or month) dims, then take climo mean of season only
+    if frequency == 'seasonal': # if the data is by season, not year
+        # assign year and season as coords, instead of time dim
         year = ds.time.dt.year
         season = ds.time.dt.season
         # assign new coords
         ds = ds.assign_coords(year=("time", year.data), season=("time", season.data))
-        # replace time with 'year' and 'month' as dims
+        # replace time with 'year' and 'season' as dims
         ds = ds.set_index(time=("year", "season")).unstack("time")  
+    elif frequency == 'monthly': # if the data is by month, not year
+        # assign year and month as coords, instead of time dim
+        year = ds.time.dt.year
+        month = ds.time.dt.month
+        # assign new coords
+        ds = ds.assign_coords(year=("time", year.data), month=("time", month.data))
+        # replace time with 'year' and 'month' as dims
+        ds = ds.set_index(time=("year", "month")).unstack("time")  
     elif frequency == 'annual':
-        ds['time'] = ds.time.dt.year.values
-        ds = ds.rename({'time': 'year'})
-    # take 30 year rolling means, labelled to the RIGHT EDGE of the window
-    ds = ds.rolling(year=30, center=False).mean(keep_attrs=True)
-    # define windows to keep, using the end year of the 30 year window ending each decade
-    windows_keep = np.arange(1980,2101,10)
-    ds = ds.sel(year=ds.year.isin(windows_keep)) # select only years we're interested in (by right-side labels), 1950 to 1970 labels are incomplete (NaN) groups
-    ds = ds.rename({'year': 'period'}) # rename to reflect climatology
-    ds['period'] = [f'{ii-29}-{ii}' for ii in ds.period.values] # relabel appropriate to windows
+        ds = ds.assign_coords(time=ds.time.dt.year.values).rename({'time': 'year'})
+    return ds
+
+class PrefixClimatology:
+    '''
+    Climatological means over any windows of years, from cumulative sums (and counts of valid values) over the year axis. 
+    Sums are found once, then the mean of each window is the difference of two cumulative sums, so that any number of 
+    windows (e.g., decadal steps, or annual steps for a moving 30 year climatology) costs the same per cell.
+    
+    Parameters
+    ----------
+    ds : xarray dataset
+        Dataset with values in ANNUAL, SEASONAL or MONTHLY frequency, with time dim.
+    frequency : String
+        Valid values: "annual", "seasonal" or "monthly". Describes data frequency.
+    '''
+    def __init__(self, ds, frequency='annual'):
+        ds = _unstack_time(ds, frequency)
+        self.years = ds.year.values
+        self.attrs = {var: ds[var].attrs for var in ds.data_vars}
+        self.ds_attrs = ds.attrs
+        # cumulative sums, with a leading zero so that the sum of years i to j (inclusive) is csum[j+1] - csum[i]
+        # (cumsum drops the year coord, which is restored for concat; sums are indexed by position)
+        zero = xr.zeros_like(ds.isel(year=[0]))
+        self.csum = xr.concat([zero, ds.fillna(0).astype('float64').cumsum('year').assign_coords(year=ds.year)], dim='year') 
+        self.ccount = xr.concat([zero.astype('int64'), ds.notnull().cumsum('year').assign_coords(year=ds.year)], dim='year')
+    
+    def window_mean(self, end_years, length=30, min_count=None):
+        '''
+        Mean over windows of 'length' years, ending in (and including) each of end_years. 
+
+        Parameters
+        ----------
+        end_years : list
+            Last year of each window, e.g. np.arange(1980, 2101, 10).
+        length : int, optional
+            Number of years in each window. The default is 30.
+        min_count : int, optional
+            Minimum number of valid (not NaN) years for a valid mean. The default is None, which requires all years, 
+            as for rolling(year=length).mean(). Windows which start before the first year are NaN.
+
+        Returns
+        -------
+        ds : xarray dataset
+            Means, with dim 'period' labelled by window (e.g., '1951-1980').
+        '''
+        end_years = np.asarray(end_years)
+        min_count = length if min_count is None else min_count
+        end = np.searchsorted(self.years, end_years) + 1 # position in cumulative sums after the end year
+        start = end - length
+        complete = (start >= 0) & (end <= len(self.years)) & np.isin(end_years, self.years)
+        end_idx = xr.DataArray(np.where(complete, end, 0), dims='period')
+        start_idx = xr.DataArray(np.where(complete, start, 0), dims='period')
+        total = self.csum.isel(year=end_idx) - self.csum.isel(year=start_idx)
+        count = self.ccount.isel(year=end_idx) - self.ccount.isel(year=start_idx)
+        ds = (total / count).where((count >= min_count) & xr.DataArray(complete, dims='period'))
+        ds = ds.drop_vars('year', errors='ignore')
+        ds['period'] = [f'{ii-length+1}-{ii}' for ii in end_years] # label windows
+        for var in ds.data_vars: 
+            ds[var].attrs = dict(self.attrs[var])
+        ds.attrs = dict(self.ds_attrs)
+        return ds
+
+    def select_mean(self, first_years, last_years):
+        '''
+        Mean over years first_years to last_years (inclusive), skipping NaN, as for ds.sel(year=slice(first, last)).mean('year').
+        Windows can differ along any dims of the data, e.g. a different source window for each realization, so that all
+        windows are found with one (pointwise) indexing of the cumulative sums. Years outside the data are not counted.
+
+        Parameters
+        ----------
+        first_years, last_years : xarray dataarray
+            First and last year of each window (int). Dims of the data (e.g. 'realization') are matched pointwise,
+            other dims (e.g. 'rcp', 'period') are added to the output.
+
+        Returns
+        -------
+        ds : xarray dataset
+            Means, with the dims of first_years and last_years and the dims of the data other than year.
+        '''
+        start = xr.DataArray(np.searchsorted(self.years, first_years.values), dims=first_years.dims, coords=first_years.coords)
+        end = xr.DataArray(np.searchsorted(self.years, last_years.values, side='right'), dims=last_years.dims, coords=last_years.coords)
+        total = self.csum.isel(year=end) - self.csum.isel(year=start)
+        count = self.ccount.isel(year=end) - self.ccount.isel(year=start)
+        ds = total / count.where(count > 0) # NaN if no valid years, as for mean
+        ds = ds.drop_vars('year', errors='ignore')
+        for var in ds.data_vars:
+            ds[var].attrs = dict(self.attrs[var])
+        ds.attrs = dict(self.ds_attrs)
+        return ds
+
+def take_climatological_mean(ds, frequency, end_years=np.arange(1980,2101,10)):
+    '''
+    Takes climatological (30 year) mean of input dataset, and appends that to attributes
+    in 'cell_methods'. Input datasets contain the entire 150 years of data.
+
+    Parameters
+    ----------
+    ds : xarray dataset or PrefixClimatology
+        Dataset containly values in SEASONAL or ANNUAL frequency.
+        This contains 150 years of data. A PrefixClimatology of the dataset can be given instead, to reuse its sums.
+    frequency : String
+        Valids values: "seasonal" or "annual". Describes data frequency.
+    end_years : list, optional
+        End year of each 30 year window. The default is the 30 year windows ending each decade, from 1980 to 2100.
+
+    Returns
+    -------
+    ds : xarray dataset
+        Dataset, with annual or seasonal values now as climatological means.
+
+    '''
+    # take 30 year means from cumulative sums, for windows labelled to the RIGHT EDGE (end year). 1950 to 1978 end years are incomplete (NaN) windows
+    climatology = ds if isinstance(ds, PrefixClimatology) else PrefixClimatology(ds, frequency)
+    ds = climatology.window_mean(end_years, length=30)
     for var in ds.data_vars: # append climatological mean as method in attrs
         ds[var].attrs['cell_methods'] = ds[var].attrs['cell_methods'] + ' time: mean over years' # in format: time: method1 within years time: method2 over years
     del(ds.attrs['frequency'])
@@ -93,29 +313,401 @@ def take_climatological_mean_pseudo_rcps(ds, frequency):
         Dataset, with annual or monthly values now as climatological means for ONE climatological period.
 
     '''
-    # If frequency is seasonal instead of annual, unstack the time dimension into
-    # year and season dims, then take climo mean of season only
-    if frequency == 'seasonal': # if the data is by season, not year
-        # assign year and month as coords, instead of time dim
-        year = ds.time.dt.year
-        season = ds.time.dt.season
-        # assign new coords
-        ds = ds.assign_coords(year=("time", year.data), season=("time", season.data))
-        # replace time with 'year' and 'month' as dims
-        ds = ds.set_index(time=("year", "season")).unstack("time")  
-    elif frequency == 'monthly': # if the data is by month, not year
-        # assign year and month as coords, instead of time dim
-        year = ds.time.dt.year
-        month = ds.time.dt.month
-        # assign new coords
-        ds = ds.assign_coords(year=("time", year.data), month=("time", month.data))
-        # replace time with 'year' and 'month' as dims
-        ds = ds.set_index(time=("year", "month")).unstack("time")  
-    elif frequency == 'annual':
-        ds['time'] = ds.time.dt.year.values
-        ds = ds.rename({'time': 'year'})
+    ds = _unstack_time(ds, frequency) # year dim, and season or month dim if needed
     ds = ds.mean(dim='year', keep_attrs=True)
     for var in ds.data_vars: # append climatological mean as method in attrs
         ds[var].attrs['cell_methods'] = ds[var].attrs['cell_methods'] + ' time: mean over years' # in format: time: method1 within years time: method2 over years
     del(ds.attrs['frequency'])
-    return ds
\ No newline at end of file
+    return ds
+
+def _lerp(a, b, t):
+    # linear interpolation between a and b, written as in numpy so that results match np.quantile exactly
+    diff = b - a
+    return np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+
+def partition_quantile(x, q, skipna=True, method='linear'):
+    '''
+    Exact quantiles of numpy array x along its last axis, using one partial sort (np.partition) for all quantiles,
+    instead of a full sort (np.nanquantile) for each. Rows are grouped by their number of valid (non-NaN) values, 
+    since NaNs are partitioned to the end of each row; each group needs only the ranks around the quantiles.
+    Matches np.nanquantile (skipna=True) or np.quantile (skipna=False), to floating point rounding.
+
+    Parameters
+    ----------
+    x : numpy array
+        Data, reduced along last axis.
+    q : float or list
+        Quantiles, from 0 to 1.
+    skipna : bool, optional
+        If False, rows with any NaN return NaN. The default is True.
+    method : String, optional
+        'linear', 'lower', 'higher', 'nearest' or 'midpoint', as in np.quantile. The default is 'linear'.
+
+    Returns
+    -------
+    out : numpy array
+        Quantiles, with shape x.shape[:-1] + (len(q),).
+    '''
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    x = np.asarray(x, dtype=np.float64) # float32 input may differ from np.quantile by float32 rounding, exact for float64
+    rows = x.reshape(-1, x.shape[-1])
+    nvalid = np.sum(~np.isnan(rows), axis=-1)
+    if not skipna: 
+        nvalid = np.where(nvalid == rows.shape[-1], nvalid, 0) # any NaN gives NaN
+    out = np.full((rows.shape[0], len(q)), np.nan)
+    for n in np.unique(nvalid[nvalid > 0]): # rows with the same number of valid values share the same ranks
+        idx = np.flatnonzero(nvalid == n)
+        h = (n - 1) * q # rank (from 0) of quantile in sorted data
+        if method == 'lower': h = np.floor(h)
+        elif method == 'higher': h = np.ceil(h)
+        elif method == 'nearest': h = np.around(h) # round half to even, as in numpy
+        elif method != 'linear' and method != 'midpoint':
+            raise ValueError(f'method {method} is not supported')
+        lower = np.floor(h).astype(np.int64)
+        upper = np.minimum(lower + 1, n - 1)
+        part = np.partition(rows[idx], np.unique(np.concatenate([lower, upper])), axis=-1)
+        t = np.where(h % 1 == 0, 0, 0.5) if method == 'midpoint' else h - lower
+        t = np.where(upper > lower, t, 0) # no interpolation at the last rank, or for exact ranks
+        out[idx] = _lerp(part[:, lower], part[:, upper], t)
+    return out.reshape(x.shape[:-1] + (len(q),))
+
+def quantile_reduce(obj, q, dim, skipna=True, keep_attrs=True, method='linear'):
+    '''
+    Drop-in replacement for obj.quantile(q, dim=dim, skipna=skipna, keep_attrs=keep_attrs), using partition_quantile.
+    Output has a leading 'quantile' dim, as for xarray quantile. Works with dask arrays, with one chunk along dim.
+    Dataset variables without dim are returned unchanged.
+
+    Parameters
+    ----------
+    obj : xarray dataarray or dataset
+        Data to reduce.
+    q : float or list
+        Quantiles, from 0 to 1.
+    dim : String
+        Dimension to reduce, e.g. 'realization'.
+    skipna : bool, optional
+        Skip NaNs. The default is True.
+    keep_attrs : bool, optional
+        Keep attrs of input. The default is True.
+    method : String, optional
+        Interpolation method, see partition_quantile. The default is 'linear'.
+
+    Returns
+    -------
+    out : xarray dataarray or dataset
+        Quantiles along new 'quantile' dim.
+    '''
+    if isinstance(obj, xr.Dataset):
+        out = obj.copy()
+        for var in obj.data_vars:
+            if dim in obj[var].dims:
+                out[var] = quantile_reduce(obj[var], q, dim, skipna=skipna, keep_attrs=keep_attrs, method=method)
+        out = out.drop_vars([coord for coord in out.coords if dim in out[coord].dims]) # e.g., dim itself, as for xarray quantile
+        if not keep_attrs:
+            out.attrs = {}
+        return out
+    scalar = np.ndim(q) == 0
+    qs = np.atleast_1d(q)
+    out = xr.apply_ufunc(partition_quantile, obj, kwargs={'q': qs, 'skipna': skipna, 'method': method},
+                         input_core_dims=[[dim]], output_core_dims=[['quantile']], 
+                         dask='parallelized', output_dtypes=[np.float64],
+                         dask_gufunc_kwargs={'output_sizes': {'quantile': len(qs)}},
+                         keep_attrs=keep_attrs)
+    out = out.assign_coords(quantile=qs).transpose('quantile', ...)
+    if scalar: 
+        out = out.squeeze('quantile') # scalar quantile coord, as for xarray quantile
+    return out
+
+# Fixed histogram bins for quantile sketches: (low, high, bin width) for each FWI System component. Bin width is the error bound of 
+# sketch quantiles for values within (low, high). Values outside are counted in the first or last bin, and quantiles are clipped to 
+# the minimum and maximum of each cell.
+sketch_edges = {'FFMC': (0, 101, 0.1),
+                'DMC': (0, 1000, 0.5),
+                'DC': (0, 2000, 1),
+                'ISI': (0, 200, 0.1),
+                'BUI': (0, 1000, 0.5),
+                'FWI': (0, 300, 0.1),
+                'DSR': (0, 1000, 0.25)}
+
+class HistogramQuantileSketch:
+    '''
+    Fixed-size quantile sketch, using a histogram with fixed bins (per cell). Counts of any number of pieces of data
+    can be summed (merged), so memory use is set by the number of bins, not the length of the time series.
+    Quantiles are interpolated within bins, and follow the 'linear' method of np.quantile, with NaN skipped.
+    Absolute error against the exact quantile is at most the bin width, for values within (low, high).
+    
+    Parameters
+    ----------
+    low : float
+        Lower edge of first bin.
+    high : float
+        Upper edge of last bin.
+    width : float
+        Bin width, also the error bound.
+    '''
+    def __init__(self, low, high, width):
+        self.low = low
+        self.width = width
+        self.nbins = int(np.ceil((high - low) / width))
+        self.error_bound = width
+    
+    def counts(self, x):
+        '''
+        Histogram counts of numpy array x along its last axis. NaNs are not counted.
+        Returns counts with shape x.shape[:-1] + (nbins,), and the minimum and maximum along the last axis.
+        '''
+        valid = ~np.isnan(x)
+        idx = np.floor((np.where(valid, x, self.low) - self.low) / self.width)
+        idx = np.clip(idx, 0, self.nbins - 1).astype(np.int64) # values outside (low, high) to the first or last bin
+        ncell = int(np.prod(x.shape[:-1]))
+        flat = (np.arange(ncell)[:, None] * self.nbins + idx.reshape(ncell, -1))[valid.reshape(ncell, -1)]
+        counts = np.bincount(flat, minlength=ncell * self.nbins).reshape(x.shape[:-1] + (self.nbins,))
+        with np.errstate(invalid='ignore'): # all-NaN cells
+            vmin, vmax = np.fmin.reduce(x, axis=-1), np.fmax.reduce(x, axis=-1)
+        return counts, vmin, vmax
+    
+    def quantile(self, counts, vmin, vmax, q):
+        '''
+        Quantiles q from histogram counts (last axis), with min and max of each cell. Returns shape counts.shape[:-1] + (len(q),).
+        '''
+        q = np.atleast_1d(q)
+        n = counts.sum(axis=-1)
+        cum = np.cumsum(counts, axis=-1)
+        h = np.maximum(n[..., None] - 1, 0) * q # rank (from 0) of quantile in sorted data, as in np.quantile 'linear'
+        def rank_value(r): # estimate of value with integer rank r
+            k = np.minimum(np.sum(cum[..., None, :] <= r[..., :, None], axis=-1), self.nbins - 1) # bin containing rank r
+            c = np.take_along_axis(counts, k, axis=-1)
+            below = np.take_along_axis(cum, k, axis=-1) - c # count in bins below k
+            # assume values are evenly spread within the bin, at the centres of c equal sub-intervals
+            out = self.low + (k + (r - below + 0.5) / np.maximum(c, 1)) * self.width 
+            return np.clip(out, vmin[..., None], vmax[..., None]) # exact at the ends, and for values outside (low, high)
+        r = np.floor(h)
+        lower = rank_value(r)
+        upper = rank_value(np.minimum(r + 1, np.maximum(n[..., None] - 1, 0)))
+        out = lower + (h - r) * (upper - lower) # linear interpolation between neighbouring ranks, as in np.quantile
+        return np.where(n[..., None] > 0, out, np.nan)
+    
+    def __call__(self, x, q):
+        # quantiles of numpy array x along last axis
+        return self.quantile(*self.counts(x), q)
+    
+    def apply(self, da, q, dim='time'):
+        '''
+        Sketch quantiles of xarray dataarray da along dim, with a leading 'quantile' dim. Attrs are kept.
+        Works on dask arrays; only the data of a single group (e.g., one year) is rechunked along dim, if needed.
+        '''
+        q = np.atleast_1d(q)
+        out = xr.apply_ufunc(self, da, kwargs={'q': q}, 
+                             input_core_dims=[[dim]], output_core_dims=[['quantile']], 
+                             dask='parallelized', output_dtypes=[np.float64], 
+                             dask_gufunc_kwargs={'output_sizes': {'quantile': len(q)}, 'allow_rechunk': True},
+                             keep_attrs=True)
+        out = out.assign_coords(quantile=q)
+        return out.transpose('quantile', ...)
+
+def sketch_resample_quantile(ds, q, edges=sketch_edges, **resample_kwargs):
+    '''
+    Streaming alternative to ds.resample(**resample_kwargs).quantile(q), using a HistogramQuantileSketch
+    for each variable. Does not need data to be in one chunk along time.
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        Daily data.
+    q : list
+        Quantiles to find, e.g. [0.95, 0.99].
+    edges : dict, optional
+        (low, high, width) of bins for each variable. The default is sketch_edges.
+    **resample_kwargs : 
+        Passed to ds.resample, e.g. time='AS'.
+
+    Returns
+    -------
+    out : xarray dataset
+        Quantiles, with dims (time, quantile, ...) as for resample().quantile(). The error bound (bin width) of each 
+        variable is added to attrs as 'quantile_error_bound'.
+    '''
+    out = ds.resample(**resample_kwargs).map(sketch_quantile, q=q, dim='time', edges=edges)
+    return out.transpose('time', 'quantile', ...)
+
+def sketch_quantile(ds, q, dim, edges=sketch_edges):
+    '''
+    Quantiles of each variable of ds along dim, using a HistogramQuantileSketch, with a leading 'quantile' dim.
+    The error bound (bin width) of each variable is added to attrs as 'quantile_error_bound'.
+    '''
+    out = xr.Dataset(attrs=ds.attrs)
+    for var in ds.data_vars:
+        sketch = HistogramQuantileSketch(*edges[var])
+        out[var] = sketch.apply(ds[var], q, dim=dim)
+        out[var].attrs['quantile_error_bound'] = sketch.error_bound
+    return out
+
+def report_sketch_error(exact, sketch):
+    '''
+    Print maximum absolute difference between exact and sketch quantiles, and the error bound, for each variable.
+    Returns a dict of the maximum differences.
+    '''
+    max_err = {}
+    for var in sketch.data_vars:
+        max_err[var] = float(abs(exact[var] - sketch[var]).max())
+        print(f'{var}: max abs error of sketch quantiles {max_err[var]:.4g}, error bound {sketch[var].attrs["quantile_error_bound"]}')
+    return max_err
+
+#%% Packed storage of land cells, for summary_stats files
+
+def pack_cells(ds, mask, keep=100):
+    '''
+    Keep only cells where mask == keep (e.g. final_mask==100, Canada excluding the northern Arctic), along a 1-D 'cell' dim,
+    instead of the full lat-lon rectangle masked with NaN. Follows CF conventions for compression by gathering: 'cell' holds 
+    the flat index of each cell in the (lat, lon) grid, with attr compress='lat lon', and lat and lon are kept as coordinates.
+    Variables without lat and lon are unchanged. See unpack_cells, or ds.cells.unpack().
+
+    Parameters
+    ----------
+    ds : xarray dataset or dataarray
+        Data on the lat-lon grid of mask.
+    mask : xarray dataarray
+        Mask with lat and lon dims, e.g. CanLEAD_FWI_mask.
+    keep : int, optional
+        Value of cells to keep. The default is 100.
+
+    Returns
+    -------
+    packed : xarray dataset or dataarray
+        Data along 'cell', with lat and lon as coordinates of the full grid.
+    '''
+    mask = mask.sel(lat=ds.lat, lon=ds.lon).transpose('lat', 'lon')
+    cell = np.flatnonzero(mask.values == keep) # in row-major (lat, lon) order
+    ilat, ilon = np.unravel_index(cell, mask.shape)
+    packed = ds.drop_vars(['lat', 'lon']).isel(lat=xr.DataArray(ilat, dims='cell'), lon=xr.DataArray(ilon, dims='cell'))
+    packed = packed.assign_coords(cell=('cell', cell.astype('int32'), {'compress': 'lat lon', 
+                                                                      'long_name': 'Index of land cell in (lat, lon) grid'}),
+                                  lat=ds['lat'].variable, lon=ds['lon'].variable)
+    return packed
+
+def unpack_cells(packed, lat=None, lon=None):
+    '''
+    Put packed data (see pack_cells) back on the full lat-lon grid, with NaN outside of packed cells. 
+    Integer and boolean variables become float, to hold NaN. lat and lon of the full grid are taken from the packed dataset,
+    or must be given for a dataarray (which can't keep lat and lon as coordinates without lat and lon dims).
+    '''
+    if isinstance(packed, xr.DataArray):
+        return unpack_cells(packed.to_dataset(name='__data__'), lat, lon)['__data__'].rename(packed.name)
+    if lat is not None and lon is not None:
+        packed = packed.assign_coords(lat=lat, lon=lon)
+    assert 'lat' in packed.dims and 'lon' in packed.dims, 'lat and lon of full grid are needed to unpack cells'
+    shape = (packed.sizes['lat'], packed.sizes['lon'])
+    ilat, ilon = np.unravel_index(packed.cell.values, shape)
+    out = xr.Dataset(coords={name: coord for name, coord in packed.coords.items() if 'cell' not in coord.dims}, attrs=packed.attrs)
+    for var in packed.data_vars:
+        da = packed[var]
+        if 'cell' not in da.dims:
+            out[var] = da
+            continue
+        da = da.transpose(..., 'cell')
+        values = np.full(da.shape[:-1] + shape, np.nan, dtype=np.promote_types(da.dtype, np.float32))
+        values[..., ilat, ilon] = da.values
+        out[var] = xr.DataArray(values, dims=da.dims[:-1] + ('lat', 'lon'), attrs=da.attrs)
+    return out
+
+@xr.register_dataset_accessor('cells')
+@xr.register_dataarray_accessor('cells')
+class CellsAccessor:
+    '''
+    Packed land cell storage (see pack_cells), e.g. ds.cells.unpack() to get data on the lat-lon grid on demand.
+    '''
+    def __init__(self, xarray_obj):
+        self._obj = xarray_obj
+
+    @property
+    def packed(self):
+        return 'cell' in self._obj.dims
+
+    def pack(self, mask, keep=100):
+        return self._obj if self.packed else pack_cells(self._obj, mask, keep)
+
+    def unpack(self, lat=None, lon=None):
+        return unpack_cells(self._obj, lat, lon) if self.packed else self._obj
+
+def write_summary(ds, path, mask, encoding=None, packed=None, compute=True):
+    '''
+    Save a summary_stats file, trimmed to Canada domain (mask==100). Either masked with NaN on the full lat-lon grid,
+    or packed to only the cells in the domain (see pack_cells).
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        Data to save, on the lat-lon grid or already packed.
+    path : String
+        Output file.
+    mask : xarray dataarray
+        Canada mask (CanLEAD_FWI_mask).
+    encoding : dict, optional
+        Encoding of variables. The default is None.
+    packed : bool, optional
+        Save packed cells. The default is None, to keep the format of ds (packed if ds has a 'cell' dim), so that files
+        made from packed files are packed.
+    compute : bool, optional
+        If False, return a dask delayed object to compute the write later (e.g. several files at once). The default is True.
+
+    Returns
+    -------
+    Output of to_netcdf.
+    '''
+    if packed is None:
+        packed = 'cell' in ds.dims
+    if packed:
+        if 'cell' not in ds.dims:
+            out = pack_cells(ds, mask)
+        elif 'lat' in ds.dims and 'lon' in ds.dims:
+            out = ds.copy()
+        else: # re-add full grid, if lost in calcs (e.g. along dims of data vars only)
+            out = ds.assign_coords(lat=mask['lat'].variable, lon=mask['lon'].variable)
+        out['cell'].attrs.update(compress='lat lon')
+    else:
+        out = (unpack_cells(ds) if 'cell' in ds.dims else ds).where(mask==100)
+    if encoding is not None:
+        encoding = {var: enc for var, enc in encoding.items() if var in out.variables}
+    return out.to_netcdf(path, encoding=encoding, compute=compute)
+
+# metrics masked from no_mask folders by apply_mask_attrs.py (EWEMBI only)
+mask_statistics = ['MJJAS_mean_fillna',
+                   'MJJAS_quantile_fillna',
+                   'fire_season_length',
+                   'exceedances_moderate',
+                   'exceedances_high',
+                   'exceedances_extreme',
+                   'annual_exceedances_1971_2000_MJJAS_95th_quantile_fillna'
+                   ]
+
+def masked_files(summary_path, rcp):
+    '''
+    Files in the no_mask folders of each masked metric, and the masked file made from each by apply_mask_attrs.py. 
+    Under RCP85, the RCP is added to the filename (and 'annual' removed from exceedance files).
+
+    Parameters
+    ----------
+    summary_path : String
+        summary_stats folder of the CanLEAD version, ending in '/'.
+    rcp : String
+        One of: 'RCP85', 'constructed_RCP26', 'constructed_RCP45'.
+
+    Returns
+    -------
+    fls : dict
+        {no_mask file: masked file}, for all metrics.
+    '''
+    fls = {}
+    for test_stat in mask_statistics:
+        outpath = f'{summary_path}{rcp}/{test_stat}/'
+        for fl in sorted(glob.glob(f'{outpath}no_mask/*{test_stat}.nc')): # for annual files in directory
+            if rcp == 'RCP85': # add RCP to filename to some files where it's missing
+                name_components = os.path.basename(fl).split('_')
+                name_components.insert(2, 'rcp85') # insert RCP into filename
+                if test_stat in ['exceedances_moderate',  'exceedances_high', 'exceedances_extreme']:
+                    name_components.remove('annual')
+                outname = '_'.join(name_components) 
+            else: 
+                outname = os.path.basename(fl)
+            fls[fl] = outpath + outname
+    return fls
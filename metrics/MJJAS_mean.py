@@ -7,7 +7,7 @@ import xarray as xr
 import glob
 import sys
 import os
-from config_stats import stats_chunks, add_realization_dim, get_MJJAS_data
+from config_stats import stats_chunks, add_realization_dim, season_reshape
 from filepaths import fwipaths
 import gc
 import subprocess
@@ -31,11 +31,11 @@ for fl in fls:
     data = xr.open_dataset(fl, chunks=stats_chunks) # load data
     data = data.drop_vars(['time_bnds', 'fire_season_mask']) # keep FWI System outputs only
     
-    # Select and return only MJJAS data with functions. Fill NaNs with zeros to ensure same length of fire season over time
-    fs_data = get_MJJAS_data(data)
+    # Select only MJJAS data, reshaped to (time, day) with one row per year and labels on May 1. Fill NaNs with zeros to ensure same length of fire season over time
+    fs_data = season_reshape(data).fillna(0)
     
     # Take sesaonal mean
-    outMJJAS = fs_data.resample(time='AS', loffset='120D').mean(keep_attrs=True) # add label offset of 120D so that labels are on May 1; only MJJAS data included
+    outMJJAS = fs_data.mean(dim='day', keep_attrs=True) 
     for var in outMJJAS.data_vars: # append method in attrs
         outMJJAS[var].attrs['cell_methods'] = 'time: mean over season (interval: 1 day)' # in format: time: method1 within years time: method2 over years   
         del(outMJJAS[var].attrs['ancillary_variables'])
@@ -1,12 +1,13 @@
 """
 Take 95th percentile of May to September (central fire season) FWI System components, annually. 
+Optionally ('sketch' as third argument), use streaming histogram sketches instead of exact quantiles (see HistogramQuantileSketch in config_stats.py).
 """
 # Set up code 
 import xarray as xr
 import glob
 import sys
 import os
-from config_stats import stats_chunks, add_realization_dim, get_MJJAS_data
+from config_stats import stats_chunks, add_realization_dim, season_reshape, sketch_quantile, report_sketch_error, quantile_reduce
 from filepaths import fwipaths
 import gc
 import subprocess
@@ -18,6 +19,7 @@ if not os.path.exists(outpath):
     os.makedirs(outpath)
 
 ens_group = sys.argv[2] # ensemble set, from 1 to 5
+sketch = len(sys.argv) > 3 and sys.argv[3] == 'sketch' # optional, streaming quantile sketches
 # get filenames of daily data for 10 ensemble members in the specified set
 fls = glob.glob(f'{fwipaths.output_data}/{version}/r{ens_group}_r*.nc')
 
@@ -28,14 +30,21 @@ final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')
 for fl in fls: 
     
     # open data
-    data = xr.open_dataset(fl, chunks=stats_chunks).chunk(dict(time=-1)) # time=-1 will create only one chunk along time dim
+    data = xr.open_dataset(fl, chunks=stats_chunks)
     data = data.drop_vars(['time_bnds', 'fire_season_mask']) # keep FWI System outputs only
     
-    # Select and return only MJJAS data. Fill NaNs with zeros
-    fs_data = get_MJJAS_data(data)
+    # Select only MJJAS data, reshaped to (time, day) with one row (and chunk) per year and labels on May 1. Fill NaNs with zeros
+    fs_data = season_reshape(data).fillna(0)
     
     # take MJJAS quantiles
-    out = fs_data.resample(time='AS', loffset='120D').quantile([0.95, 0.99], keep_attrs=True) # add offset of 120D so that labels are on May 1, only MJJAS data included
+    if sketch:
+        out = sketch_quantile(fs_data, [0.95, 0.99], dim='day') # fixed-size histogram per year and cell
+        if fl == fls[0]: # report error against exact quantiles, on first tile
+            tile = dict(lat=slice(0, stats_chunks['lat']), lon=slice(0, stats_chunks['lon']))
+            report_sketch_error(quantile_reduce(fs_data.isel(**tile), [0.95, 0.99], dim='day').compute(), out.isel(**tile).compute())
+    else:
+        out = quantile_reduce(fs_data, [0.95, 0.99], dim='day') # partial sort for both quantiles at once
+    out = out.transpose('time', 'quantile', ...)
     
     # update attrs
     for var in out.data_vars:
@@ -1,5 +1,5 @@
 '''
-Calculate climatological (30-year) means for RCP85.
+Calculate climatological (30-year) means for RCP85, for windows ending each decade, and as a moving 30-year mean (annual steps).
 For constructed RCPs 2.6 and 4.5, this is completed during the GWL translation process
 '''
 
@@ -10,6 +10,7 @@ import datetime
 import glob
 import sys
 from filepaths import fwipaths
+from config_stats import take_climatological_mean, PrefixClimatology, write_summary
 import gc
 import subprocess
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
@@ -29,50 +30,6 @@ version = f'CanLEAD-FWI-{sys.argv[1]}-v1' # S14FD or EWEMBI
 # Canada mask, excluding northern Arctic
 final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')['CanLEAD_FWI_mask'] 
 
-def take_climatological_mean(ds, frequency):
-    '''
-    Takes climatological (30 year) mean of input dataset, and appends that to attributes
-    in 'cell_methods'.
-
-    Parameters
-    ----------
-    ds : xarray dataset
-        Dataset containly values in MONTHLY or ANNUAL frequency.
-    frequency : String
-        Valids values: "monthly" or "annual". Describes data frequency.
-
-    Returns
-    -------
-    ds : xarray dataset
-        Dataset, with annual or monthly values now as climatological means.
-
-    '''
-    # If frequency is seasonal instead of annual, unstack the time dimension into year and season dims
-    # then take climo mean across all years, by season
-    # For annual frequency data, simply rename time dim to year, take climo mean
-    if frequency == 'seasonal': # if the data is by season, not year 
-        # assign year and season as coords, instead of time dim
-        year = ds.time.dt.year
-        season = ds.time.dt.season
-        # assign new coords
-        ds = ds.assign_coords(year=("time", year.data), season=("time", season.data))
-        # replace time with 'year' and 'month' as dims
-        ds = ds.set_index(time=("year", "season")).unstack("time")  
-    elif frequency == 'annual':
-        ds['time'] = ds.time.dt.year.values
-        ds = ds.rename({'time': 'year'})
-    # take 30 year rolling means, labelled to the RIGHT EDGE of the window
-    ds = ds.rolling(year=30, center=False).mean(keep_attrs=True)
-    # define windows to keep, using the end year of the 30 year window ending each decade
-    windows_keep = np.arange(1980,2101,10)
-    ds = ds.sel(year=ds.year.isin(windows_keep)) # select only years we're interested in (by right-side labels), 1950 to 1970 labels are incomplete (NaN) groups
-    ds = ds.rename({'year': 'period'}) # rename to reflect climatology
-    ds['period'] = [f'{ii-29}-{ii}' for ii in ds.period.values] # relabel appropriate to windows
-    for var in ds.data_vars: # append climatological mean as method in attrs
-        ds[var].attrs['cell_methods'] = ds[var].attrs['cell_methods'] + ' time: mean over years' # in format: time: method1 within years time: method2 over years
-    del(ds.attrs['frequency'])
-    return ds
-
 for test_stat in test_statistics: 
     
     outpath = f'{fwipaths.output_data}{version}/summary_stats/RCP85/{test_stat}/' # set input and output file directory
@@ -89,15 +46,21 @@ for test_stat in test_statistics:
             encoding[var] = {'dtype': 'float64', '_FillValue': None}  # for lat, lon and time
                                                     
         # take 30 year averages, add tracking attrs, and save
-        out30 = take_climatological_mean(ds, 'annual') # take climatological mean and update attrs via config function. All final stats are annual in frequency
+        climatology = PrefixClimatology(ds, 'annual') # cumulative sums over years, found once and used for all windows
+        out30 = take_climatological_mean(climatology, 'annual') # take climatological mean and update attrs via config function. All final stats are annual in frequency
         out30.attrs['history'] = f'Generated by {sys.argv[0]}'
         out30.attrs['git_id'] = tracking_id
         out30.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/' 
         out30.attrs['rcp'] = 'RCP8.5'
         out30.attrs['creation_date'] = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
         
-        out30 = out30.where(final_mask==100) # mask with Canadian boundaries and ecozone mask
-        out30.to_netcdf(f'{outpath}/{ds.realization.values[0]}_rcp85_{version}_{test_stat}_30yr_mean.nc', encoding=encoding) # save
+        # mask with Canadian boundaries and ecozone mask and save, packed if the annual file is packed
+        write_summary(out30, f'{outpath}/{ds.realization.values[0]}_rcp85_{version}_{test_stat}_30yr_mean.nc', final_mask, encoding)
+        
+        # moving 30 year means, for every window from 1950-1979 to 2071-2100. From the same cumulative sums, each window is a difference of two sums
+        out30_moving = take_climatological_mean(climatology, 'annual', end_years=np.arange(1979,2101)) 
+        out30_moving.attrs = out30.attrs
+        write_summary(out30_moving, f'{outpath}/{ds.realization.values[0]}_rcp85_{version}_{test_stat}_30yr_moving_mean.nc', final_mask, encoding)
         
-        del([out30,ds])
+        del([out30,out30_moving,climatology,ds])
         gc.collect()
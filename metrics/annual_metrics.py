@@ -0,0 +1,187 @@
+"""
+Calculate all annual metrics from the daily CanLEAD-FWI data, reading each daily file once.
+Replaces separate passes of MJJAS_mean.py, MJJAS_percentile.py, annual_percentile.py, fire_season_length.py,
+count_days_fire_danger_bins.py (for each level) and exceedances_hist_MJJAS_percentile.py. Outputs are written
+to the same paths and file names, with the same attrs and encoding, as those scripts.
+"""
+# Set up code
+import xarray as xr
+import glob
+import sys
+import os
+import dask
+from config_stats import stats_chunks, add_realization_dim, season_reshape, dexceedance, count_exceedances, sketch_resample_quantile, sketch_quantile, report_sketch_error, quantile_reduce, pack_cells
+from filepaths import fwipaths
+import gc
+import subprocess
+tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+
+version = f'CanLEAD-FWI-{sys.argv[1]}-v1' # EWEMBI or S14FD
+outpath = f'{fwipaths.output_data}{version}/summary_stats/RCP85/'
+
+ens_group = sys.argv[2] # ensemble set, from 1 to 5
+sketch = 'sketch' in sys.argv[3:] # optional, streaming quantile sketches (see HistogramQuantileSketch in config_stats.py)
+packed = 'packed' in sys.argv[3:] # optional, save only cells in Canada domain along a 'cell' dim (see pack_cells in config_stats.py)
+# get filenames of daily data for 10 ensemble members in the specified set
+fls = glob.glob(f'{fwipaths.output_data}/{version}/r{ens_group}_r*.nc')
+
+# Canada mask, excluding northern Arctic
+final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')['CanLEAD_FWI_mask']
+
+levels = ['high', 'very_high', 'extreme'] # fire danger levels, see dexceedance in config_stats.py
+test_statistics = ['MJJAS_mean_fillna', 'MJJAS_quantile_fillna', 'annual_quantile', 'fire_season_length',
+                   'exceedances_1971_2000_MJJASp95_fillna'] + [f'exceedances_{level}' for level in levels]
+for test_stat in test_statistics:
+    if not os.path.exists(f'{outpath}{test_stat}/'):
+        os.makedirs(f'{outpath}{test_stat}/')
+
+# one chunk along time, so that each block (stats_chunks lat-lon tile) is read once and used for all metrics.
+# Quantile sketches do not need the full time series in one chunk, so blocks of stats_chunks are used instead
+read_chunks = stats_chunks if sketch else dict(stats_chunks, time=-1)
+
+#%% Metrics. Each returns annual values with attrs, and the encoding to save with. See individual scripts for details.
+
+def float_encoding(out):
+    encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 3, '_FillValue': 1e+20} for var in out.data_vars}
+    for var in ['lat','lon']:
+        encoding[var] = {'dtype': 'float64', '_FillValue': None}  # for lat and lon
+    return encoding
+
+def count_encoding(out):
+    encoding = {var: {'dtype': 'int16', 'zlib': True, 'complevel': 3, '_FillValue': 32767} for var in out.data_vars}
+    for var in ['lat','lon']:
+        encoding[var] = {'dtype': 'float64', '_FillValue': None}  # for lat and lon
+    return encoding
+
+def MJJAS_mean(fs_data):
+    # Take seasonal mean of MJJAS data (NaNs filled with zeros, reshaped to (time, day) with labels on May 1), as in MJJAS_mean.py
+    out = fs_data.mean(dim='day', keep_attrs=True)
+    for var in out.data_vars: # append method in attrs
+        out[var].attrs['cell_methods'] = 'time: mean over season (interval: 1 day)' # in format: time: method1 within years time: method2 over years
+        del(out[var].attrs['ancillary_variables'])
+    out.attrs['frequency'] = 'annual fire season'
+    return out, float_encoding(out)
+
+def MJJAS_quantile(fs_data):
+    # Take MJJAS quantiles, as in MJJAS_percentile.py
+    if sketch:
+        out = sketch_quantile(fs_data, [0.95, 0.99], dim='day')
+    else:
+        out = quantile_reduce(fs_data, [0.95, 0.99], dim='day')
+    out = out.transpose('time', 'quantile', ...)
+    for var in out.data_vars:
+        out[var].attrs['cell_methods'] = 'time: percentile over MJJAS (interval: 1 day)' # add cell_methods in format: time: method1 within years time: method2 over years
+        del(out[var].attrs['ancillary_variables'])
+    out.attrs['frequency'] = 'annual fire season' # change attrs in outfile to reflect new frequency
+    return out, float_encoding(out)
+
+def annual_quantile(data):
+    # Take annual quantiles, NaN are skipped, as in annual_percentile.py
+    if sketch:
+        out = sketch_resample_quantile(data, [0.95, 0.99], time='AS')
+    else:
+        out = data.resample(time='AS').map(quantile_reduce, q=[0.95, 0.99], dim='time')
+    for var in out.data_vars:
+        out[var].attrs['cell_methods'] = 'time: percentile over year (interval: 1 day)' # add cell_methods in format: time: method1 within years time: method2 over years
+        del(out[var].attrs['ancillary_variables'])
+    out.attrs['frequency'] = 'annual' # change attrs in outfile to reflect new frequency
+    return out, float_encoding(out)
+
+def fire_season_length(fire_season_mask):
+    # Take annual count of fire season days, as in fire_season_length.py
+    out = fire_season_mask.resample(time='AS').sum(keep_attrs=True) # since values are 1 in summer, 0 in winter, this equals count
+    out = out.rename({'fire_season_mask': 'fire_season'}) # rename variable to 'fire season'
+    out['fire_season'].attrs = dict(short_name = 'fire_season',
+                                    long_name = 'Fire Season Length',
+                                    cell_methods = 'time: count within years', # in format: time: method1 within years time: method2 over years
+                                    description = 'Number of days in the annual fire season (when there is measurable fire danger and '\
+                                                  +'fire weather calculations are turned on) based on temperature thresholds.'
+                                    # wait to assign units until a later step. units are 'days'
+                                    )
+    out.attrs['frequency'] = 'year' # change attrs in outfile to reflect new frequency
+    encoding = {'fire_season': {'dtype': 'int16', '_FillValue': 32767} } # for fire season
+    for var in ['lat','lon']:
+        encoding[var] = {'dtype': 'float64', '_FillValue': None}  # for lat and lon
+    return out, encoding
+
+def exceedances_levels(data):
+    # Count days that exceed national fire danger thresholds, as in count_days_fire_danger_bins.py. All levels in one pass (see count_exceedances)
+    counts = count_exceedances(data, {level: dexceedance[level] for level in levels})
+    outputs = {}
+    for level in levels:
+        exceedances = dexceedance[level]
+        out = counts.sel(level=level).drop_vars('level')
+        for var in out.data_vars:
+            out[var].attrs = dict(short_name = data[var].attrs['short_name'] + f'_days_greater_{level}_fire_danger',
+                                  long_name = data[var].attrs['long_name'] + f': Count of days that exceed the {level} fire danger threshold of {exceedances[var]}',
+                                  cell_methods = 'time: count within years', # in format: time: method1 within years time: method2 over years
+                                  exceedance_threshold = exceedances[var],
+                                  description = data[var].attrs['description']
+                                  #units = 'days' # auto-converts into a timedelta in future scripts, leave off for now
+                                  )
+        out.attrs['frequency'] = 'year' # change attrs in outfile to reflect new frequency
+        to_exceed = data.isel(time=1).drop('time').squeeze() # get a grid of identical lat-lon from dataset, for threshold file
+        for var in data.data_vars: 
+            to_exceed[var] = exceedances[var]
+        outputs[level] = (out, count_encoding(out), to_exceed)
+    return outputs
+
+def exceedances_hist_MJJASp95(data, MJJAS_q):
+    # Count days that exceed the 1971-2000 mean MJJAS 95th percentile of this realization, as in exceedances_hist_MJJAS_percentile.py.
+    # Historical percentile is taken from MJJAS quantiles found in this pass, instead of re-reading the MJJAS_quantile_fillna_30yr_mean file.
+    # Cast to float32 first, to match the precision of the saved quantile files used by that script
+    hist = MJJAS_q.sel(quantile=0.95, time=slice('1971', '2000')).astype('float32').mean(dim='time').astype('float32').drop('quantile')
+    out = xr.where(data >= hist, 1, 0) # if true, 1, if false 0. These will be added below to count days >= hist
+    out.attrs = data.attrs # replace attrs
+    out = out.resample(time='AS').sum(keep_attrs=True) # count exceedances by summing values of 1, which indicate values >= hist
+    for var in out.data_vars:
+        out[var].attrs = dict(short_name = data[var].attrs['short_name'] + '_days_greater_historical_MJJAS_q95',
+                              long_name = data[var].attrs['long_name'] + ': Count of days that exceed the 95th percentile MJJAS fillna value in 1971-2000',
+                              cell_methods = 'time: count within years', # in format: time: method1 within years time: method2 over years
+                              description =  data[var].attrs['description']
+                              ) # units are 'days', leave off until ensemble stats
+    out.attrs['frequency'] = 'year' # change attrs in outfile to reflect new frequency
+    return out, count_encoding(out)
+
+#%% Loop over files. Build all metrics lazily, then compute and write together so that each block of daily data is read once
+
+for fl in fls:
+
+    ds = xr.open_dataset(fl, chunks=read_chunks) # open data
+    data = ds.drop_vars(['time_bnds', 'fire_season_mask']) # keep FWI System outputs only
+    fs_data = season_reshape(data).fillna(0) # Select only MJJAS data, one row per year. Fill NaNs with zeros to ensure same length of fire season over time
+
+    outputs = {} # test_stat: (out, encoding)
+    outputs['MJJAS_mean_fillna'] = MJJAS_mean(fs_data)
+    outputs['MJJAS_quantile_fillna'] = MJJAS_quantile(fs_data)
+    outputs['annual_quantile'] = annual_quantile(data)
+    outputs['fire_season_length'] = fire_season_length(ds[['fire_season_mask']])
+    outputs['exceedances_1971_2000_MJJASp95_fillna'] = exceedances_hist_MJJASp95(data, outputs['MJJAS_quantile_fillna'][0])
+    thresholds = {}
+    for level, (out, encoding, thresholds[level]) in exceedances_levels(data).items():
+        outputs[f'exceedances_{level}'] = (out, encoding)
+
+    if sketch and fl == fls[0]: # report error of sketch quantiles against exact quantiles, on first tile
+        tile = dict(lat=slice(0, stats_chunks['lat']), lon=slice(0, stats_chunks['lon']))
+        report_sketch_error(data.isel(**tile).chunk(dict(time=-1)).resample(time='AS').quantile([0.95, 0.99]).compute(), 
+                            outputs['annual_quantile'][0].isel(**tile).compute())
+        report_sketch_error(quantile_reduce(fs_data.isel(**tile), [0.95, 0.99], dim='day').compute(), 
+                            outputs['MJJAS_quantile_fillna'][0].isel(**tile).compute())
+
+    writes = []
+    for test_stat, (out, encoding) in outputs.items():
+        # add git id
+        out.attrs['history'] = f'Generated by {sys.argv[0]}'
+        out.attrs['git_id'] = tracking_id
+        out.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/'
+        # add realization as a dimension and realization attrs, via config func
+        out, realization_label = add_realization_dim(out) # realization is taken from dataset attrs
+        out = pack_cells(out, final_mask) if packed else out.where(final_mask==100) # mask with Canadian boundaries and ecozone mask
+        writes.append(out.to_netcdf(f'{outpath}{test_stat}/{realization_label}_rcp85_{version}_{test_stat}.nc', encoding=encoding, compute=False))
+    dask.compute(*writes) # single pass over daily data, shared by all metrics
+
+    for level in levels:
+        thresholds[level].isel(lat=1,lon=1).squeeze().to_netcdf(f'{outpath}exceedances_{level}/exceedances_thresholds_{level}.nc') # save exceedance thresholds file, for records
+
+    del([outputs, writes, thresholds, data, fs_data, ds, realization_label])
+    gc.collect()
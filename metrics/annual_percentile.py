@@ -1,12 +1,13 @@
 """
 Take 95th percentile of FWI System components, annually. NaN are skipped.
+Optionally ('sketch' as third argument), use streaming histogram sketches instead of exact quantiles (see HistogramQuantileSketch in config_stats.py).
 """
 # Set up code 
 import xarray as xr
 import glob
 import sys
 import os
-from config_stats import stats_chunks, add_realization_dim
+from config_stats import stats_chunks, add_realization_dim, sketch_resample_quantile, report_sketch_error, quantile_reduce
 from filepaths import fwipaths
 import gc
 import subprocess
@@ -18,6 +19,7 @@ if not os.path.exists(outpath):
     os.makedirs(outpath)
 
 ens_group = sys.argv[2] # ensemble set, from 1 to 5
+sketch = len(sys.argv) > 3 and sys.argv[3] == 'sketch' # optional, streaming quantile sketches
 # get filenames of daily data for 10 ensemble members in the specified set
 fls = glob.glob(f'{fwipaths.output_data}/{version}/r{ens_group}_r*.nc')
 
@@ -28,11 +30,18 @@ final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')
 for fl in fls: 
     
     # open data
-    data = xr.open_dataset(fl, chunks=stats_chunks).chunk(dict(time=-1)) # time=-1 will create only one chunk along time dim
+    data = xr.open_dataset(fl, chunks=stats_chunks)
     data = data.drop_vars(['time_bnds', 'fire_season_mask']) # keep FWI System outputs only
         
     # take quantiles
-    out = data.resample(time='AS').quantile([0.95, 0.99], keep_attrs=True) 
+    if sketch: 
+        out = sketch_resample_quantile(data, [0.95, 0.99], time='AS') # fixed-size histogram per year and cell, no need for one chunk along time
+        if fl == fls[0]: # report error against exact quantiles, on first tile
+            tile = dict(lat=slice(0, stats_chunks['lat']), lon=slice(0, stats_chunks['lon']))
+            report_sketch_error(data.isel(**tile).chunk(dict(time=-1)).resample(time='AS').quantile([0.95, 0.99]).compute(), out.isel(**tile).compute())
+    else:
+        data = data.chunk(dict(time=-1)) # time=-1 will create only one chunk along time dim
+        out = data.resample(time='AS').map(quantile_reduce, q=[0.95, 0.99], dim='time') # partial sort for both quantiles at once, NaN skipped
     
     # update attrs
     for var in out.data_vars:
@@ -1,54 +1,41 @@
 '''
 Apply domain mask (Canada, excluding the high Arctic) to annual and climatological metric files.
 Add missing attributes and update filenames.
+Files keep the format of their input: packed inputs (cells in the domain along a 'cell' dim, see pack_cells in config_stats.py)
+are saved packed, others masked on the lat-lon grid. Add 'packed' or 'unpacked' to save all files in one format.
+
+Run as: python apply_mask_attrs.py rcp [packed|unpacked]
 '''
 
 import xarray as xr
 import sys
-import os
-import glob
 import tqdm
 from filepaths import fwipaths
+from config_stats import write_summary, masked_files
 
 ## Mask annual metric files with Canada mask, excluding northern Arctic ecozone. 30 year and annual
 rcp = sys.argv[1] # one of: 'RCP85', 'constructed_RCP26', 'constructed_RCP45'        
-test_statistics = ['MJJAS_mean_fillna',
-                   'MJJAS_quantile_fillna',
-                   'fire_season_length',
-                   'exceedances_moderate',
-                   'exceedances_high',
-                   'exceedances_extreme',
-                   'annual_exceedances_1971_2000_MJJAS_95th_quantile_fillna'
-                   ]
+packed = None # default, keep format of input files (see write_summary in config_stats.py)
+if len(sys.argv) > 2: # optional, 'packed' or 'unpacked' to save all files in one format
+    assert sys.argv[2] in ['packed', 'unpacked'], f'Unknown format: {sys.argv[2]}'
+    packed = sys.argv[2] == 'packed'
 
 final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')['CanLEAD_FWI_mask'] # get final mask to apply
 
-for test_stat in test_statistics: 
+# files in no_mask folders of all metrics (see mask_statistics in config_stats.py), and output names, 
+# with RCP added to filename of some files where it's missing 
+fls = masked_files(f'{fwipaths.output_data}CanLEAD-FWI-EWEMBI-v1/summary_stats/', rcp)
+
+for fl, outname in tqdm.tqdm(fls.items()):
+
+    ds = xr.open_dataset(fl)
+
+    # add RCP as attr
+    if rcp == 'RCP85':
+        ds.attrs['rcp'] = 'RCP8.5' 
+    elif rcp == 'constructed_RCP26':
+        ds.attrs['rcp'] = 'Constructed RCP2.6' 
+    elif rcp == 'constructed_RCP45':
+        ds.attrs['rcp'] = 'Constructed RCP4.5' 
     
-    outpath = f'{fwipaths.output_data}CanLEAD-FWI-EWEMBI-v1/summary_stats/{rcp}/{test_stat}/'
-    fls = glob.glob(f'{outpath}no_mask/*{test_stat}.nc') # for annual files in directory
-
-    for fl in tqdm.tqdm(fls):
-
-        ds = xr.open_dataset(fl)
-
-        # apply mask and add RCP to all metric files
-        ds = ds.where(final_mask==100) # mask with Canadian boundaries and ecozone mask
-        # add RCP as attr
-        if rcp == 'RCP85':
-            ds.attrs['rcp'] = 'RCP8.5' 
-        elif rcp == 'constructed_RCP26':
-            ds.attrs['rcp'] = 'Constructed RCP2.6' 
-        elif rcp == 'constructed_RCP45':
-            ds.attrs['rcp'] = 'Constructed RCP4.5' 
-        
-        # add RCP to filename to some files where it's missing
-        if rcp == 'RCP85':
-            name_components = os.path.basename(fl).split('_')
-            name_components.insert(2, 'rcp85') # insert RCP into filename
-            if test_stat in ['exceedances_moderate',  'exceedances_high', 'exceedances_extreme']:
-                name_components.remove('annual')
-            outname = '_'.join(name_components) 
-        else: 
-            outname = os.path.basename(fl)
-        ds.to_netcdf(outpath + outname) # save file
\ No newline at end of file
+    write_summary(ds, outname, final_mask, packed=packed) # mask with Canadian boundaries and ecozone mask, and save file
@@ -1,14 +1,19 @@
 """
 Count exceedances of future FWI System component moderate, high, and extreme fire weather conditions, annually. 
 NOTE: These are incorrectly labelled in this script, and should likely be called 'high', 'very high', and 'extreme' conditions.
+All levels are counted in one pass over each daily file (see count_exceedances in config_stats.py). Third argument is one 
+level ('high', 'very_high', or 'extreme'), 'all' for all three, or the path to a json file of other thresholds, 
+in the format {level: {var: threshold}}. Thresholds from a json file are saved in one file with a level dim, named 
+after the json file, whatever the number of levels.
 """
 #%% Set up code 
 
 import xarray as xr
 import glob
+import json
 import sys
 import os
-from config_stats import stats_chunks, add_realization_dim
+from config_stats import stats_chunks, add_realization_dim, dexceedance, count_exceedances
 from filepaths import fwipaths
 import gc
 import subprocess  
@@ -16,11 +21,27 @@ tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('asci
 
 version = f'CanLEAD-FWI-{sys.argv[1]}-v1' # EWEMBI or S14FD variant
 
-level = sys.argv[3] # 'high', 'very_high', or 'extreme'
+level = sys.argv[3] # 'high', 'very_high', 'extreme', 'all', or path to json file of thresholds
+user_thresholds = level != 'all' and level not in dexceedance # thresholds from a json file
+if level == 'all': 
+    thresholds = dexceedance # national FWI System standard ratings, see dexceedance in config_stats.py
+    set_name = 'all_levels'
+elif level in dexceedance: 
+    thresholds = {level: dexceedance[level]}
+    set_name = level
+else: # user-supplied thresholds
+    with open(level) as f:
+        thresholds = json.load(f)
+    set_name = os.path.splitext(os.path.basename(level))[0]
 
-outpath = f'{fwipaths.output_data}{version}/summary_stats/RCP85/exceedances_{level}/'
-if not os.path.exists(outpath):
-    os.makedirs(outpath)
+outpath = f'{fwipaths.output_data}{version}/summary_stats/RCP85/'
+# per-level files (standard levels only) are kept for compatibility, a combined file is added for more than one level,
+# and always for user-supplied thresholds (even with one level)
+level_files = [] if user_thresholds else list(thresholds)
+combined = user_thresholds or len(thresholds) > 1
+for out_dir in [f'exceedances_{lev}' for lev in level_files] + ([f'exceedances_{set_name}'] if combined else []):
+    if not os.path.exists(f'{outpath}{out_dir}/'):
+        os.makedirs(f'{outpath}{out_dir}/')
 
 ens_group = sys.argv[2] # ensemble set, a value of 1 to 5
 fls = glob.glob(f'{fwipaths.output_data}/{version}/r{ens_group}_*.nc') # get filenames of daily data for 10 ensemble members in the specified set
@@ -28,80 +49,67 @@ fls = glob.glob(f'{fwipaths.output_data}/{version}/r{ens_group}_*.nc') # get fil
 # Canada mask, excluding northern Arctic
 final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')['CanLEAD_FWI_mask'] 
 
-#%% Count the number of values which exceed a set exceedance threshold, annually, by component
+#%% Count the number of values which exceed a set of exceedance thresholds, annually, by component
 
-# These are from national FWI System standard ratings, e.g.: https://cwfis.cfs.nrcan.gc.ca/ha/fwnormals?type=dsr&month=7
-dexceedance = { 'high': {'FFMC': 84,
-                            'DMC': 27, 
-                            'DC':  190,
-                            'ISI': 5,
-                            'BUI': 40,
-                            'FWI': 10,
-                            'DSR': 3},
-                'very_high': {'FFMC': 88,
-                         'DMC': 40, 
-                         'DC':  300,
-                         'ISI': 10,
-                         'BUI': 60,
-                         'FWI': 20,
-                         'DSR': 5},
-                'extreme': {'FFMC': 91,
-                            'DMC': 60, 
-                            'DC':  425,
-                            'ISI': 15,
-                            'BUI': 90,
-                            'FWI': 30,
-                            'DSR': 15} }
+def count_attrs(data, var, lev, threshold):
+    # attrs for count of days that exceed a threshold
+    return dict(short_name = data[var].attrs['short_name'] + f'_days_greater_{lev}_fire_danger',
+                long_name = data[var].attrs['long_name'] + f': Count of days that exceed the {lev} fire danger threshold of {threshold}',
+                cell_methods = 'time: count within years', # in format: time: method1 within years time: method2 over years
+                exceedance_threshold = threshold,
+                description = data[var].attrs['description']
+                #units = 'days' # auto-converts into a timedelta in future scripts, leave off for now
+                )
 
-for fl in fls: 
-   
-    exceedances = dexceedance[level] # set which exceedances (moderate, high or extreme)
-
-    # open data
-    data = xr.open_dataset(fl, chunks=stats_chunks) 
-    data = data.drop_vars(['time_bnds', 'fire_season_mask']) # keep FWI System outputs only
-
-    # create lat-lon grid of the static exceedances for each var
-    to_exceed = data.isel(time=1).drop('time').squeeze() # get a grid of identical lat-lon from dataset
-    for var in data.data_vars: # re-assign values for each component using "exceedances" defined above
-        to_exceed[var] = exceedances[var] 
-            
-    out = xr.where(data >= to_exceed, 1, 0) # if true, 1, if false 0
-    out.attrs = data.attrs # copy over attrs from input dataset lost in xr.where
-    out = out.resample(time='AS').sum(keep_attrs=True) # take annual sum of counts where data >= to_exceed
-    
-    # add realization as a dimension and realization attrs, via config func
-    out, realization_label = add_realization_dim(out) # realization taken from dataset attrs
-
-    # update FWI System component attrs + var names
-    for var in out.data_vars: 
-        # set new attributes
-        attrs = dict(short_name = data[var].attrs['short_name'] + f'_days_greater_{level}_fire_danger',
-                     long_name = data[var].attrs['long_name'] + f': Count of days that exceed the {level} fire danger threshold of {exceedances[var]}',
-                     cell_methods = 'time: count within years', # in format: time: method1 within years time: method2 over years
-                     exceedance_threshold = exceedances[var],
-                     description = data[var].attrs['description']
-                     #units = 'days' # auto-converts into a timedelta in future scripts, leave off for now
-                     )
-        out[var].attrs = attrs # replace attrs with new attrs
-    out.attrs['frequency'] = 'year' # change attrs in outfile to reflect new frequency
-
-    # set encoding
+def save(out, flnm):
+    # set encoding, add git id, mask and save
     encoding = {var: {'dtype': 'int16', 'zlib': True, 'complevel': 3, '_FillValue': 32767} for var in out.data_vars} 
     for var in ['lat','lon']: 
         encoding[var] = {'dtype': 'float64', '_FillValue': None}  # for lat and lon
-
-    # add  git id
     out.attrs['history'] = f'Generated by {sys.argv[0]}'
     out.attrs['git_id'] = tracking_id
     out.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/' 
-        
     out = out.where(final_mask==100) # mask with Canadian boundaries and ecozone mask
-           
-    # save
-    out.to_netcdf(f'{outpath}/{realization_label}_rcp85_{version}_exceedances_{level}.nc', encoding=encoding) 
+    out.to_netcdf(flnm, encoding=encoding) 
+
+for fl in fls: 
+
+    # open data
+    data = xr.open_dataset(fl, chunks=stats_chunks) 
+    data = data.drop_vars(['time_bnds', 'fire_season_mask']) # keep FWI System outputs only
+    
+    # annual count of days >= threshold, for all levels at once. Each day is binned once with np.digitize
+    counts = count_exceedances(data, thresholds).persist() # keep counts (small) in memory, used for all outputs
+    
+    # add realization as a dimension and realization attrs, via config func
+    counts, realization_label = add_realization_dim(counts) # realization taken from dataset attrs
+    counts.attrs['frequency'] = 'year' # change attrs in outfile to reflect new frequency
+    
+    # save one file per standard level, as before
+    for lev in level_files:
+        out = counts.sel(level=lev).drop_vars('level')
+        for var in out.data_vars: 
+            out[var].attrs = count_attrs(data, var, lev, thresholds[lev][var]) # replace attrs with new attrs
+        save(out, f'{outpath}exceedances_{lev}/{realization_label}_rcp85_{version}_exceedances_{lev}.nc')
         
-    to_exceed.isel(lat=1,lon=1).squeeze().to_netcdf(f'{outpath}/exceedances_thresholds_{level}.nc') # save exceedance thresholds file, for records
+        # save exceedance thresholds file, for records
+        to_exceed = data.isel(time=1, lat=1, lon=1).drop('time').squeeze() 
+        for var in data.data_vars: 
+            to_exceed[var] = thresholds[lev][var] 
+        to_exceed.to_netcdf(f'{outpath}exceedances_{lev}/exceedances_thresholds_{lev}.nc') 
+    
+    # save all levels in one file, with level as a dim
+    if combined:
+        out = counts.copy()
+        for var in out.data_vars: 
+            out[var].attrs = dict(short_name = data[var].attrs['short_name'] + '_days_greater_fire_danger',
+                                  long_name = data[var].attrs['long_name'] + ': Count of days that exceed the fire danger threshold of each level',
+                                  cell_methods = 'time: count within years', 
+                                  exceedance_threshold = [thresholds[lev][var] for lev in thresholds], # in order of level dim
+                                  description = data[var].attrs['description']
+                                  )
+        out['level'].attrs = dict(long_name = 'Fire danger level', threshold_set = set_name)
+        save(out, f'{outpath}exceedances_{set_name}/{realization_label}_rcp85_{version}_exceedances_{set_name}.nc')
         
-    del([out,data,realization_label,to_exceed])
-    gc.collect()     
\ No newline at end of file
+    del([counts,data,realization_label])
+    gc.collect()
@@ -9,10 +9,13 @@ import subprocess
 import sys
 import datetime
 from filepaths import fwipaths
+from config_ensemble import stream_ensemble
+from config_stats import write_summary
 import gc
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
 
 version = f'CanLEAD-FWI-{sys.argv[1]}-v1'
+max_memory = float(sys.argv[2]) * 1e9 if len(sys.argv) > 2 else 2e9 # optional, memory budget (GB) for one spatial tile of all realizations, see stream_ensemble in config_ensemble.py
 
 test_statistics = ['MJJAS_mean_fillna',
                    'MJJAS_quantile_fillna',
@@ -47,26 +50,27 @@ for test_stat in test_statistics:
     cfls = glob.glob(f'{fwipaths.output_data}{version}/summary_stats/{rcp}/{test_stat}/*_{test_stat}*_30yr_mean.nc') 
     assert len(cfls) == 50, f'Number of files does not equal 50: {len(cfls)}'
     
-    # open all 50 files together
-    alldat = xr.open_mfdataset(cfls, chunks={'realization':-1, 'lat':5, 'lon':5},
-                               decode_timedelta=False).chunk({'realization':-1}) # chunk=-1 will create only one chunk, to allow stats
+    def select_ref_period(ds):
+        return ds.sel(period=['1971-2000']) # select historical period. this is the 30 year average
     
-    ref_period = alldat.sel(period='1971-2000').squeeze() # select historical period. this is the 30 year average
+    def std_tile(ref_period):
+        ref_period = ref_period.squeeze('period')
+        # for MJJAS quantile metric, rename quantile dims if they exist
+        if 'quantile' in ref_period.coords: 
+            ref_period = ref_period.rename({'quantile': 'annual_quantiles'}) 
+        # take the standard deviation across the reference period climatologies
+        return {'std': ref_period.std(dim='realization', keep_attrs=True, skipna=False)}
     
-    # for MJJAS quantile metric, rename quantile dims if they exist
-    if 'quantile' in ref_period.coords: 
-        ref_period = ref_period.rename({'quantile': 'annual_quantiles'}) 
-                
-    # take the standard deviation across the reference period climatologies
-    std = ref_period.std(dim='realization', keep_attrs=True, skipna=False) 
+    # stream the 50 files in spatial tiles, only the reference period is read
+    std = stream_ensemble(cfls, std_tile, preprocess=select_ref_period, max_memory=max_memory)['std']
            
     # set encoding for file save
-    encoding = {var: {'zlib': True, 'complevel': 4} for var in alldat.data_vars} 
+    encoding = {var: {'zlib': True, 'complevel': 4} for var in std.data_vars} 
     for var in ['lat','lon']:
         encoding[var] = {'dtype': 'float64', '_FillValue': None}  
         
     std = add_attrs(std) # add file tracking (git) attrs
-    std.where(final_mask==100).to_netcdf(f'{outpath}{test_stat}_ensemble_std_1971_2000.nc', encoding=encoding) # save
+    write_summary(std, f'{outpath}{test_stat}_ensemble_std_1971_2000.nc', final_mask, encoding) # trim to Canada domain and save, packed if inputs are packed
         
-    del([cfls,alldat,std])
+    del([cfls,std])
     gc.collect()
@@ -0,0 +1,70 @@
+'''
+Climatological (30-year) means of metrics at any global warming levels (GWL), for each realization, from the RCP8.5
+window of each realization closest to each GWL. Windows are taken from the persisted window index (see config_gwl.py),
+which is extended for GWLs not yet in the index, so that new warming levels do not need the GWL translation to be rerun.
+
+Run as: python gwl_climatology.py version gwls test_stat [test_stat ...]
+    gwls: comma separated warming levels, e.g. 1.5,2,3,4
+'''
+
+import xarray as xr
+import glob
+import os
+import sys
+import datetime
+import subprocess
+import dask
+import gc
+from filepaths import fwipaths
+from config_stats import write_summary
+from config_gwl import window_index, stack_realizations, gwl_climatology, tas_window
+tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+
+version = f'CanLEAD-FWI-{sys.argv[1]}-v1'
+gwls = [float(gwl) for gwl in sys.argv[2].split(',')]
+test_statistics = sys.argv[3:]
+
+tas_file = f'{fwipaths.input_data}/CanLEAD/tasAnom_PI_Ayr_CanESM2_historical-rcp85_185001-210012.csv' # CanESM2-LE global warming levels for RCP85
+index = window_index(f'{fwipaths.working_data}/GWL/gwl_window_index.csv', tas_file, gwls, tas_window)
+
+# Canada mask, excluding northern Arctic
+final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')['CanLEAD_FWI_mask'] 
+
+def add_attrs(ds):
+    ds.attrs['history'] = f'Generated by {sys.argv[0]}'
+    ds.attrs['git_id'] = tracking_id
+    ds.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/'
+    ds.attrs['creation_date'] = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    ds.attrs['description'] = 'Climatological means at global warming levels, from the 30 year window of each realization '\
+                              +'under RCP8.5 with the global warming level closest to the target.'
+    return ds
+
+for test_stat in test_statistics:
+
+    if test_stat == 'QS-DEC_mean':
+        freq = 'seasonal'
+    elif test_stat == 'MS_mean':
+        freq = 'monthly'
+    else:
+        freq = 'annual'
+
+    outpath = f'{fwipaths.output_data}{version}/summary_stats/GWL/{test_stat}/'
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
+
+    afls = sorted(glob.glob(f'{fwipaths.output_data}{version}/summary_stats/RCP85/{test_stat}/*{test_stat}.nc'))
+    annual_alldat, member_attrs = stack_realizations(afls) # file attrs differ by realization
+    climatology = gwl_climatology(annual_alldat, gwls, index, freq) # all realizations and GWLs at once
+
+    writes = []
+    for i, realization in enumerate(annual_alldat.realization.values):
+        out = climatology.isel(realization=[i]).transpose('gwl', 'realization', ...)
+        out.attrs = dict(member_attrs[i])
+        out.attrs.pop('frequency', None)
+        out = add_attrs(out)
+        # mask with Canadian boundaries and ecozone mask and save, packed if the annual file is packed
+        writes.append(write_summary(out, f'{outpath}{realization}_rcp85_{version}_{test_stat}_GWL_30yr_mean.nc', final_mask, compute=False))
+    dask.compute(*writes)
+
+    del([annual_alldat, climatology, writes])
+    gc.collect()
@@ -9,6 +9,7 @@ import sys
 import os
 import datetime
 from filepaths import fwipaths
+from config_stats import write_summary
 from tqdm import tqdm
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
 
@@ -57,6 +58,6 @@ for test_stat in tqdm(test_statistics):
         # calculate the robustness of future change using a signal to noise ratio approach. Robust change = True when |SNR| > 1
         robustness = xr.where(abs(alldat) > std, True, False)  
         
-        # add attrs, mask to study domain, and save
-        add_attrs(robustness).where(final_mask==100).to_netcdf(f'{outpath}{test_stat}_{rcp}_30yr_mean_robustness.nc')
+        # add attrs, mask to study domain, and save (packed if the ensemble statistics are packed)
+        write_summary(add_attrs(robustness), f'{outpath}{test_stat}_{rcp}_30yr_mean_robustness.nc', final_mask)
           
\ No newline at end of file
@@ -10,12 +10,14 @@ import sys
 import os
 import datetime
 from filepaths import fwipaths
+from config_ensemble import ensemble_percentiles, stream_ensemble
 import gc
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
 
 version = f'CanLEAD-FWI-{sys.argv[1]}-v1'
 if sys.argv[1] == 'S14FD': nfls = 10
 elif sys.argv[1] == 'EWEMBI': nfls = 50
+max_memory = float(sys.argv[2]) * 1e9 if len(sys.argv) > 2 else 2e9 # optional, memory budget (GB) for one spatial tile of all realizations, see stream_ensemble in config_ensemble.py
 
 test_statistics = ['annual_quantile',
                    #'QS-DEC_mean', 
@@ -37,16 +39,17 @@ for test_stat in test_statistics:
             
     afls = glob.glob(f'{fwipaths.output_data}{version}/summary_stats/RCP85/{test_stat}/*_{test_stat}.nc')
     assert len(afls) == nfls, f'Number of files does not equal {nfls}: {len(afls)}'
-    annual_alldat = xr.open_mfdataset(afls).chunk({'realization':-1})
     
-    test_period = annual_alldat.sel(time=slice('1981','2014')).mean(dim='time')
+    def test_period_mean(ds):
+        return ds.sel(time=slice('1981','2014')).mean(dim='time', keep_attrs=True)
     
-    if 'quantile' in test_period.coords:
-        test_period = test_period.rename({'quantile': 'annual_quantiles'})
-        
-    test_period_ens_perc = xr.merge([test_period.quantile([0.10,0.50,0.90], dim='realization', keep_attrs=True).rename({'quantile':'ensemble_statistic'}),
-                                     test_period.mean(dim='realization', keep_attrs=True).assign_coords({'ensemble_statistic': 'mean'}).expand_dims('ensemble_statistic')])
-    test_period_ens_perc['ensemble_statistic'] = [f'quantile:{q}' for q in test_period_ens_perc.ensemble_statistic.values[:3]] + ['mean']                     
+    def ensemble_tile(test_period):
+        if 'quantile' in test_period.coords:
+            test_period = test_period.rename({'quantile': 'annual_quantiles'})
+        return {'absolute': ensemble_percentiles(test_period)}
+    
+    # stream annual files in spatial tiles, so that only one tile of all realizations is in memory at once
+    test_period_ens_perc = stream_ensemble(afls, ensemble_tile, preprocess=test_period_mean, max_memory=max_memory)['absolute']
         
     encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 4} for var in test_period_ens_perc.data_vars} #
         
@@ -54,5 +57,5 @@ for test_stat in test_statistics:
               
     test_period_ens_perc.to_netcdf(f'{outpath}/{test_stat}_1981_2014_mean_ensemble_percentiles.nc', encoding=encoding)
     
-    del([afls,annual_alldat,test_period,test_period_ens_perc])
+    del([afls,test_period_ens_perc])
     gc.collect()
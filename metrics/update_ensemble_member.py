@@ -0,0 +1,135 @@
+'''
+Update ensemble statistics, intraensemble standard deviation and robustness when one realization is added, removed or
+replaced (e.g. reprocessed after a data fix), without re-reading the other realizations. Uses the ensemble state saved
+for each metric (see EnsembleState in config_ensemble.py), which is built from all realization files on the first run.
+Outputs are written to the same paths and file names as ensemble_statistics_all_rcps.py, ensemble_std.py and robustness.py.
+
+Run as: python update_ensemble_member.py version rcp action [realization] [verify]
+    action: 'build' (state from all files), 'add', 'remove' or 'replace'
+    realization: realization label, e.g. r1_r1i1p1 (not needed for 'build')
+    verify: optional, check updated statistics against a full recompute from all files
+'''
+
+import xarray as xr
+import glob
+import pandas as pd
+import subprocess
+import datetime
+import sys
+import os
+from filepaths import fwipaths
+from config_ensemble import EnsembleState, save_ensemble_statistics
+from config_stats import write_summary
+import gc
+tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+
+version = f'CanLEAD-FWI-{sys.argv[1]}-v1' # get CanLEAD version from job file
+rcp = sys.argv[2] # get RCP from job file
+action = sys.argv[3] # 'build', 'add', 'remove' or 'replace'
+assert action in ['build', 'add', 'remove', 'replace'], f'Unknown action: {action}'
+label = sys.argv[4] if action != 'build' else None
+verify = sys.argv[-1] == 'verify'
+
+test_statistics = ['fire_season_length',
+                   'exceedances_high',
+                   'exceedances_extreme',
+                   'exceedances_very_high',
+                   'MJJAS_mean_fillna',
+                   'MJJAS_quantile_fillna',
+                   'annual_quantile',
+                   'exceedances_1971_2000_MJJASp95_fillna'
+                   ]
+std_statistics = [test_stat for test_stat in test_statistics if test_stat != 'annual_quantile'] # as in ensemble_std.py
+robustness_statistics = [test_stat for test_stat in std_statistics if test_stat != 'exceedances_1971_2000_MJJASp95_fillna'] # as in robustness.py
+
+inpath = f'{fwipaths.output_data}{version}/summary_stats/'
+outpath = f'{inpath}{rcp}/ensemble_percentiles/'
+statepath = f'{inpath}{rcp}/ensemble_state/'
+if not os.path.exists(statepath):
+    os.makedirs(statepath)
+
+# Canada mask, excluding northern Arctic
+final_mask = xr.open_dataset(f'{fwipaths.input_data}/CanLEAD_FWI_final_mask.nc')['CanLEAD_FWI_mask']
+
+if rcp == 'RCP85':
+    # get RCP8.5 info from csv, not associated with nc input files
+    all_wl = pd.read_csv(f'{fwipaths.working_data}GWL/warming_levels_by_period_all_RCPs.csv', index_col=0)['RCP8.5']
+    wl_string = [f'GWL:{wl:.2f}Cvs1850-1900' for wl in all_wl.values] # generate strings to use as dataset coordinate
+else:
+    wl_string = None # for constructed RCPs, from the mean warming level of members, kept in the state
+
+# function to add tracking attributes to std output file, as in ensemble_std.py
+def add_attrs(ds):
+    ds.attrs['history'] = f'Generated by {sys.argv[0]}'
+    ds.attrs['git_id'] = tracking_id
+    ds.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/'
+    ds.attrs['creation_date'] = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    return ds
+
+# function to add tracking attributes and description to robustness output file, as in robustness.py
+def add_robustness_attrs(ds):
+    ds = add_attrs(ds)
+    ds.attrs['description'] = 'Boolean mask of whether the CanLEAD-FWI ensemble mean projected change is robust'\
+                                +' (signal to noise ratio greater than 1) for the FWI System component and' \
+                                +'  time period specified by the coordinates.'
+    ds.attrs['values'] = "True (robust), False (non-robust)"
+    return ds
+
+def robustness(test_stat, rcp):
+    # robustness of future change using a signal to noise ratio approach. Robust change = True when |SNR| > 1, as in robustness.py
+    delta_file = f'{inpath}{rcp}/ensemble_percentiles/{test_stat}_{rcp}_30yr_mean_delta_1971_2000_ensemble_percentiles.nc'
+    std_file = f'{inpath}intraensemble_std_1971_2000/{test_stat}_ensemble_std_1971_2000.nc'
+    if not (os.path.exists(delta_file) and os.path.exists(std_file)):
+        return
+    rpath = f'{inpath}{rcp}/ensemble_percentiles/robustness/'
+    if not os.path.exists(rpath):
+        os.makedirs(rpath)
+    with xr.open_dataset(delta_file, decode_timedelta=False) as alldat, xr.open_dataset(std_file, decode_timedelta=False) as std:
+        robust = xr.where(abs(alldat.sel(ensemble_statistic='mean')) > std, True, False).load()
+    write_summary(add_robustness_attrs(robust), f'{rpath}{test_stat}_{rcp}_30yr_mean_robustness.nc', final_mask)
+
+for test_stat in test_statistics:
+
+    cfls = glob.glob(f'{inpath}{rcp}/{test_stat}/*_{test_stat}*_30yr_mean.nc') # get all files
+    if action == 'remove': # file of removed realization may still be in folder
+        cfls = [fl for fl in cfls if not os.path.basename(fl).startswith(f'{label}_')]
+    state_file = f'{statepath}{test_stat}_{rcp}_ensemble_state.nc'
+
+    if action == 'build' or not os.path.exists(state_file):
+        state = EnsembleState.from_files(cfls) # read each realization file once, this includes any changed realization
+    else:
+        state = EnsembleState.open(state_file)
+        if action == 'remove':
+            state.remove(label)
+        else:
+            member_fl = glob.glob(f'{inpath}{rcp}/{test_stat}/{label}_*_{test_stat}*_30yr_mean.nc')
+            assert len(member_fl) == 1, f'Number of files for {label} does not equal 1: {len(member_fl)}'
+            with xr.open_dataset(member_fl[0], decode_timedelta=False) as ds:
+                if action == 'add':
+                    state.add(ds)
+                else:
+                    state.replace(ds)
+    print(f'{test_stat} {rcp}: {len(state.members)} members')
+
+    if verify: # consistency check against a full recompute from all files
+        assert state.verify(cfls, wl_string), f'Updated ensemble statistics of {test_stat} do not match a full recompute'
+
+    # ensemble percentiles of absolute values, deltas and percent deltas. Add attrs, trim to Canada domain and save
+    var_attrs = {var: state.state[var].attrs for var in state.variables}
+    save_ensemble_statistics(state.statistics(wl_string), test_stat, rcp, outpath, var_attrs, final_mask, f'Generated by {sys.argv[0]}', tracking_id)
+
+    # all RCPs are the same in historical period (due to GWL translation), so std is only from RCP85, and used for robustness of all RCPs
+    if rcp == 'RCP85' and test_stat in std_statistics:
+        std = add_attrs(state.std()) # add file tracking (git) attrs
+        encoding = {var: {'zlib': True, 'complevel': 4} for var in std.data_vars}
+        for var in ['lat','lon']:
+            encoding[var] = {'dtype': 'float64', '_FillValue': None}
+        write_summary(std, f'{inpath}intraensemble_std_1971_2000/{test_stat}_ensemble_std_1971_2000.nc', final_mask, encoding)
+
+    if test_stat in robustness_statistics:
+        for robustness_rcp in (['RCP85','constructed_RCP26', 'constructed_RCP45'] if rcp == 'RCP85' else [rcp]):
+            robustness(test_stat, robustness_rcp)
+
+    state.save(state_file)
+    del([cfls, state])
+    gc.collect()
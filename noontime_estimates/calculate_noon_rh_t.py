@@ -10,11 +10,16 @@ import sys
 import os
 import math
 import subprocess
+import resource
+import dask
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/'))
 import xclim as xc # xclim functions for unit conversions
 from xclim.indices import saturation_vapor_pressure
 from filepaths import fwipaths
 from config import canada_bounds
+from config_noon import broadcast_climatology, cache_static_parameters, open_static_parameters, static_cache_valid
 import datetime
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip() 
 
@@ -127,26 +132,55 @@ def RH_noon_wrapper(tnoon, tasmin, tasmax, hurs):
 version = sys.argv[2] # EWEMBI or S14FD
 InputDataDir = f'{fwipaths.input_data}CanLEAD/CanRCM4-{version}-MBCn/'
 OutputDataDir = f'{fwipaths.working_data}noontime/' 
+CacheDir = f'{fwipaths.working_data}noontime_static_cache/' # read-only memory maps of sunrise, solar noon and temperature offsets, shared by workers and versions
+sunrise_noon_file = f'{fwipaths.working_data}CanLEAD_utc_sunrise_solar_noon.nc' # sources of the cache, rebuilt if changed
+temp_offsets_file = f'{fwipaths.working_data}CanLEAD_offsets_tmin_tmax_month_1971_2000_all_realization_circmean.nc'
 if not os.path.exists(OutputDataDir): 
     os.makedirs(OutputDataDir)
+workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1 # optional, number of realizations to run at once
+memory_limit = float(sys.argv[4]) if len(sys.argv) > 4 else None # optional, memory limit per worker in GB
     
 ## Add CanLEAD filename components here to make read-in more streamlined
 fname1 = "_NAM-44i_CCCma-CanESM2_rcp85_"
 fname2 = f"_CCCma-CanRCM4_r2_ECCC-MBCn-{version}-1981-2010_day_19500101-21001231.nc" 
-   
-## Import estimated offsets of hmax, and time of local solar noon in UTC. Predetermined from CanRCM4 in utc_sunrise_noon.py and diurnal_estimates.py
 
 chunks = {"time": 2555, 'lat': 10, 'lon': 10} # define chunks to use on data import, to speed up calculations with dask
-sunrise_noon = xr.open_dataset(f'{fwipaths.working_data}CanLEAD_utc_sunrise_solar_noon.nc', chunks=chunks).sel(**canada_bounds) # get sunrise and solar noon
-temp_offsets = xr.open_dataset(f'{fwipaths.working_data}CanLEAD_offsets_tmin_tmax_1971_2000_all_realization_circmean_1950_2100_daily.nc').sel(**canada_bounds) # time of tmin and tmax, from 0 to 23
 
-# Get ensemble group from job file. For each realization in group, calculate noontime estimates 
-j = sys.argv[1]
-for m in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]: 
-    # define ensemble number
-    if m in [8,9,10]: nens = f'r{j}_r{m}i2p1' 
-    else: nens = f'r{j}_r{m}i1p1'
-     
+def build_static_cache():
+    '''
+    Import time of local solar noon and sunrise in UTC, and estimated monthly offsets of hmax, clipped to Canada. Predetermined 
+    from CanRCM4 in utc_sunrise_noon.py and diurnal_estimates.py. Written to CacheDir (see cache_static_parameters in config_noon.py), 
+    so that workers do not each re-read, re-chunk and slice these inputs, with the size and modification time of the source files.
+    The inputs are the same for all versions, so the cache is shared by versions, and each part is only rebuilt if incomplete 
+    or if its source file has changed.
+    '''
+    if not static_cache_valid(f'{CacheDir}sunrise_noon/', [sunrise_noon_file]):
+        sunrise_noon = xr.open_dataset(sunrise_noon_file, chunks=chunks).sel(**canada_bounds) # get sunrise and solar noon
+        cache_static_parameters(sunrise_noon, f'{CacheDir}sunrise_noon/', time_block=chunks['time'], sources=[sunrise_noon_file])
+    if not static_cache_valid(f'{CacheDir}temp_offsets_month/', [temp_offsets_file]):
+        temp_offsets_month = xr.open_dataset(temp_offsets_file).sel(**canada_bounds) # time of tmin and tmax, from 0 to 23, by month
+        temp_offsets_month = temp_offsets_month.drop_vars('time', errors='ignore') # drop any scalar time coordinate left from regridding
+        cache_static_parameters(temp_offsets_month, f'{CacheDir}temp_offsets_month/', sources=[temp_offsets_file])
+
+def init_worker(dask_threads, memory_limit=None):
+    '''
+    Set up a worker process: limit memory, set number of dask threads, and open the cached static parameters
+    as read-only memory maps (pages are shared between workers, not copied).
+    '''
+    global sunrise_noon, temp_offsets
+    if memory_limit is not None: 
+        # RLIMIT_DATA counts heap and anonymous memory, but not the read-only memory maps, which are shared
+        limit = int(memory_limit * 1024**3)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit)) 
+    dask.config.set(scheduler='threads', num_workers=dask_threads)
+    sunrise_noon = open_static_parameters(f'{CacheDir}sunrise_noon/', chunks=chunks)
+    temp_offsets_month = open_static_parameters(f'{CacheDir}temp_offsets_month/')
+    temp_offsets = broadcast_climatology(temp_offsets_month, sunrise_noon.time, group='month', chunks=chunks) # index monthly offsets by the month of each day, lazily at compute time
+
+def noon_estimates(nens):
+    '''
+    Calculate noontime temperature and RH for one realization, and save. Run in a worker set up by init_worker.
+    '''
     ## import CanLEAD-CanRCM4 relative humidity, maximum temperature, and minimum temperature
     
     flnm = InputDataDir + nens + "/tasmaxAdjust" + fname1 + nens + fname2 
@@ -203,7 +237,7 @@ for m in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
         
     ## calculate approx temperature at noon using function 'tas_noon' detailed above
     
-    # apply tas_noon using groupby('time.month') for all inputs other than temp_offsets, which has month instead time dim
+    # apply tas_noon for all inputs, temp_offsets is indexed by month of each day (see broadcast_climatology in config_noon.py)
     tnoon = xr.apply_ufunc(tas_noon, 
                            tasminAdjust, tasmaxAdjust,  # tmin, tmax
                            sunrise_noon.sunrise_utc, # h_sunrise
@@ -243,7 +277,33 @@ for m in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
                                + f'Solar noon and sunrise determined for each location (grid point lat-lon) using {sunrise_noon.attrs["pvlib_info"]}.'       
     
     add_attrs(RH_noon, 'RH_noon') # add additional attrs, and save
-  
+    
     del([tasmaxAdjust, tasminAdjust, RH_noon, tnoon])
     gc.collect()
+    return nens
 
+if __name__ == '__main__':
+    build_static_cache() # built once, reused for all ensemble groups and versions
+    
+    # Get ensemble group from job file. For each realization in group, calculate noontime estimates 
+    j = sys.argv[1]
+    nens_all = []
+    for m in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]: 
+        # define ensemble number
+        if m in [8,9,10]: nens_all.append(f'r{j}_r{m}i2p1')
+        else: nens_all.append(f'r{j}_r{m}i1p1')
+    
+    # run realizations over a pool of worker processes, split cpus between workers for dask 
+    dask_threads = max(1, (os.cpu_count() or 1) // workers)
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(dask_threads, memory_limit)) as pool:
+        futures = {pool.submit(noon_estimates, nens): nens for nens in nens_all}
+        for future in tqdm(as_completed(futures), total=len(futures)): 
+            nens = futures[future]
+            try:
+                future.result()
+            except Exception as e: # e.g., MemoryError if worker exceeds memory_limit, continue with other realizations
+                print(f'{nens} failed: {e!r}')
+                failed.append(nens)
+    if failed:
+        sys.exit(f'Noontime estimates failed for: {", ".join(failed)}')
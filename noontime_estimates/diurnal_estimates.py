@@ -8,7 +8,8 @@ import xarray as xr
 import numpy as np
 import gc
 import glob
-from scipy import stats
+import datetime
+import dask
 
 import sys
 import os
@@ -16,6 +17,7 @@ import subprocess
 sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/'))
 from filepaths import fwipaths 
 from config import canada_bounds_rotated_index
+from config_noon import CircularMeanAccumulator
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip() 
 
 #%% Equations 
@@ -53,6 +55,37 @@ def hourmin(da):
     out = da.argmin(dim='time') # return index (time) of the minimum temperature value
     return out
 
+def hourmax_hourmin(da):
+    '''
+    Determine the hour of daily maximum and minimum temperature in a single pass. The hourly series is reshaped 
+    to (day, hour) and argmax and argmin are taken along the hour dimension, so both are computed from the same read
+    of the input data. Equivalent to resample(time='24H').map(hourmax) and resample(time='24H').map(hourmin).
+    
+    Falls back to the resample approach if the input does not consist of whole, regular UTC days 
+    (e.g., gaps in the hourly series, or a series which does not start at 00:00 UTC).
+    
+    Parameters
+    ----------
+    da : xr dataarray of hourly tas (temperature), aligned to the hour (e.g., with resample(time='1H').nearest())
+
+    Returns
+    ----------
+    hmax, hmin : Time (index) of maximum and minimum temperature, in hours from midnight, with daily time dimension
+    '''  
+    times = da.indexes['time']
+    whole_days = (times.size % 24 == 0) and (times[0].hour == 0) # series must contain whole UTC days only
+    if whole_days: # check that hourly steps are regular, i.e., no gaps, so that each block of 24 values is one day
+        steps = np.unique(np.diff(np.asarray(times[::24]))) # difference between the first time step of each day
+        whole_days = (times.size == 24) or (steps.size == 1 and steps[0] == datetime.timedelta(days=1))
+    if not whole_days: 
+        return da.resample(time='24H').map(hourmax), da.resample(time='24H').map(hourmin)
+    
+    daily = da.coarsen(time=24).construct(time=('day', 'hour')) # reshape (time) to (day, hour), without copying data 
+    day_time = times[::24] # label each day by its first time step (00:00 UTC), as in resample(time='24H')
+    hmax = daily.argmax(dim='hour').rename(day='time').assign_coords(time=day_time) 
+    hmin = daily.argmin(dim='hour').rename(day='time').assign_coords(time=day_time)
+    return hmax, hmin
+
 def get_circmean(da, min_max, dawn_noon): 
     '''
     Calculate the 'day of year' circular mean of the timing of maximum or minimum temperature. Add attributes.
@@ -67,13 +100,14 @@ def get_circmean(da, min_max, dawn_noon):
     ----------
     mn : xr dataset containing the circular mean of the timing of tmax or tmin, by day of year 
     '''  
-    mn = xr.apply_ufunc(stats.circmean, da.groupby('time.month'), # take circular mean across 30 years by day of year, max value = period = 24, min value = 0
-                        kwargs=dict(high=24, low=0),
-                        input_core_dims=[['time']], # broadcast across all times except time, that is, take mean over time dim (grouped by day of year)
-                        output_dtypes=[da.dtype],
-                        vectorize=True, # loop over non-core dims
-                        dask='parallelized') # apply_ufunc to speed up via dask
-                        
+    # take circular mean across 30 years by month, max value = period = 24, min value = 0. Vectorized over all cells using running sums of sines and cosines
+    mn = CircularMeanAccumulator(high=24, low=0, group='month').add(da, dim='time').result().astype(da.dtype) 
+    return add_circmean_attrs(mn, min_max, dawn_noon)
+
+def add_circmean_attrs(mn, min_max, dawn_noon):
+    '''
+    Add attributes to the circular mean of the timing of maximum or minimum temperature, and return as a dataset.
+    '''
     mn.attrs['description'] = f'Day of year climatological ({start_yr}, {end_yr}) circular mean of the offset of daily {min_max} temperature from {dawn_noon} in decimal hours'
     mn.attrs['name'] = f'Offset of {min_max} temperature from {dawn_noon}'
     mn.attrs['units'] = 'Decimal hours'
@@ -88,29 +122,38 @@ def mask_add_ens(ds): # clip to Canada domain, add realization as dimension
 #%% Determine daily timing (index) of max and min temperature for each day of year using CanRCM4 hourly data
 # For use in noontime temperature estimates based on Beck and Trevitt (1989). For additional details see calculate_noon_rh_t.py.
 
-ens = sys.argv[1] # get ensemble group number from run file: [1,2,3,4,5] 
+start_yr, end_yr = 1971, 2000
+
+def hourly_files(ens, real, yr):
+    # get filenames of hourly temperature data that contain the year 'yr' for realization
+    return glob.glob(f'{fwipaths.input_data}CanRCM4/NAM-44_CCCma-CanESM2_historical-r{ens}/1hr/atmos/tas/r{real}i2p1/*{yr}*nc') 
+
+def open_noon_sunrise():
+    # time of sunrise and noon in UTC, generated in utc_sunrise_noon.py
+    noon_sunrise = xr.open_dataset(f'{fwipaths.working_data}CanRCM4_utc_sunrise_solar_noon.nc',
+                                   chunks={'time':-1, 'rlat':10, 'rlon': 10}).sel(time=slice(str(start_yr), str(end_yr))) 
+    return noon_sunrise.resample(time='1D').nearest() # fix times off by a couple seconds
 
-for real in [8,9,10]: # get number, only 3 have hourly data: [8,9,10] 
-       
-    start_yr, end_yr = 1971, 2000
-    import_years = range(start_yr, end_yr+1) # want to import all files that contain these years
-      
+def offsets(ens, real):
+    '''
+    Circular mean (by month) of the offsets of tmax from solar noon and tmin from sunrise for one realization, 
+    reading all years of hourly data at once.
+    '''
     # import hourly temperature data for specified realization
     # get filenames that contain desired timeframe (years in import_years) for realization
     flnms = []
-    for yr in import_years: 
-        flnms = flnms + glob.glob(f'{fwipaths.input_data}CanRCM4/NAM-44_CCCma-CanESM2_historical-r{ens}/1hr/atmos/tas/r{real}i2p1/*{yr}*nc') 
+    for yr in range(start_yr, end_yr+1): # want to import all files that contain these years
+        flnms = flnms + hourly_files(ens, real, yr)
     tas = xr.open_mfdataset(np.unique(flnms), preprocess=mask_add_ens, # geog_mask_ens_dims used to assign ens+real as a dimension and clip to Canada domain
                             chunks={'time':-1, 'rlat':10, 'rlon': 10}).sel(time=slice(str(start_yr), str(end_yr))) 
     tas = tas.resample(time='1H').nearest() # fix times off by a couple seconds
     
-    # time of sunrise and noon in UTC, generated in utc_sunrise_noon.py
-    noon_sunrise = xr.open_dataset(f'{fwipaths.working_data}CanRCM4_utc_sunrise_solar_noon.nc',
-                                   chunks={'time':-1, 'rlat':10, 'rlon': 10}).sel(time=slice(str(start_yr), str(end_yr))) 
-    noon_sunrise = noon_sunrise.resample(time='1D').nearest() # fix times off by a couple seconds
+    noon_sunrise = open_noon_sunrise()
     
-    # find timing of maximum temperature, typically after noontime 
-    hmax = tas['tas'].resample(time='24H').map(hourmax) # find timing (index) of max temp in every 24 hr period, indexed from 0 to 23 in UTC (timezone of tas)
+    # find timing (index) of max and min temp in every 24 hr period in a single pass, indexed from 0 to 23 in UTC (timezone of tas)
+    hmax, hmin = hourmax_hourmin(tas['tas'])
+    
+    # find offset of maximum temperature from solar noon, typically after noontime 
     hmax_offset = hmax - noon_sunrise['solar_noon_utc'] # get offset of hmax from solar noon  
     
     hmax_offset_out = get_circmean(hmax_offset.chunk({'time':-1, 'rlat':10, 'rlon': 10}),
@@ -130,29 +173,58 @@ for real in [8,9,10]: # get number, only 3 have hourly data: [8,9,10]
     in noontime temperature estimates. The following determination of tmin offsets is used for testing only.
     ''' 
    
-    del([hmax, hmax_offset])
-    gc.collect()
-    
     # find offset of minimum temperature from sunrise, typically after sunrise
-    hmin =  tas.tas.resample(time='24H').map(hourmin) # find timing (index) of min temp in every 24 hr period, indexed from 0 to 23 in UTC midnight (timezone of tas)
     hmin_offset = hmin - noon_sunrise['sunrise_utc'] # get offset of hmax from solar noon 
     hmin_offset_out = get_circmean(hmin_offset.chunk({'time':-1, 'rlat':10, 'rlon': 10}),
                                    'minimum',
                                    'sunrise')
-    
-    del([tas, hmin, hmin_offset])
-    gc.collect()
-    
-    # add script attrs, save
-    t_out = xr.merge([hmax_offset_out, hmin_offset_out])
-    t_out.attrs['git_id'] = tracking_id
-    t_out.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/'
-    t_out.attrs['history'] = f"Generated by {os.path.basename(sys.argv[0])}"  # get script name from run file
-    encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 4} for var in t_out.data_vars} # save as float32 and compress to save space
-    if not os.path.exists(f'{fwipaths.working_data}offsets_tmin_tmax/'):
-        os.makedirs(f'{fwipaths.working_data}offsets_tmin_tmax/')
-    t_out.to_netcdf(f'{fwipaths.working_data}offsets_tmin_tmax/offsets_tmin_tmax_month_{start_yr}_{end_yr}_r{ens}r{real}i2p1.nc')
-    
-    del([hmax_offset_out, hmin_offset_out, t_out])
-    gc.collect() # free up space
-                     
+    return xr.merge([hmax_offset_out, hmin_offset_out])
+
+def offsets_streamed(ens, real):
+    '''
+    As offsets(), but reads hourly data one year at a time. Daily offsets for each year are added to running 
+    circular mean sums (see CircularMeanAccumulator in config_noon.py), so memory use does not grow with the number of years.
+    '''
+    noon_sunrise = open_noon_sunrise()
+    hmax_mean = CircularMeanAccumulator(high=24, low=0, group='month')
+    hmin_mean = CircularMeanAccumulator(high=24, low=0, group='month')
+    for yr in range(start_yr, end_yr+1): 
+        tas = xr.open_mfdataset(np.unique(hourly_files(ens, real, yr)), preprocess=mask_add_ens, 
+                                chunks={'time':-1, 'rlat':10, 'rlon': 10}).sel(time=str(yr)) # one year of hourly data
+        tas = tas.resample(time='1H').nearest() # fix times off by a couple seconds
+        hmax, hmin = hourmax_hourmin(tas['tas']) # timing (index) of max and min temp, single pass
+        noon_sunrise_yr = noon_sunrise.sel(time=str(yr))
+        hmax_mean.add(hmax - noon_sunrise_yr['solar_noon_utc'], dim='time') # offsets from solar noon and sunrise, see offsets() for details
+        hmin_mean.add(hmin - noon_sunrise_yr['sunrise_utc'], dim='time')
+        hmax_mean.sums, hmin_mean.sums = dask.compute(hmax_mean.sums, hmin_mean.sums) # compute both from one read of this year's data
+        tas.close()
+        del([tas, hmax, hmin])
+        gc.collect()
+    hmax_offset_out = add_circmean_attrs(hmax_mean.result().astype('float64'), 'maximum', 'solar noon')
+    hmin_offset_out = add_circmean_attrs(hmin_mean.result().astype('float64'), 'minimum', 'sunrise')
+    return xr.merge([hmax_offset_out, hmin_offset_out])
+
+# get ensemble group number from run file: [1,2,3,4,5], or 'all' to run all five ensemble groups in one job
+ens_groups = [1, 2, 3, 4, 5] if sys.argv[1] == 'all' else [sys.argv[1]] 
+# 'stream' to read hourly data one year at a time, with memory use independent of the number of years
+stream = len(sys.argv) > 2 and sys.argv[2] == 'stream'
+
+for ens in ens_groups:
+    for real in [8,9,10]: # get number, only 3 have hourly data: [8,9,10] 
+        
+        if stream: 
+            t_out = offsets_streamed(ens, real)
+        else:
+            t_out = offsets(ens, real)
+        
+        # add script attrs, save
+        t_out.attrs['git_id'] = tracking_id
+        t_out.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/'
+        t_out.attrs['history'] = f"Generated by {os.path.basename(sys.argv[0])}"  # get script name from run file
+        encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 4} for var in t_out.data_vars} # save as float32 and compress to save space
+        if not os.path.exists(f'{fwipaths.working_data}offsets_tmin_tmax/'):
+            os.makedirs(f'{fwipaths.working_data}offsets_tmin_tmax/')
+        t_out.to_netcdf(f'{fwipaths.working_data}offsets_tmin_tmax/offsets_tmin_tmax_month_{start_yr}_{end_yr}_r{ens}r{real}i2p1.nc')
+        
+        del([t_out])
+        gc.collect() # free up space
@@ -0,0 +1,317 @@
+'''
+Run the CanLEAD-FWI workflow as a dependency graph, instead of running each script in order from job files:
+noontime estimates -> daily FWI -> annual metrics -> 30-year means (RCP8.5) and GWL translation (constructed RCPs)
+-> ensemble statistics -> intraensemble std -> robustness -> masking.
+
+Each node runs one script with the same arguments as its job file. Independent nodes (e.g. ensemble groups) run in
+parallel. Only stale nodes are run: a node is stale if any output is missing, if an input (outputs of upstream nodes,
+source data read by the script, and the script) is newer than its outputs ('mtime') or has changed since the last
+successful run ('hash'), or if an upstream node is run. Hashes and run times are kept in a json manifest in working_data.
+
+Run as: python run_pipeline.py EWEMBI [--dry-run] [--jobs 4] [--check mtime] [--targets robustness*] [--force]
+'''
+
+import argparse
+import datetime
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from filepaths import fwipaths
+from config_stats import masked_files
+
+repo = os.path.dirname(os.path.abspath(__file__))
+ens_groups = [1, 2, 3, 4, 5]
+rcps = ['RCP85', 'constructed_RCP26', 'constructed_RCP45']
+test_statistics = ['fire_season_length',
+                   'MJJAS_quantile_fillna',
+                   'annual_quantile',
+                   'exceedances_high',
+                   'exceedances_very_high',
+                   'exceedances_extreme',
+                   'MJJAS_mean_fillna',
+                   'exceedances_1971_2000_MJJASp95_fillna'
+                   ]
+
+class Node:
+    '''
+    One step of the workflow.
+
+    Parameters
+    ----------
+    name : String
+        Unique name, e.g. 'annual_metrics_r1'.
+    script : String
+        Script path, relative to the repository.
+    args : list
+        Arguments of the script, as in job files.
+    outputs : list
+        Glob patterns of output files. Each pattern must match at least one file for the node to be complete.
+    deps : list, optional
+        Names of upstream nodes, whose outputs are inputs of this node. The default is [].
+    inputs : list, optional
+        Glob patterns of other input files (not made by the workflow). The default is [].
+    after : list, optional
+        Names of nodes to run before this node, whose outputs are not inputs of this node. The default is [].
+    '''
+    def __init__(self, name, script, args, outputs, deps=[], inputs=[], after=[]):
+        self.name = name
+        self.script = script
+        self.args = [str(arg) for arg in args]
+        self.outputs = outputs
+        self.deps = deps
+        self.inputs = inputs
+        self.after = after
+
+    def command(self):
+        return [sys.executable, os.path.join(repo, self.script)] + self.args
+
+def build_graph(data_version):
+    '''
+    Nodes of the workflow for one CanLEAD version ('EWEMBI' or 'S14FD'), keyed by name.
+    '''
+    version = f'CanLEAD-FWI-{data_version}-v1'
+    summary = f'{fwipaths.output_data}{version}/summary_stats/'
+    # source data read by the scripts (not made by the workflow), inputs of the nodes that read them
+    canrcm4 = f'{fwipaths.input_data}CanRCM4/NAM-44_CCCma-CanESM2_historical-r'
+    canlead = f'{fwipaths.input_data}CanLEAD/CanRCM4-{data_version}-MBCn/'
+    canlead_grid = f'{fwipaths.input_data}CanLEAD/CanRCM4-S14FD-MBCn/r1_r1i1p1/prAdjust*.nc' # sample file for the CanLEAD grid
+    final_mask = f'{fwipaths.input_data}CanLEAD_FWI_final_mask.nc'
+    nodes = [Node('utc_sunrise_noon', 'noontime_estimates/utc_sunrise_noon.py', [],
+                  [f'{fwipaths.working_data}CanRCM4_utc_sunrise_solar_noon.nc', f'{fwipaths.working_data}CanLEAD_utc_sunrise_solar_noon.nc'],
+                  inputs=[f'{canrcm4}1/day/atmos/tas/r1i1p1/*.nc', canlead_grid])]
+    for g in ens_groups:
+        nodes.append(Node(f'diurnal_estimates_r{g}', 'noontime_estimates/diurnal_estimates.py', [g],
+                          [f'{fwipaths.working_data}offsets_tmin_tmax/offsets_tmin_tmax_month_1971_2000_r{g}r*i2p1.nc'],
+                          deps=['utc_sunrise_noon'],
+                          inputs=[f'{canrcm4}{g}/1hr/atmos/tas/r*i2p1/*.nc'])) # hourly temperature
+    nodes.append(Node('regrid_diurnal_estimates', 'noontime_estimates/regrid_diurnal_estimates.py', [],
+                      [f'{fwipaths.working_data}CanLEAD_offsets_tmin_tmax_month_1971_2000_all_realization_circmean.nc'],
+                      deps=[f'diurnal_estimates_r{g}' for g in ens_groups],
+                      inputs=[f'{canrcm4}1/fx/atmos/{var}/r1i1p1/{var}_*.nc' for var in ['sftlf', 'sftgif']] + [canlead_grid]))
+    for g in ens_groups:
+        nodes.append(Node(f'calculate_noon_rh_t_r{g}', 'noontime_estimates/calculate_noon_rh_t.py', [g, data_version],
+                          [f'{fwipaths.working_data}noontime/r{g}_*_1950_2100_{data_version}.nc'],
+                          deps=['utc_sunrise_noon', 'regrid_diurnal_estimates'],
+                          inputs=[f'{canlead}r{g}_*/{var}*.nc' for var in ['tasmaxAdjust', 'tasminAdjust', 'hursAdjust']]))
+        nodes.append(Node(f'calculate_gridded_fwi_r{g}', 'calculate_gridded_fwi.py', [g, data_version],
+                          [f'{fwipaths.output_data}{version}/r{g}_r*_{version}.nc'],
+                          deps=[f'calculate_noon_rh_t_r{g}'],
+                          inputs=[f'{canlead}r{g}_*/{var}*.nc' for var in ['tasmaxAdjust', 'sfcWindAdjust', 'prAdjust']] + [final_mask]))
+        nodes.append(Node(f'annual_metrics_r{g}', 'metrics/annual_metrics.py', [data_version, g],
+                          [f'{summary}RCP85/{test_stat}/r{g}_*_rcp85_{version}_{test_stat}.nc' for test_stat in test_statistics],
+                          deps=[f'calculate_gridded_fwi_r{g}'],
+                          inputs=[final_mask]))
+    annual = [f'annual_metrics_r{g}' for g in ens_groups]
+    nodes.append(Node('RCP85_climo_means', 'metrics/RCP85_climo_means.py', [data_version],
+                      [f'{summary}RCP85/{test_stat}/*_rcp85_{version}_{test_stat}_30yr_mean.nc' for test_stat in test_statistics],
+                      deps=annual,
+                      inputs=[final_mask]))
+    nodes.append(Node('gwl_translation', 'metrics/gwl_translation_constructed_scenarios.py', [data_version] + test_statistics,
+                      [f'{summary}constructed_{rcp.upper()}/{test_stat}/*_{rcp}_{version}_{test_stat}_30yr_mean.nc' 
+                       for test_stat in test_statistics for rcp in ['rcp26', 'rcp45']],
+                      deps=annual, # all metrics in one run, source windows are found once
+                      inputs=[f'{fwipaths.input_data}CanLEAD/tasAnom_PI_Ayr_CanESM2_historical-rcp85_185001-210012.csv', 
+                              f'{fwipaths.working_data}GWL/*_annual_mean_GSAT_area_weighted_mon.csv', final_mask]))
+    for rcp in rcps:
+        nodes.append(Node(f'ensemble_statistics_{rcp}', 'metrics/ensemble_statistics_all_rcps.py', [data_version, rcp],
+                          [f'{summary}{rcp}/ensemble_percentiles/*_{rcp}_30yr_mean_ensemble_percentiles.nc'],
+                          deps=['RCP85_climo_means'] if rcp == 'RCP85' else ['gwl_translation'],
+                          inputs=([f'{fwipaths.working_data}GWL/warming_levels_by_period_all_RCPs.csv'] if rcp == 'RCP85' else []) + [final_mask]))
+    nodes.append(Node('ensemble_std', 'metrics/ensemble_std.py', [data_version],
+                      [f'{summary}intraensemble_std_1971_2000/*_ensemble_std_1971_2000.nc'],
+                      deps=['RCP85_climo_means'],
+                      inputs=[final_mask]))
+    nodes.append(Node('robustness', 'metrics/robustness.py', [data_version],
+                      [f'{summary}{rcp}/ensemble_percentiles/robustness/*_{rcp}_30yr_mean_robustness.nc' for rcp in rcps],
+                      deps=['ensemble_std'] + [f'ensemble_statistics_{rcp}' for rcp in rcps],
+                      inputs=[final_mask]))
+    nodes.append(Node('stats_for_obs_comp', 'metrics/stats_for_obs_comp.py', [data_version],
+                      [f'{summary}1981_2014_ensemble_percentiles/*_1981_2014_mean_ensemble_percentiles.nc'],
+                      deps=annual))
+    for rcp in rcps if data_version == 'EWEMBI' else []: # masking of files in no_mask folders, see apply_mask_attrs.py (EWEMBI only)
+        fls = masked_files(summary, rcp) # no_mask files are not made by the workflow, outputs are the masked file of each
+        if fls:
+            nodes.append(Node(f'apply_mask_attrs_{rcp}', 'metrics/apply_mask_attrs.py', [rcp],
+                              [glob.escape(fl) for fl in fls.values()],
+                              inputs=[glob.escape(fl) for fl in fls] + [final_mask],
+                              after=['robustness']))
+    graph = {node.name: node for node in nodes}
+    for node in nodes: # check graph is complete
+        for dep in node.deps + node.after:
+            assert dep in graph, f'Unknown dependency of {node.name}: {dep}'
+    return graph
+
+def topological_order(graph):
+    # nodes ordered so that each node comes after its upstream nodes
+    order, visited = [], set()
+    def visit(name, path=()):
+        if name in path:
+            raise ValueError(f'Cycle in workflow: {" -> ".join(path + (name,))}')
+        if name in visited:
+            return
+        for dep in graph[name].deps + graph[name].after:
+            visit(dep, path + (name,))
+        visited.add(name)
+        order.append(name)
+    for name in graph:
+        visit(name)
+    return order
+
+def select(graph, targets):
+    # target nodes (names or glob patterns, e.g. 'annual_metrics_*') and all their upstream nodes
+    selected = set()
+    def add(name):
+        if name not in selected:
+            selected.add(name)
+            for dep in graph[name].deps:
+                add(dep)
+    for target in targets:
+        matches = fnmatch.filter(graph, target)
+        if not matches:
+            raise ValueError(f'No node matches target {target}')
+        for name in matches:
+            add(name)
+    return selected
+
+def files(patterns):
+    return sorted(set(fl for pattern in patterns for fl in glob.glob(pattern)))
+
+def node_inputs(node, graph):
+    # input files of a node: outputs of upstream nodes, other inputs, and the script itself
+    return files([pattern for dep in node.deps for pattern in graph[dep].outputs] + node.inputs) + [os.path.join(repo, node.script)]
+
+def file_hash(fl, block=2**20):
+    h = hashlib.sha1()
+    with open(fl, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def input_hashes(node, graph):
+    return {fl: file_hash(fl) for fl in node_inputs(node, graph)}
+
+def stale_reason(node, graph, manifest, check):
+    '''
+    Reason a node needs to run, or None if up to date (not accounting for upstream nodes).
+    '''
+    missing = [pattern for pattern in node.outputs if not glob.glob(pattern)]
+    if missing:
+        return f'missing outputs {missing[0]}' + (f' (+{len(missing)-1})' if len(missing) > 1 else '')
+    if check == 'hash':
+        if node.name not in manifest:
+            return 'no record of previous run'
+        changed = [fl for fl, h in input_hashes(node, graph).items() if manifest[node.name]['inputs'].get(fl) != h]
+        if changed:
+            return f'changed input {changed[0]}' + (f' (+{len(changed)-1})' if len(changed) > 1 else '')
+    else:
+        newest = max(node_inputs(node, graph), key=os.path.getmtime)
+        if os.path.getmtime(newest) > min(os.path.getmtime(fl) for fl in files(node.outputs)):
+            return f'newer input {newest}'
+    return None
+
+def plan(graph, selected, manifest, check, force):
+    '''
+    Nodes to run, in topological order, with the reason each is stale. A node is stale if stale itself, or if an
+    upstream node is run. With force, all selected nodes are run.
+    '''
+    reasons = {}
+    for name in topological_order(graph):
+        if name not in selected:
+            continue
+        node = graph[name]
+        upstream = [dep for dep in node.deps if dep in reasons]
+        if force:
+            reasons[name] = 'forced'
+        elif upstream:
+            reasons[name] = f'upstream {upstream[0]} is run'
+        else:
+            reason = stale_reason(node, graph, manifest, check)
+            if reason is not None:
+                reasons[name] = reason
+    return reasons
+
+def run_node(node, logdir):
+    # run one script, with the repository on the path for config modules, and log output
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    with open(f'{logdir}{node.name}.log', 'w') as log:
+        log.write(' '.join(node.command()) + '\n')
+        log.flush()
+        return subprocess.run(node.command(), cwd=repo, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+
+def run(graph, reasons, manifest, manifest_fl, logdir, jobs):
+    '''
+    Run stale nodes over a pool of jobs threads (each runs a script in its own process), starting each node once
+    its upstream nodes are done. Nodes downstream of a failed node are skipped.
+    '''
+    pending = set(reasons)
+    done, failed, skipped = set(), set(), set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            for name in sorted(pending):
+                deps = [dep for dep in graph[name].deps + graph[name].after if dep in reasons]
+                if any(dep in failed or dep in skipped for dep in deps):
+                    pending.remove(name)
+                    skipped.add(name)
+                    print(f'skip  {name} (upstream failed)')
+                elif all(dep in done for dep in deps) and len(running) < jobs:
+                    pending.remove(name)
+                    running[pool.submit(run_node, graph[name], logdir)] = name
+                    print(f'start {name}: {reasons[name]}')
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                returncode = future.result()
+                if returncode == 0:
+                    done.add(name)
+                    manifest[name] = dict(finished=datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"),
+                                          command=' '.join(graph[name].args),
+                                          inputs=input_hashes(graph[name], graph))
+                    with open(manifest_fl, 'w') as f: # record after each node, so that completed nodes are kept if the run stops
+                        json.dump(manifest, f, indent=1)
+                    print(f'done  {name}')
+                else:
+                    failed.add(name)
+                    print(f'FAIL  {name} (exit code {returncode}, see {logdir}{name}.log)')
+    return done, failed, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the CanLEAD-FWI workflow, re-running only stale steps.')
+    parser.add_argument('version', help="CanLEAD version, 'EWEMBI' or 'S14FD'")
+    parser.add_argument('--dry-run', action='store_true', help='print the plan without running')
+    parser.add_argument('--jobs', type=int, default=1, help='number of nodes to run at once')
+    parser.add_argument('--check', choices=['mtime', 'hash'], default='mtime', help='compare inputs by modification time or by content hash')
+    parser.add_argument('--targets', nargs='+', default=['*'], help='nodes to bring up to date (names or glob patterns), with their upstream nodes')
+    parser.add_argument('--force', action='store_true', help='run all selected nodes, even if up to date')
+    options = parser.parse_args()
+
+    graph = build_graph(options.version)
+    manifest_fl = f'{fwipaths.working_data}pipeline_manifest_{options.version}.json'
+    manifest = json.load(open(manifest_fl)) if os.path.exists(manifest_fl) else {}
+    selected = select(graph, options.targets)
+    reasons = plan(graph, selected, manifest, options.check, options.force)
+
+    if options.dry_run:
+        for name in topological_order(graph):
+            if name in selected:
+                status = f'RUN   ({reasons[name]})' if name in reasons else 'ok'
+                print(f'{name:45s} {status}')
+                if name in reasons:
+                    print(f'      {" ".join(graph[name].command())}')
+        print(f'{len(reasons)} of {len(selected)} nodes to run')
+        sys.exit(0)
+
+    logdir = f'{fwipaths.working_data}pipeline_logs/{options.version}/'
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    done, failed, skipped = run(graph, reasons, manifest, manifest_fl, logdir, options.jobs)
+    print(f'{len(done)} done, {len(failed)} failed, {len(skipped)} skipped')
+    if failed:
+        sys.exit(1)
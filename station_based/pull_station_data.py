@@ -1,17 +1,29 @@
 ''' 
 Script to generate individual station netcdf datasets of weather station CFFWIS observations as well as projected CFFWIS outputs from 
 CanLEAD-FWI. Run for each station which meets the quality checks specified in the function read_station_data (see read_obs_data.py)
+The nearest model cell of each station is found once, and stations are read from each realization in batches of nearby 
+stations, each read as one block of cells that fits within a memory budget (see station_cells.py).
+
+Run as: python pull_station_data.py provider version [max_memory] [store]
+    max_memory: optional, memory budget in GB for the model data of one batch of stations (default 2)
+    store: optional, save all stations of the provider in one obs file and one model file with a 'station' dim (see station_store.py)
 '''
 
 import os
 import sys
 import glob
+import gc
 import xarray as xr
 sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/')) 
 from read_obs_data import read_station_data 
+from station_store import to_station_store, store_path
+from station_cells import nearest_cells, station_batches, extract_stations
 from filepaths import fwipaths
 
 provider_name = sys.argv[1] # code indicating provincial, territorial or national data source
+options = sys.argv[3:]
+store = 'store' in options # optional, save all stations of the provider in one file with a 'station' dim (see station_store.py)
+memory = [float(opt) for opt in options if opt != 'store'] # optional, memory budget (GB) for the model data of one batch of stations, all realizations
 
 ## Load and save station observational data. 
 
@@ -31,8 +43,12 @@ encoding_obs = {var:  {'dtype': 'float32',
                       '_FillValue': 1e+20 # missing value depreciated, not added
                       } for var in station_dataset[kn]['obs_data'].data_vars}  
                                         
-for s in station_dataset.keys(): 
-    station_dataset[s]['obs_data'].to_netcdf(f'{obs_out_path}/{s}_{provider_name}_obs_data.nc', encoding=encoding_obs) # save 
+if store: # all stations in one file
+    obs_store = to_station_store({s: station_dataset[s]['obs_data'] for s in station_dataset.keys()})
+    obs_store.to_netcdf(store_path(obs_out_path, provider_name), encoding=encoding_obs) # save 
+else:
+    for s in station_dataset.keys(): 
+        station_dataset[s]['obs_data'].to_netcdf(f'{obs_out_path}/{s}_{provider_name}_obs_data.nc', encoding=encoding_obs) # save 
 
 quality_checks['P_T'] = provider_name
 quality_checks.to_csv(f'{obs_out_path}/quality_report_{provider_name}.csv')
@@ -41,32 +57,23 @@ kurtosis_checks.to_csv(f'{obs_out_path}/kurtosis_report_{provider_name}.csv')
 ## Load and save CanLEAD pointwise data
 
 version = f'CanLEAD-FWI-{sys.argv[2]}-v1' # set version
-CanLEAD_FWI_input_data = glob.glob(f'{fwipaths.output_data}/{version}/*.nc') # get all realizations
+max_memory = memory[0] * 1e9 if memory else 2e9
+CanLEAD_FWI_input_data = sorted(glob.glob(f'{fwipaths.output_data}/{version}/*.nc')) # get all realizations, in order of realization
 
-# Loop over CanLEAD realizations and accumulate pointwise data
-for r in CanLEAD_FWI_input_data:
-    r_name=os.path.basename(r)[:10] # get realization ID from file name
-    
-    mod_ds = xr.open_dataset(r)
-    mod_ds = mod_ds.assign_coords(realization=r_name).expand_dims('realization') # add realization as dimension
-    
-    for s in station_dataset.keys(): # loop over observation-based locations, and load nearest model data
-        station_dataset[s]['model_data'][r_name] = mod_ds.sel(lat=station_dataset[s]['obs_data']['lat'],
-                                                              lon=station_dataset[s]['obs_data']['lon'],
-                                                              method='nearest').drop_vars('time_bnds') # drop time bands, we don't want to index by realization in merge
-    
-    time_bounds = mod_ds.squeeze().time_bnds # pull time_bnds before close
+with xr.open_dataset(CanLEAD_FWI_input_data[0]) as mod_ds:
+    time_bounds = mod_ds.time_bnds.load() # pull time_bnds, the same for all realizations
     time_units, time_cal = mod_ds.time.encoding['units'], mod_ds.time.encoding['calendar'] # pull some encoding
-    mod_ds.close()
-
-## Concatenate collected data for each station location, along new 'realization' dimension
+    data_vars = [var for var in mod_ds.data_vars if var != 'time_bnds']
+    cell_size = sum(mod_ds[var].dtype.itemsize for var in data_vars) * mod_ds.sizes['time'] # bytes of model data per cell, one realization
+    ilat, ilon = nearest_cells(mod_ds, [station_dataset[s]['obs_data']['lat'].values[0] for s in station_dataset.keys()], 
+                               [station_dataset[s]['obs_data']['lon'].values[0] for s in station_dataset.keys()])
 
 # to save space, set encoding as float32, zlib compress
 encoding_mod = {var: {'dtype': 'float32',
                       'zlib': True, # compress outputs
                       'complevel': 3, # 1 to 9, where 1 is fastest, and 9 is maximum compression
                       '_FillValue': 1e+20 # missing value depreciated, not added
-                      } for var in station_dataset[kn]['model_data'][r_name].data_vars} 
+                      } for var in data_vars} 
 del(encoding_mod['fire_season_mask']) # drop encoding for fire_season_mask, want to keep as original dtype (bool) to save space
 # add encoding for lat, lon, time
 for var in ['lat','lon','time','time_bnds']:
@@ -87,15 +94,37 @@ realization_attrs = dict(standard_name = 'realization',
                          long_name = 'Ensemble member',
                          units = '')  
 
-# for each station: merge, add time_bnds, add realization attrs, and save
-for s in station_dataset.keys():    
-    # merge all realizations. keep all attrs, except drop conflicts (e.g., realization name)
-    station_dataset[s]['model_data'] = xr.merge(station_dataset[s]['model_data'].values(), 
-                                                combine_attrs='drop_conflicts') 
-    # re-add time_bnds
-    station_dataset[s]['model_data']['time_bnds'] = time_bounds
-    # set realization coordinate attrs
-    station_dataset[s]['model_data']['realization'].attrs = realization_attrs
-    # save
-    station_dataset[s]['model_data'].to_netcdf(f'{model_out_path}/{s}_{provider_name}_{version}_model_data.nc', encoding=encoding_mod)
+## Extract all stations from each realization, in batches of nearby stations that fit within max_memory
+# (block of cells read from one realization, and data of the batch for all realizations)
 
+stations = list(station_dataset.keys())
+batches = station_batches(ilat, ilon, cell_size, cell_size * len(CanLEAD_FWI_input_data), max_memory)
+for i, batch in enumerate(batches):
+    batch_stations = [stations[j] for j in batch]
+    cube = extract_stations(CanLEAD_FWI_input_data, ilat[batch], ilon[batch], batch_stations)
+    
+    # for each station: add time_bnds, add realization attrs, and save
+    model_data = {}
+    for s in batch_stations:
+        model_data[s] = cube.sel(station=s).drop_vars('station')
+        model_data[s] = model_data[s].expand_dims(lat=[model_data[s].lat.values], lon=[model_data[s].lon.values], axis=[2, 3]) # lat and lon as dims, as in obs data
+        # re-add time_bnds
+        model_data[s]['time_bnds'] = time_bounds
+        # set realization coordinate attrs
+        model_data[s]['realization'].attrs = realization_attrs
+        # save
+        if not store:
+            model_data[s].to_netcdf(f'{model_out_path}/{s}_{provider_name}_{version}_model_data.nc', encoding=encoding_mod)
+    if store: # stations of the batch in one file, combined below
+        to_station_store(model_data).to_netcdf(f'{store_path(model_out_path, provider_name, version)}.{i}', encoding=encoding_mod)
+    
+    del([cube, model_data])
+    gc.collect()
+
+if store: # combine batches along 'station' into one file
+    batch_files = [f'{store_path(model_out_path, provider_name, version)}.{i}' for i in range(len(batches))]
+    with xr.open_mfdataset(batch_files, combine='nested', concat_dim='station', data_vars='minimal', coords='minimal', compat='override') as model_store:
+        model_store = model_store.sel(station=[str(s) for s in stations]) # stations in the same order as the obs store
+        model_store.to_netcdf(store_path(model_out_path, provider_name, version), encoding=encoding_mod)
+    for fl in batch_files:
+        os.remove(fl)
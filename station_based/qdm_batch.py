@@ -0,0 +1,180 @@
+'''
+Batched quantile delta mapping (QDM), for many series at once (e.g. all FWI System components and realizations of a station).
+Numpy version of the QDM steps of run_qdm.py, which call xclim for each series: jitter and logit transform (FFMC), training
+(sdba.QuantileDeltaMapping.train with group='time'), adjustment in 30-year moving windows (construct_moving_yearly_window,
+QM.adjust with linear interpolation and constant extrapolation, unpack_moving_yearly_window with append_ends=True).
+Series are rows of 2D arrays (series, time), and results match those of xclim to floating point rounding.
+'''
+
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/'))
+from config_stats import partition_quantile
+
+def jitter(x, lower=0.25, upper=100.75, minimum=0, maximum=101):
+    '''
+    Replace values of x under lower and over (or equal to) upper by uniform random noise, as xclim.sdba.processing.jitter.
+    Noise is drawn with np.random, for the whole of x, as in xclim, so that calls in the same order as per-series calls
+    of xclim jitter (with the same seed) give the same values.
+    '''
+    out = x.copy()
+    notnull = ~np.isnan(x)
+    noise = np.random.uniform(low=minimum + np.finfo(x.dtype).eps, high=lower, size=x.shape).astype(x.dtype)
+    out = np.where((x < lower) & notnull, noise, out)
+    noise = np.random.uniform(low=upper, high=maximum, size=x.shape).astype(x.dtype)
+    out = np.where((x >= upper) & notnull, noise, out)
+    return out
+
+def to_logit(x, lower=0, upper=101):
+    # transform to additive space, as xclim.sdba.processing.to_additive_space with trans='logit'
+    x_prime = (x - lower) / (upper - lower)
+    return np.log(x_prime / (1 - x_prime))
+
+def from_logit(y, lower=0, upper=101):
+    # back-transform from additive space, as xclim.sdba.processing.from_additive_space with trans='logit'
+    x_prime = 1 / (1 + np.exp(-y))
+    return x_prime * (upper - lower) + lower
+
+def qdm_train(obs, hist, quantiles, kind):
+    '''
+    Adjustment factors of each series, between quantiles of obs and hist (NaNs are skipped), as
+    sdba.QuantileDeltaMapping.train(obs, hist, nquantiles=quantiles, group='time', kind=kind).
+
+    Parameters
+    ----------
+    obs : numpy array
+        Target data, (series, time).
+    hist : numpy array
+        Training data, (series, time).
+    quantiles : array
+        Quantiles for which adjustment factors are found.
+    kind : String or array
+        '+' (additive) or '*' (multiplicative), for all series or for each series.
+
+    Returns
+    -------
+    af : numpy array
+        Adjustment factors, (series, quantiles).
+    hist_q : numpy array
+        Quantiles of hist, (series, quantiles).
+    quantiles : numpy array
+        Quantiles, in the dtype of obs (as in xclim).
+    '''
+    quantiles = np.asarray(quantiles).astype(obs.dtype)
+    ref_q = partition_quantile(obs, quantiles).astype(obs.dtype)
+    hist_q = partition_quantile(hist, quantiles).astype(hist.dtype)
+    additive = (np.asarray(kind) == '+')[..., np.newaxis] if np.ndim(kind) else kind == '+'
+    with np.errstate(divide='ignore', invalid='ignore'): # as xclim, hist quantiles of 0 give inf or NaN
+        af = np.where(additive, ref_q - hist_q, ref_q / hist_q)
+    return af, hist_q, quantiles
+
+def rank_pct(x):
+    '''
+    Percentage ranks along the last axis, from 0 to 1, as xclim.sdba.utils.rank(pct=True): ties get the average of their
+    ranks (as xarray rank), then ranks are rescaled so that the smallest is 0 and the largest is 1. NaNs stay NaN.
+    '''
+    order = np.argsort(x, axis=-1, kind='stable') # NaNs sorted to the end
+    return _rank_sorted(np.take_along_axis(x, order, axis=-1), order)
+
+def _rank_sorted(xs, order):
+    # percentage ranks (see rank_pct) of values xs sorted along the last axis, returned to their positions before sorting (order)
+    n = xs.shape[-1]
+    idx = np.broadcast_to(np.arange(n), xs.shape)
+    start = np.ones(xs.shape, dtype=bool) # first position of each group of ties
+    start[..., 1:] = xs[..., 1:] != xs[..., :-1]
+    end = np.ones(xs.shape, dtype=bool) # last position of each group of ties
+    end[..., :-1] = start[..., 1:]
+    first = np.maximum.accumulate(np.where(start, idx, 0), axis=-1)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(end, idx, n), axis=-1), axis=-1), axis=-1)
+    count = np.sum(~np.isnan(xs), axis=-1, keepdims=True)
+    ranks = np.where(np.isnan(xs), np.nan, (first + last) / 2 + 1) / count # average ranks, as a fraction of valid values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mn = np.nanmin(ranks, axis=-1, keepdims=True)
+        mx = np.nanmax(ranks, axis=-1, keepdims=True)
+        ranks = mx * (ranks - mn) / (mx - mn)
+    out = np.empty(xs.shape)
+    np.put_along_axis(out, order, ranks, axis=-1)
+    return out
+
+def interp_quantiles(newx, xq, yq):
+    '''
+    Linear interpolation of yq (series, quantiles) at newx (series, time), with constant extrapolation (first and last
+    non-NaN yq), as xclim.sdba.utils.interp_on_quantiles (scipy interp1d, per series). NaNs in xq or yq are removed,
+    NaNs in newx stay NaN. Output dtype is that of yq.
+    '''
+    out = np.full(newx.shape, np.nan, dtype=yq.dtype)
+    valid = ~(np.isnan(yq) | np.isnan(xq))
+    full = valid.all(axis=-1)
+    if full.any(): # series without NaN adjustment factors, all at once
+        xs, ys, x = xq[full] if xq.ndim > 1 else xq, yq[full], newx[full]
+        if xs.ndim == 1:
+            i = np.clip(np.searchsorted(xs, x, side='left'), 1, len(xs) - 1)
+            x_lo, x_hi = xs[i - 1], xs[i]
+        else:
+            i = np.clip(np.stack([np.searchsorted(a, b, side='left') for a, b in zip(xs, x)]), 1, xs.shape[-1] - 1)
+            x_lo, x_hi = np.take_along_axis(xs, i - 1, axis=-1), np.take_along_axis(xs, i, axis=-1)
+        y_lo, y_hi = np.take_along_axis(ys, i - 1, axis=-1), np.take_along_axis(ys, i, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = (y_hi - y_lo) / (x_hi - x_lo) * (x - x_lo) + y_lo # as interp1d, linear
+        x_min, x_max = (xs[..., :1], xs[..., -1:]) if xs.ndim > 1 else (xs[0], xs[-1])
+        y = np.where(x < x_min, ys[:, :1], y)
+        y = np.where(x > x_max, ys[:, -1:], y)
+        out[full] = np.where(np.isnan(x), np.nan, y)
+    for k in np.flatnonzero(~full & valid.any(axis=-1)): # series with some NaN adjustment factors, one at a time
+        xs = (xq[k] if xq.ndim > 1 else xq)[valid[k]]
+        out[k] = interp_quantiles(newx[k:k + 1], xs, yq[k:k + 1, valid[k]])[0]
+    return out # series with all NaN adjustment factors stay NaN, as in xclim
+
+def qdm_adjust(sim, quantiles, af, kind):
+    '''
+    Adjust each series of sim (series, time) with its adjustment factors (series, quantiles), at the quantile (rank)
+    of each value in the series, as QM.adjust(sim, extrapolation='constant', interp='linear') of a QDM object.
+    '''
+    sim_q = rank_pct(sim)
+    factor = interp_quantiles(sim_q, quantiles, af)
+    additive = (np.asarray(kind) == '+')[..., np.newaxis] if np.ndim(kind) else kind == '+'
+    return np.where(additive, sim + factor, sim * factor)
+
+def moving_windows(n_time, n_in_year, window=30, step=10):
+    # first time index of each full moving window, as construct_moving_yearly_window (partial windows are left out)
+    return np.arange(0, n_time - window * n_in_year + 1, step * n_in_year)
+
+def rank_pct_moving(sim, n_in_year=365, window=30, step=10):
+    '''
+    Percentage ranks (as rank_pct) of each value of sim (series, time) within the moving window in which it is kept (see
+    qdm_adjust_moving). Windows overlap, so each series is sorted once, and the sorted values of each window are taken 
+    from the sorted series (values of the window, in sorted order), instead of sorting each window. Ranks are the same 
+    as those of rank_pct on each window.
+    '''
+    starts = moving_windows(sim.shape[-1], n_in_year, window, step)
+    N = window * n_in_year
+    left = (window - step) // 2 * n_in_year
+    n_out = starts[-1] + N
+    rows = sim.reshape(-1, sim.shape[-1])[:, :n_out]
+    order = np.argsort(rows, axis=-1) # NaNs sorted to the end, order of ties does not change ranks
+    xs = np.take_along_axis(rows, order, axis=-1)
+
+    out = np.full(rows.shape, np.nan)
+    for w, start in enumerate(starts):
+        in_window = (order >= start) & (order < start + N) # N values in each series, still sorted
+        ranks = _rank_sorted(xs[in_window].reshape(-1, N), order[in_window].reshape(-1, N) - start)
+        keep_from = 0 if w == 0 else left # front end from first window
+        keep_to = N if w == len(starts) - 1 else left + step * n_in_year # back end from last window
+        out[:, start + keep_from:start + keep_to] = ranks[:, keep_from:keep_to]
+    return out.reshape(sim.shape[:-1] + (n_out,))
+
+def qdm_adjust_moving(sim, quantiles, af, kind, n_in_year=365, window=30, step=10):
+    '''
+    Adjust sim (series, time) in moving windows of 'window' years, every 'step' years, keeping the central 'step' years
+    of each window, and the first and last years from the first and last windows. As construct_moving_yearly_window,
+    QM.adjust and unpack_moving_yearly_window(append_ends=True) in run_qdm.py. Time steps after the last full window
+    are left out, so the output has (last window start + window) time steps.
+    Ranks of all windows are found from one sort of each series (rank_pct_moving), and adjustment factors are 
+    interpolated once for all time steps.
+    '''
+    sim_q = rank_pct_moving(sim, n_in_year, window, step)
+    factor = interp_quantiles(sim_q.reshape(-1, sim_q.shape[-1]), quantiles, af.reshape(-1, af.shape[-1])).reshape(sim_q.shape)
+    additive = (np.asarray(kind) == '+')[..., np.newaxis] if np.ndim(kind) else kind == '+'
+    sim = sim[..., :sim_q.shape[-1]]
+    return np.where(additive, sim + factor, sim * factor)
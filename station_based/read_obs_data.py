@@ -1,8 +1,188 @@
 '''
 Custom function to read observational CFFWIS station data in from csv, pre-process, and write to netcdf (with attributes) 
 on a per-station basis if quality checks are passed. Run within 'pull_station_data.py'.                                                                                   
+Raw csv files of each provider are converted once to a Parquet cache (partitioned by year), which is read on later runs,
+and rebuilt if any source file or the csv read options change. If pyarrow is not installed, csv files are read directly.
 '''
 
+def read_csv_files(files, reader, workers=None):
+    '''
+    Read csv files (e.g. one per decade) in parallel with threads, and concatenate in the order of files. bz2 decompression 
+    and csv parsing release the GIL, so that files are decompressed in parallel.
+    '''
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+    
+    with ThreadPoolExecutor(max_workers=workers or len(files)) as pool:
+        frames = list(pool.map(reader, files))
+    return pd.concat(frames).reset_index(drop=True)
+
+def source_state(files):
+    # size and modification time of each source file, to check if the cache is still valid
+    import os
+    return {os.path.abspath(f): [os.path.getsize(f), os.path.getmtime(f)] for f in sorted(files)}
+
+def read_cached_station_data(provider_name, files, read_options, date_column, cache_path):
+    '''
+    Read raw station data of one provider from a Parquet cache, partitioned by year. The cache is made from the raw csv files 
+    on the first run, and rebuilt when any source file is added, removed or changed (size or modification time), or when 
+    the csv read options change. Rows are returned in the same order and with the same values as read from the csv files. 
+    Falls back to reading the csv files if pyarrow is not installed, or if the data can't be converted (e.g. columns of 
+    mixed types).
+
+    Parameters
+    ----------
+    provider_name : String
+        Province or 'NAT' for national, used as cache folder name.
+    files : list
+        Raw csv files of the provider.
+    read_options : dict
+        Keyword arguments of pd.read_csv for each file (json serializable, e.g. dtype={'aes': 'str'}), kept in the 
+        manifest of the cache.
+    date_column : String
+        Column with dates (starting with the year), used to partition the cache by year.
+    cache_path : String
+        Folder of the cache, e.g. f'{fwipaths.working_data}station_cache/'.
+
+    Returns
+    -------
+    stn_data : pandas dataframe
+        Raw station data, with index reset.
+    '''
+    import os
+    import json
+    import shutil
+    import numpy as np
+    import pandas as pd
+    try:
+        import pyarrow # noqa: F401, needed for parquet
+    except ImportError:
+        pyarrow = None
+    
+    reader = lambda f: pd.read_csv(f, **read_options) # bz2 files are decompressed by read_csv (compression inferred from name)
+    
+    if pyarrow is None: # no cache
+        return read_csv_files(files, reader)
+    
+    cache = os.path.join(cache_path, provider_name)
+    manifest = os.path.join(cache, '_manifest.json') # files starting with '_' are not read as data
+    state = {'files': source_state(files), 'read_options': read_options} # cache is rebuilt if either changes
+    valid = False
+    if os.path.exists(manifest):
+        with open(manifest) as fl:
+            valid = json.load(fl) == state
+    
+    if not valid: # convert raw csv files to parquet, partitioned by year
+        stn_data = read_csv_files(files, reader)
+        cached = stn_data.assign(cache_row=np.arange(len(stn_data)), # to keep row order
+                                 cache_year=stn_data[date_column].astype(str).str[:4])
+        tmp = cache + '_tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            cached.to_parquet(tmp, partition_cols=['cache_year'], index=False)
+        except (TypeError, ValueError, pyarrow.lib.ArrowException) as err: # e.g. object columns of mixed types
+            print(f'Station data of {provider_name} not cached: {err}')
+            shutil.rmtree(tmp, ignore_errors=True)
+            return stn_data
+        with open(os.path.join(tmp, '_manifest.json'), 'w') as fl:
+            json.dump(state, fl)
+        shutil.rmtree(cache, ignore_errors=True)
+        os.replace(tmp, cache) # manifest is only in place once the cache is complete
+        return stn_data
+    
+    stn_data = pd.read_parquet(cache)
+    stn_data = stn_data.sort_values('cache_row').drop(columns=[col for col in ['cache_row', 'cache_year'] if col in stn_data.columns])
+    for col in stn_data.columns[stn_data.dtypes == object]: # missing strings are read as None, use NaN as in read_csv
+        stn_data[col] = stn_data[col].where(stn_data[col].notna(), np.nan)
+    return stn_data.reset_index(drop=True)
+
+def quality_control(stn_data, stn_list, coverage=0.80, min_length=20, month_start=5, month_end=9):
+    '''
+    Quality checks of all stations at once, as grouped operations over the whole station dataframe: removal of duplicates, 
+    removal of years with insufficient fire season data, kurtosis (to flag outliers) and the minimum length test. Only stations 
+    in the metadata list with more than one record are checked. See read_station_data for parameters.
+
+    Returns
+    -------
+    quality_checks : pandas dataframe
+        Duplicates dropped, years dropped, whether quality criteria are passed and number of years of good data, by station.
+    kurtosis_checks : pandas dataframe
+        Kurtosis of each FWI System component, by station.
+    passed : dict
+        For stations that pass the quality criteria (in order of stn_list), the remaining station data (dataframe) and 
+        the count of FWI values in each year with data (series indexed by year).
+    '''
+    import numpy as np
+    import pandas as pd
+    from scipy import stats
+    from datetime import date
+    
+    components = ['FFMC', 'DMC', 'DC', 'BUI', 'ISI', 'FWI', 'DSR']
+    name = stn_data.index.name
+    n_records = stn_data.index.value_counts()
+    stations = stn_list.index[stn_list.index.isin(n_records.index[n_records > 1])].unique() # in order of station metadata list, with more than one record
+    
+    ########## Check for and remove duplicates ##########
+    
+    data = stn_data[stn_data.index.isin(stations)].drop('index', axis=1).reset_index() # station as a column, so that duplicates are found by station
+    data = data.drop_duplicates(keep='first') # first, if duplicates are identical, keep only one
+    osize = data.groupby(name, sort=False).size().reindex(stations, fill_value=0)
+    # then, find and remove duplicate dates with values that differ, and note these in error report
+    data = data.drop_duplicates(subset=[name, 'date'], keep=False) 
+    dropped_duplicates = osize - data.groupby(name, sort=False).size().reindex(stations, fill_value=0) # count records dropped
+    
+    ########## Remove years with insufficient fire season data ########## 
+    
+    year_count = data.groupby([name, 'year']).size() # days in whole year - not just fire season - with data
+    summer_count = data[data.month.isin(range(month_start, month_end + 1))].groupby([name, 'year']).size().reindex(year_count.index) # days in fire season with data, NaN if none
+    fire_season_days = (date(2023, month_end + 1, 1) - date(2023, month_start, 1)).days # find days in fire season period using 2023 as representative year (NB: 153 in MJJAS)
+    # drop years with less than defined fire season coverage, and years with no fire season data (otherwise we could accidentally keep years with no summer data but with winter data)
+    no_fs = summer_count.isna()
+    to_drop = (summer_count < int(fire_season_days*coverage)) | no_fs
+    yrs_to_drop = year_count.index.to_frame(index=False)[to_drop.values].assign(no_fs=no_fs[to_drop].values)
+    yrs_to_drop = yrs_to_drop.sort_values('no_fs', kind='stable') # years with insufficient coverage first, then years with no fire season data, by year
+    empty = np.array([], dtype=data['year'].dtype)
+    yrs_to_drop = {s: yrs['year'].values for s, yrs in yrs_to_drop.groupby(name, sort=False)}
+    
+    data = data[~to_drop.reindex(pd.MultiIndex.from_frame(data[[name, 'year']])).values] # drop all data from these years
+    data = data.set_index(name)
+    kurtosis_checks = data.groupby(level=name, sort=False)[components].apply(lambda obs: pd.Series(stats.kurtosis(obs, axis=0, nan_policy='omit'), # kurtosis for testing for outliers
+                                                                                                     index=components))
+    kurtosis_checks = kurtosis_checks.reindex(stations).astype('float64').rename_axis(None) # NaN for stations with no data left
+    
+    ########## Count number of years, if at least min_length of years, then station is retained ##########
+    
+    dyr = data.groupby([name, 'year'])['FWI'].count() # count values in years, see how many years of data we have
+    years_good_data = dyr.groupby(level=name).size().reindex(stations, fill_value=0)
+    passes = years_good_data >= min_length
+    
+    quality_checks = pd.DataFrame({'number_dropped_duplicates': [n if n != 0 else np.nan for n in dropped_duplicates.tolist()],
+                                   'years_dropped_insufficient_fire_season_data': np.nan,
+                                   'pass_quality_criteria': np.where(passes, 'yes', 'no'),
+                                   'years_good_data': years_good_data.tolist(),
+                                   'land_area_fraction': np.nan}, 
+                                  index=pd.Index(stations.tolist()), dtype=object)
+    for s in stations: # record years dropped for records, one station at a time, so that arrays are stored as in the report
+        quality_checks.loc[s, 'years_dropped_insufficient_fire_season_data'] = yrs_to_drop.get(s, empty)
+    
+    groups = dict(list(data[data.index.isin(stations[passes.values])].groupby(level=name, sort=False)))
+    passed = {s: (groups[s], dyr.xs(s, level=name)) for s in stations[passes.values]}
+    return quality_checks, kurtosis_checks, passed
+
+def passed_stations(obs_path):
+    '''
+    Stations that pass the quality criteria, from the quality reports of all providers saved by pull_station_data.py 
+    (quality_report_*.csv in obs_path), with station ID ('stn_id') and provider ('P_T'). Reports are read in order of 
+    file name, so that the row of each station is the same in all runs (e.g. in run_qdm.py and run_stations.py).
+    '''
+    import glob
+    import pandas as pd
+    
+    all_stations = pd.concat([pd.read_csv(fl, index_col=0).reset_index() for fl in sorted(glob.glob(f'{obs_path}/quality_report_*.csv'))])
+    all_stations.rename(columns={'index': 'stn_id'}, inplace=True)
+    all_stations = all_stations[all_stations.pass_quality_criteria == 'yes']
+    return all_stations.reset_index(drop=True)
+
 def read_station_data(provider_name, coverage=0.80, min_length=20, month_start=5, month_end=9, run_script=None):
     '''
     Function to read in station data, clean it up (check for duplicates, minimum data length and quality).
@@ -34,7 +214,6 @@ def read_station_data(provider_name, coverage=0.80, min_length=20, month_start=5
     import pandas as pd
     import xarray as xr
     import os
-    import bz2
     import glob
     import nested_dict as nd
     import numpy as np
@@ -45,6 +224,7 @@ def read_station_data(provider_name, coverage=0.80, min_length=20, month_start=5
     import sys
     sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/')) 
     from filepaths import stnpaths, fwipaths
+    cache_path = fwipaths.working_data + 'station_cache/' # Parquet cache of raw station data, see read_cached_station_data
             
     station_dataset = nd.nested_dict() # initialize a dictionary to store all data
     
@@ -63,15 +243,15 @@ def read_station_data(provider_name, coverage=0.80, min_length=20, month_start=5
                               pd.read_csv(os.path.join(station_input_data_prefix,'cwfis_allstn2017.csv')),
                               pd.read_csv(os.path.join(station_input_data_prefix,'cwfis_allstn2019.csv'))
                               ]).drop_duplicates(subset='aes', keep='first')
-        stn_data = pd.concat([
-                              pd.read_csv(bz2.BZ2File(os.path.join(station_input_data_prefix,'cwfis_fwi1950sv3.0.csv.bz2'), 'r'),          dtype={'aes': str}),
-                              pd.read_csv(bz2.BZ2File(os.path.join(station_input_data_prefix,'cwfis_fwi1960sv3.0.csv.bz2'), 'r'),          dtype={'aes': str}),
-                              pd.read_csv(bz2.BZ2File(os.path.join(station_input_data_prefix,'cwfis_fwi1970sv3.0.csv.bz2'), 'r'),          dtype={'aes': str}),
-                              pd.read_csv(bz2.BZ2File(os.path.join(station_input_data_prefix,'cwfis_fwi1980sv3.0.csv.bz2'), 'r'),          dtype={'aes': str}),
-                              pd.read_csv(bz2.BZ2File(os.path.join(station_input_data_prefix,'cwfis_fwi1990sv3.0.csv.bz2'), 'r'),          dtype={'aes': str}),
-                              pd.read_csv(bz2.BZ2File(os.path.join(station_input_data_prefix,'cwfis_fwi2000sv3.0opEC_2015.csv.bz2'), 'r'), dtype={'aes': str}),
-                              pd.read_csv(bz2.BZ2File(os.path.join(station_input_data_prefix,'cwfis_fwi2010sopEC.csv.bz2'), 'r'),          dtype={'aes': str})
-                              ]).reset_index(drop=True)
+        decade_files = [os.path.join(station_input_data_prefix, fl) for fl in ['cwfis_fwi1950sv3.0.csv.bz2', 
+                                                                              'cwfis_fwi1960sv3.0.csv.bz2', 
+                                                                              'cwfis_fwi1970sv3.0.csv.bz2',
+                                                                              'cwfis_fwi1980sv3.0.csv.bz2',
+                                                                              'cwfis_fwi1990sv3.0.csv.bz2',
+                                                                              'cwfis_fwi2000sv3.0opEC_2015.csv.bz2',
+                                                                              'cwfis_fwi2010sopEC.csv.bz2']]
+        # decades are decompressed in parallel on the first run, then read from the cache
+        stn_data = read_cached_station_data('NAT', decade_files, dict(dtype={'aes': 'str'}), 'rep_date', cache_path)
         stn_data=stn_data.dropna(axis=0,how='any',subset=['ffmc', 'dmc', 'dc', 'bui', 'isi', 'fwi']) #drop any records that don't have FWI info
         stn_data=stn_data.reset_index(drop=True)
         
@@ -109,7 +289,9 @@ def read_station_data(provider_name, coverage=0.80, min_length=20, month_start=5
             station_input_data_prefix  = stnpaths.yk 
         
             stn_list = pd.read_csv(station_input_data_prefix + 'yukon-stations.csv')
-            stn_data = pd.read_csv(station_input_data_prefix + 'yukon-daily-indices.csv', na_values="-1.#I").reset_index(drop=True) # interpret error code '-1.#I' as NaNs
+            stn_data = read_cached_station_data('YK', [station_input_data_prefix + 'yukon-daily-indices.csv'], 
+                                                dict(na_values="-1.#I"), # interpret error code '-1.#I' as NaNs
+                                                'DateObs', cache_path)
                    
             # rename for consistency with provincial obs names
             stn_data.rename(columns={'Name': 'station_name', 
@@ -143,10 +325,12 @@ def read_station_data(provider_name, coverage=0.80, min_length=20, month_start=5
             if provider_name=='QC': # for QC, change province name from uppercase and use special encoding to read special characters
                 stn_list = pd.read_csv(f[0], encoding='iso-8859-1', encoding_errors='replace')
                 provider_name='Qc'
-                stn_data = pd.concat([pd.read_csv(f, encoding='iso-8859-1', encoding_errors='replace') for f in glob.glob(os.path.join(station_input_data_prefix,provider_name+'*Daily*.csv'))]).reset_index(drop=True)
+                read_options = dict(encoding='iso-8859-1', encoding_errors='replace')
             else:
                 stn_list = pd.read_csv(f[0])
-                stn_data = pd.concat([pd.read_csv(f) for f in glob.glob(os.path.join(station_input_data_prefix,provider_name+'*Daily*.csv'))]).reset_index(drop=True)
+                read_options = {}
+            stn_data = read_cached_station_data(provider_name, glob.glob(os.path.join(station_input_data_prefix,provider_name+'*Daily*.csv')), 
+                                                read_options, 'weather_date', cache_path)
                 
             stn_data['date'] = pd.to_datetime(stn_data['weather_date'], format='%Y%m%d') # Convert weather_date to datetime object 
             stn_data.rename(columns={'relative_humidity': 'rh',
@@ -180,116 +364,72 @@ def read_station_data(provider_name, coverage=0.80, min_length=20, month_start=5
             stn_list=stn_list.set_index('station_code')
             stn_data=stn_data.set_index('station_code')    
                        
-    quality_checks = pd.DataFrame(columns=['number_dropped_duplicates', 'years_dropped_insufficient_fire_season_data',
-                                           'pass_quality_criteria', 'years_good_data', 'land_area_fraction']) # initiate quality tracking dataframe for records 
-    kurtosis_checks = pd.DataFrame(columns=['FFMC', 'DMC', 'DC', 'BUI', 'ISI', 'FWI', 'DSR']) # initiate kurtosis tracking dataframe to flag for outliers 
+    # duplicates, fire season coverage, minimum length and kurtosis checks for all stations at once, see quality_control
+    quality_checks, kurtosis_checks, passed = quality_control(stn_data, stn_list, coverage, min_length, month_start, month_end)
             
-    for s in stn_list.index: # this only evaluates stations that exist in station metadata list
-        if s in stn_data.index: # that also have data
-            
-            obs_data=stn_data.loc[s] # get data for this station
-            
-            if len(obs_data.shape) > 1: # if data has more than one record
-            
-                ########## Check for and remove duplicates ##########
-                
-                # first, if duplicates are identical, keep only one
-                obs_data = obs_data.drop('index', axis=1).drop_duplicates(keep='first') # keeps first duplicate. this line also drops the column index
-                osize = obs_data.shape # get size of dataframe, to record if non-identifical duplicates dropped in next step
-                
-                # then, find and remove duplicate dates with values that differ, and note these in error report
-                obs_data = obs_data.drop_duplicates(subset='date', keep=False) # consider only the 'date' column in dropping duplicates, keep=False to keep no duplicates
-                if osize[0] != obs_data.shape[0]: # if size of dataframe not the same before/after drop performed (aka, any data was dropped), note this
-                    quality_checks.loc[s, 'number_dropped_duplicates'] = osize[0] - obs_data.shape[0] # count records dropped and record in error report 
-                
-                ########## Remove years with insufficient fire season data ########## 
-                
-                # where fire season month_start and month_end are defined in function
-                data_summer_count = obs_data[obs_data.month.isin(range(month_start, month_end + 1))].groupby('year').count() # subset data to fire season, groupby year, and count days in fire season with data (will not count NaNs) 
-                data_year_count=obs_data.groupby('year').count() # count days in whole year - not just fire season - with data (will not count NaNs)
-                
-                # drop years with less than defined fire season coverage
-                fire_season_days = (date(2023, month_end + 1, 1) - date(2023, month_start, 1)).days # find days in fire season period using 2023 as representative year (NB: 153 in MJJAS)
-                yrs_insufficient_fs = data_summer_count[data_summer_count['date']<int(fire_season_days*coverage)].index # list of years that have less than required fire season coverage [coverage requirement is added as an attribute to output file]
-                yrs_no_fs = data_year_count[~data_year_count.index.isin(data_summer_count.index)].index # years with no fire season data (aka year in data_year_count, but not in data_summer_count). Otherwise we could accidentally keep years with no summer data but with winter data 
-                yrs_to_drop = np.append(yrs_insufficient_fs, yrs_no_fs)  
-                
-                obs_data = obs_data[~obs_data.year.isin(yrs_to_drop)] # drop all data from these years 
-                quality_checks.loc[s, 'years_dropped_insufficient_fire_season_data'] = yrs_to_drop # record years dropped for records
-                kurtosis_checks.loc[s] = stats.kurtosis(obs_data[['FFMC', 'DMC', 'DC', 'BUI', 'ISI', 'FWI', 'DSR']], # kurtosis for testing for outliers
-                                                        axis=0, nan_policy='omit')
-                
-                ########## Count number of years, if at least min_length of years, then perform conversion to xarray dataset ##########
-                    
-                dyr = obs_data.groupby('year')['FWI'].count() # count values in years, see how many years of data we have
-                if len(dyr) >= min_length: #If there is at least a certain span of data, convert to xr dataset and add to station_dataset dictionary
-                    quality_checks.loc[s, 'pass_quality_criteria'] = 'yes'
-                    quality_checks.loc[s, 'years_good_data'] = len(dyr)
-                    
-                    ########## Re-index dataframe with full year calendars ##########
-                    
-                    out = obs_data.set_index('date').sort_index() # set index from station_name to date, and sort by date
-                    obs_yrs, obs_yre = out.index[0].year, out.index[-1].year
-                    idx = pd.date_range(f'01-01-{obs_yrs}', f'12-31-{obs_yre}') # range potential range for obs data 
-                    if provider_name in ['NAT', 'YK']: # NAT, YK have different date format, must specify it here so joining by date won't break dataframe
-                        idx = pd.date_range(f'01-01-{obs_yrs} 12:00', f'12-31-{obs_yre} 12:00')
-                    out = out.reindex(idx, fill_value=np.NaN) # re-index dataframe with idx. This will fill missing values (aka no data for that date) with NaNs
-                    out = out[~((idx.month == 2) & (idx.day == 29))] # remove leap days from data. when doing bias correction, we need equal calendars, and model data is 365 day year format
-                    out.index = xr.cftime_range(f'{obs_yrs}-01-01 12:00', f'{obs_yre}-12-31 12:00', freq='D', calendar='noleap', name='time')
-                    
-                    ########## convert dataframe to xarray dataset ##########
-                    
-                    if provider_name == 'NAT': # for NAT, retain following columns and convert to xarray
-                        outxr = out[['temp', 'rh', 'ws', 'precip', 'calcstatus',
-                                     'FFMC', 'DMC', 'DC', 'ISI', 'BUI', 'FWI', 'DSR']].to_xarray()
-                    else: # for all others, keep following columns and convert to xarray. differences due to lack of 'calcstatus' for prov data
-                        outxr = out[['temp', 'rh', 'ws', 'precip', 
-                                     'FFMC', 'DMC', 'DC', 'ISI', 'BUI', 'FWI', 'DSR']].to_xarray()
-                        
-                    ########## add attributes to dataset ##########
-                    
-                    if provider_name == 'NAT':  # for NAT, add following from stn_list to ds attributes 
-                        for atr in ['wmo', 'id', 'station_name', 'instr', 'longitude', 
-                                    'latitude', 'elevation', 'P_T', 'tz_correct', 'agency']:
-                            try: outxr.attrs[atr] = stn_list.loc[s, atr].strip() # formatting func strip() will fail for non-strings, so 'try-except' is needed
-                            except AttributeError: outxr.attrs[atr] = stn_list.loc[s, atr] 
-                        outxr.attrs['aes'] = s # 's' originally called 'aes', so re-set to this in attrs
-                        outxr.attrs['description'] = 'Observational CFFWIS system inputs and outputs for national CWFIS stations.'
-                        outxr.attrs['data_source'] = 'https://cwfis.cfs.nrcan.gc.ca/downloads/fwi_obs/' # origin of data
-                    else:  # for PROV/TER, need following attrs
-                        for atr in ['station_name', 'P_T', 'owner', 'longitude', 'latitude', 'elevation', 'comments']:
-                            try: outxr.attrs[atr] = stn_list.loc[s, atr] # 'Comments' only present for YK
-                            except KeyError: pass 
-                        outxr.attrs['description'] = f'Observational CFFWIS system inputs and outputs for {provider_name} stations.' 
-                        outxr.attrs['data_source'] = 'Pacific Forestry Centre, NRCan for all regions except Yukon, where station data was provided by the Government of Yukon, Wildland Fire Management branch.' # origin of data 
-                    
-                    outxr.attrs['station_code'] = s # for NWT, YK and SK: no station code, so station_code = station_name. Duplicate of AES for NAT, but added for consistency w provincial data    
-                    if 'station_name' not in outxr.attrs:
-                        outxr.attrs['station_name'] = s
-                                                                          
-                    outxr.attrs['history'] = f'Generated by {run_script}'
-                    outxr.attrs['years_with_obs_data'] = dyr.index.values # years wtih obs data will be useful to know later, when doing bias adjustment
-                    outxr.attrs['completeness_checks'] = f'Data retained for years with >= {coverage*100}% data coverage during the fire season, here defined as the start of month {month_start} to the end of month {month_end}.'\
-                                                        +f' Duplicate dates and invalid values removed if present. Only stations with >= {min_length} years of acceptable data retained.'
-                    outxr.attrs['git_id'] = tracking_id 
-                    outxr.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/commit/'
-                    
-                    # add lat and lon as dataset dims (in addition to being file attrs) 
-                    outxr = outxr.assign_coords(lon=outxr.attrs['longitude']).expand_dims('lon')
-                    outxr = outxr.assign_coords(lat=outxr.attrs['latitude']).expand_dims('lat')
-                                  
-                    ## some final quality checks ## 
-                    for dv in ['ws', 'precip', 'DMC', 'DC', 'ISI', 'BUI', 'FWI', 'DSR']:
-                        outxr[dv] = xr.where((outxr[dv] >= 0), outxr[dv], np.nan)
-                    outxr['rh'] = xr.where((outxr['rh'] >= 0) & (outxr['rh'] <= 100), outxr['rh'], np.nan)
-                    outxr['FFMC'] = xr.where((outxr['FFMC'] >= 0) & (outxr['FFMC'] <= 101), outxr['FFMC'], np.nan) # only ffmc is not open-ended
-                    # no checks for temp
-                    
-                    # add dataset to output dictionary
-                    station_dataset[s]['obs_data'] = outxr
-                else:
-                    quality_checks.loc[s, 'pass_quality_criteria'] = 'no'
-                    quality_checks.loc[s, 'years_good_data'] = len(dyr)
+    for s, (obs_data, dyr) in passed.items(): # stations that pass quality criteria, in order of station metadata list
+        
+        ########## Re-index dataframe with full year calendars ##########
+
+        out = obs_data.set_index('date').sort_index() # set index from station_name to date, and sort by date
+        obs_yrs, obs_yre = out.index[0].year, out.index[-1].year
+        idx = pd.date_range(f'01-01-{obs_yrs}', f'12-31-{obs_yre}') # range potential range for obs data 
+        if provider_name in ['NAT', 'YK']: # NAT, YK have different date format, must specify it here so joining by date won't break dataframe
+            idx = pd.date_range(f'01-01-{obs_yrs} 12:00', f'12-31-{obs_yre} 12:00')
+        out = out.reindex(idx, fill_value=np.NaN) # re-index dataframe with idx. This will fill missing values (aka no data for that date) with NaNs
+        out = out[~((idx.month == 2) & (idx.day == 29))] # remove leap days from data. when doing bias correction, we need equal calendars, and model data is 365 day year format
+        out.index = xr.cftime_range(f'{obs_yrs}-01-01 12:00', f'{obs_yre}-12-31 12:00', freq='D', calendar='noleap', name='time')
+
+        ########## convert dataframe to xarray dataset ##########
+
+        if provider_name == 'NAT': # for NAT, retain following columns and convert to xarray
+            outxr = out[['temp', 'rh', 'ws', 'precip', 'calcstatus',
+                         'FFMC', 'DMC', 'DC', 'ISI', 'BUI', 'FWI', 'DSR']].to_xarray()
+        else: # for all others, keep following columns and convert to xarray. differences due to lack of 'calcstatus' for prov data
+            outxr = out[['temp', 'rh', 'ws', 'precip', 
+                         'FFMC', 'DMC', 'DC', 'ISI', 'BUI', 'FWI', 'DSR']].to_xarray()
+
+        ########## add attributes to dataset ##########
+
+        if provider_name == 'NAT':  # for NAT, add following from stn_list to ds attributes 
+            for atr in ['wmo', 'id', 'station_name', 'instr', 'longitude', 
+                        'latitude', 'elevation', 'P_T', 'tz_correct', 'agency']:
+                try: outxr.attrs[atr] = stn_list.loc[s, atr].strip() # formatting func strip() will fail for non-strings, so 'try-except' is needed
+                except AttributeError: outxr.attrs[atr] = stn_list.loc[s, atr] 
+            outxr.attrs['aes'] = s # 's' originally called 'aes', so re-set to this in attrs
+            outxr.attrs['description'] = 'Observational CFFWIS system inputs and outputs for national CWFIS stations.'
+            outxr.attrs['data_source'] = 'https://cwfis.cfs.nrcan.gc.ca/downloads/fwi_obs/' # origin of data
+        else:  # for PROV/TER, need following attrs
+            for atr in ['station_name', 'P_T', 'owner', 'longitude', 'latitude', 'elevation', 'comments']:
+                try: outxr.attrs[atr] = stn_list.loc[s, atr] # 'Comments' only present for YK
+                except KeyError: pass 
+            outxr.attrs['description'] = f'Observational CFFWIS system inputs and outputs for {provider_name} stations.' 
+            outxr.attrs['data_source'] = 'Pacific Forestry Centre, NRCan for all regions except Yukon, where station data was provided by the Government of Yukon, Wildland Fire Management branch.' # origin of data 
+
+        outxr.attrs['station_code'] = s # for NWT, YK and SK: no station code, so station_code = station_name. Duplicate of AES for NAT, but added for consistency w provincial data    
+        if 'station_name' not in outxr.attrs:
+            outxr.attrs['station_name'] = s
+
+        outxr.attrs['history'] = f'Generated by {run_script}'
+        outxr.attrs['years_with_obs_data'] = dyr.index.values # years wtih obs data will be useful to know later, when doing bias adjustment
+        outxr.attrs['completeness_checks'] = f'Data retained for years with >= {coverage*100}% data coverage during the fire season, here defined as the start of month {month_start} to the end of month {month_end}.'\
+                                            +f' Duplicate dates and invalid values removed if present. Only stations with >= {min_length} years of acceptable data retained.'
+        outxr.attrs['git_id'] = tracking_id 
+        outxr.attrs['git_repo'] = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/commit/'
+
+        # add lat and lon as dataset dims (in addition to being file attrs) 
+        outxr = outxr.assign_coords(lon=outxr.attrs['longitude']).expand_dims('lon')
+        outxr = outxr.assign_coords(lat=outxr.attrs['latitude']).expand_dims('lat')
+
+        ## some final quality checks ## 
+        for dv in ['ws', 'precip', 'DMC', 'DC', 'ISI', 'BUI', 'FWI', 'DSR']:
+            outxr[dv] = xr.where((outxr[dv] >= 0), outxr[dv], np.nan)
+        outxr['rh'] = xr.where((outxr['rh'] >= 0) & (outxr['rh'] <= 100), outxr['rh'], np.nan)
+        outxr['FFMC'] = xr.where((outxr['FFMC'] >= 0) & (outxr['FFMC'] <= 101), outxr['FFMC'], np.nan) # only ffmc is not open-ended
+        # no checks for temp
+
+        # add dataset to output dictionary
+        station_dataset[s]['obs_data'] = outxr
                     
     print(f'\n Useable stations (land and water) in {provider_name}: {len(list(station_dataset.keys()))} of {len(total_stations_with_data)}')
     
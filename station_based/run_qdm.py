@@ -5,7 +5,6 @@
 
 import os
 import sys
-import glob
 import datetime
 import numpy as np
 import pandas as pd
@@ -16,6 +15,9 @@ from xclim.sdba import construct_moving_yearly_window, unpack_moving_yearly_wind
 from xclim.sdba.processing import to_additive_space, from_additive_space, jitter
 sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/')) 
 from filepaths import fwipaths
+from station_store import open_station, store_path
+from read_obs_data import passed_stations
+import qdm_batch
 import subprocess
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
 
@@ -125,6 +127,75 @@ def QM_routine(obs, hist, sim, qnts=None, realization=None, training_realization
     
     return out, count_non_nans, adf, out.attrs['history']
 
+def save_adjusted(s, provider_name, fwi_component, adjusted, factors_all, qdm_hist, data_obs, data_model, quantiles, 
+                  high_adj, yidx, obs_lat_lon, model_lat_lon):
+    '''
+    Save adjustment factors and QDM-adjusted data (with attrs) of one station and CFFWIS component, and record the 
+    highest adjustment factor. Used by apply_qm and apply_qm_batch. See apply_qm for parameters.
+    '''
+    (o_lat, o_lon), (m_lat, m_lon) = obs_lat_lon, model_lat_lon
+    
+    # save adjustment factors
+    factors_all.to_netcdf(f'{out_path}adj_factors_nans/{s}_{provider_name}_{fwi_component}_adjustment_factors.nc', encoding={'af': {'dtype': 'float32', 'zlib': True, 'complevel': 5},
+                                                                                                                             'hist_q': {'dtype': 'float32',  'zlib': True, 'complevel': 5}})  
+    # record high adjustment factor values
+    high_adj.loc[s, fwi_component] = factors_all.af.max().max().values
+
+    ### Add attrs, and save to netCDF ###
+
+    # define and add new attrs
+    attrs_to_add = dict(product = "station-based-fire-weather-projections",
+                        title = f'Canadian Forest Fire Weather Index System (CFFWIS) projections based on CanLEAD-CanRCM4-{sys.argv[3]}, '\
+                                +'bias-adjusted to station observations', 
+                        creation_date = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"),
+                        obs_lat_lon = (o_lat, o_lon), 
+                        model_lat_lon = (m_lat, m_lon),
+                        years_training_data = yidx,
+                        history = f'Generated by {sys.argv[0]}. All NaNs in observation and model datasets cross-masked '\
+                                  +'to avoid fire season start or end discrepancies. Quantile delta mapping (QDM) training '\
+                                  +'is completed with different ensemble member than adjustment. QDM history: '\
+                                  +f'{qdm_hist}. Quantiles: {quantiles}.', # xclim version is recorded already in 'qdm_hist'
+                        git_id = tracking_id,
+                        git_repo = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/',
+                        )
+    adjusted.attrs = attrs_to_add # add new attrs
+
+    # copy only desired attrs from input model data
+    mod_attrs_keep = ['Conventions', 'institute_id', 'institution', 'contact', 'frequency', 
+                      'data_licence', 'index_package_information', 'references', 'overwintering',
+                      'fire_season', 'project_id'] 
+    for attr_name in mod_attrs_keep:
+        adjusted.attrs[attr_name] = data_model.attrs[attr_name] 
+
+    # add desired attrs from input obs data, pre-pend 'obs'
+    for attr_name in ['description', 'data_source', 'station_name', 'station_code']:
+        adjusted.attrs['obs_' + attr_name] = data_obs.attrs[attr_name] 
+
+    # replace all variable-specifc attrs lost during QDM (including for lat, lon, time, CFFWIS component, time_bnds)
+    for var in adjusted.variables: 
+        adjusted[var].attrs = data_model[var].attrs 
+    adjusted[fwi_component].attrs['long_name'] = "Bias-Adjusted " + adjusted[fwi_component].attrs['long_name']  
+
+    # set encoding
+    encoding_mod = {fwi_component: {'dtype': 'float32',
+                                    'zlib': True, # compress outputs
+                                    'complevel': 3, # 1 to 9, where 1 is fastest, and 9 is maximum compression
+                                    '_FillValue': 1e+20 # missing value depreciated, not added
+                                    } }
+    # add encoding for lat, lon, time
+    for var in ['lat','lon','time','time_bnds']: 
+        encoding_mod[var] = {'dtype': 'float64',
+                             '_FillValue': None}  
+        if var in ['time', 'time_bnds']: 
+            encoding_mod[var]['units'] = data_model.time.encoding['units']
+            encoding_mod[var]['calendar'] = data_model.time.encoding['calendar']
+    encoding_mod['realization'] = {'dtype': 'S1'} # add string encoding for realization coord
+
+    # save QDM-adjusted model
+    adjusted.to_netcdf(f'{out_path}{s}_{provider_name}_{fwi_component}_{version}_QDM.nc', encoding=encoding_mod)
+    
+    return high_adj
+
 def apply_qm(s, provider_name, data_obs=None, data_model=None, quantiles=None, high_adj=None, fwi_components=None):
     '''
     Preprocess observational data and model output, then run quantile delta mapping (QDM) to bias adjust
@@ -214,86 +285,128 @@ def apply_qm(s, provider_name, data_obs=None, data_model=None, quantiles=None, h
                                                                                                                                                   
         nan_components[fwi_component] = count_non_nans.rename(fwi_component) # add count_non_nans to dictionary
         factors_all = xr.merge(adj_fact.values())    
-        # save adjustment factors
-        factors_all.to_netcdf(f'{out_path}adj_factors_nans/{s}_{provider_name}_{fwi_component}_adjustment_factors.nc', encoding={'af': {'dtype': 'float32', 'zlib': True, 'complevel': 5},
-                                                                                                                                 'hist_q': {'dtype': 'float32',  'zlib': True, 'complevel': 5}})  
-        # record high adjustment factor values
-        high_adj.loc[s, fwi_component] = factors_all.af.max().max().values
+        high_adj = save_adjusted(s, provider_name, fwi_component, adjusted, factors_all, qdm_hist, data_obs, data_model, 
+                                 quantiles, high_adj, yidx, (o_lat, o_lon), (m_lat, m_lon))
+               
+    # save count_non_nans after all fwi components are run
+    encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 5} for var in fwi_components} # to save space, encode as float32, zlib compress
+    xr.merge(nan_components.values()).to_netcdf(f'{out_path}adj_factors_nans/{s}_{provider_name}_count_nans.nc', encoding=encoding) 
+    
+    return high_adj # return high_adj df, will get fed back in for next station to record adj_factors
+
+def apply_qm_batch(s, provider_name, data_obs=None, data_model=None, quantiles=None, high_adj=None, fwi_components=None, step=10):
+    '''
+    Same as apply_qm, but QDM is run for all CFFWIS components and realizations of the station at once (see qdm_batch.py), 
+    instead of with one xclim call per component and realization. Inputs are prepared and outputs are saved as in apply_qm, 
+    and adjusted data and adjustment factors match those of apply_qm to floating point rounding. For FFMC, jitter noise is 
+    drawn in the same order as in apply_qm, so that results are the same for the same random seed.
+    See apply_qm for parameters.
+    '''
+    window = 30 # size (in years) of moving window, as in QM_routine
+    
+    ### Load and preprocess station and model data, for all CFFWIS components at once ### 
+    
+    years = data_obs.attrs['years_with_obs_data'] # use all years available for bias correction 
+    yidx = len(years) # length of training data
+    obs_yrs, obs_yre = int(years.min()), int(years.max())
+    o_lat, o_lon = data_obs.lat.values[0], data_obs.lon.values[0] # record station lat-lon
+    m_lat, m_lon = data_model.lat.values[0], data_model.lon.values[0]
+    
+    obs_data = data_obs[fwi_components].sel(time=slice(f'{obs_yrs}-01-01', f'{obs_yre}-12-31')).squeeze()
+    obs_data = obs_data.where(obs_data.time.dt.year.isin(years), drop=True) # drop all years with no data from index
+    mod_data = data_model[fwi_components].squeeze().drop(['lat', 'lon']) 
+    mod_ref = mod_data.sel(time=slice(f'{obs_yrs}-01-01', f'{obs_yre}-12-31')) # get training period data for model
+    mod_ref = mod_ref.where(mod_ref.time.dt.year.isin(years), drop=True) # drop all years with no OBS data from index
+    
+    reals = mod_ref.coords['realization'].values
+    match_reals = assign_matches(reals) # train with a different realization than the one adjusted
+    train = [list(reals).index(match_reals[r]) for r in reals]
+    
+    # count all non-nan data by day of year, for the training realization and obs (each realization trains one other)
+    mod_count = mod_ref.groupby('time.dayofyear').count()
+    obs_count = obs_data.groupby('time.dayofyear').count()
+    
+    # arrays of (component, realization, time)
+    obs = np.stack([obs_data[c].values for c in fwi_components])[:, np.newaxis, :]
+    hist = np.stack([mod_ref[c].transpose('realization', 'time').values for c in fwi_components])[:, train, :]
+    sim = np.stack([mod_data[c].transpose('realization', 'time').values for c in fwi_components])
+    
+    # mask out NaNs to prevent discrepancies due to systemic differences in season start and end dates 
+    hist = np.where(~np.isnan(obs), hist, np.nan).astype(hist.dtype) # mask out OBS NaNs
+    obs = np.where(~np.isnan(hist), obs, np.nan).astype(obs.dtype) # mask out CanLEAD NaNs, for each realization
+    
+    ffmc = [i for i, c in enumerate(fwi_components) if c == 'FFMC']
+    for i in ffmc: # for FFMC, jitter (in the order of QM_routine: sim, hist, obs for each realization) and logit transform
+        for k in range(len(reals)):
+            sim[i, k] = qdm_batch.jitter(sim[i, k])
+            hist[i, k] = qdm_batch.jitter(hist[i, k])
+            obs[i, k] = qdm_batch.jitter(obs[i, k])
+        sim[i], hist[i], obs[i] = qdm_batch.to_logit(sim[i]), qdm_batch.to_logit(hist[i]), qdm_batch.to_logit(obs[i])
+    kind = np.array([['+' if c == 'FFMC' else '*'] * len(reals) for c in fwi_components]).reshape(-1)
+    
+    ### Apply Quantile Delta Mapping (QDM) to all series at once ###
+    
+    nc, nr = len(fwi_components), len(reals)
+    af, hist_q, qnts = qdm_batch.qdm_train(obs.reshape(nc * nr, -1), hist.reshape(nc * nr, -1), quantiles, kind)
+    
+    sim_time = mod_data.time.sel(time=slice('1951','2100')) # start time in 1951, so that it ends in 2100 when using 30 year windows 
+    first = int(np.flatnonzero(mod_data.time.isin(sim_time))[0])
+    adjusted_all = qdm_batch.qdm_adjust_moving(sim.reshape(nc * nr, -1)[:, first:first + sim_time.size], qnts, af, kind, window=window, step=step)
+    adjusted_all = adjusted_all.reshape(nc, nr, -1)
+    for i in ffmc:
+        adjusted_all[i] = qdm_batch.from_logit(adjusted_all[i])
+    af, hist_q = af.reshape(nc, nr, -1), hist_q.reshape(nc, nr, -1)
+    
+    nan_components = {}
+    for i, fwi_component in enumerate(fwi_components):
+        kind_c = '+' if fwi_component == 'FFMC' else '*'
+        qdm_hist = f'Bias-adjusted with batched QDM (qdm_batch.py) equivalent to QuantileDeltaMapping(group=Grouper(name=\'time\'), '\
+                   +f'kind=\'{kind_c}\').adjust(sim, extrapolation=\'constant\', interp=\'linear\') in {window} year moving windows '\
+                   +f'with step {step}' + (', in logit space (jitter and to_additive_space, from_additive_space)' if kind_c == '+' else '')
+        adjusted = xr.DataArray(adjusted_all[i], dims=['realization', 'time'], name=fwi_component,
+                                coords={'realization': reals, 'time': sim_time.isel(time=slice(0, adjusted_all.shape[-1])).values}).to_dataset()
+        adjusted['time_bnds'] = data_model['time_bnds'] 
         
-        ### Add attrs, and save to netCDF ###
+        # adjustment factors, as in the 'ds' of xclim QDM objects
+        transform = {'sdba_transform': 'logit', 'sdba_transform_lower': 0.0, 'sdba_transform_upper': 101.0, 
+                     'sdba_transform_units': ''} if kind_c == '+' else {} # attrs of to_additive_space, for FFMC
+        factors_all = xr.Dataset({'af': (['realization', 'group', 'quantiles'], af[i][:, np.newaxis, :], 
+                                         {**transform, 'units': '', 'kind': kind_c, 'standard_name': 'Adjustment factors', 
+                                          'long_name': 'Quantile mapping adjustment factors'}),
+                                  'hist_q': (['realization', 'group', 'quantiles'], hist_q[i][:, np.newaxis, :],
+                                             {**transform, 'units': '', 'standard_name': 'Model quantiles', 
+                                              'long_name': 'Quantiles of model on the reference period'})},
+                                 coords={'quantiles': qnts, 'group': [1], 'realization': reals},
+                                 attrs={'group': 'time', 'group_compute_dims': ['time'], 'group_window': 1, 
+                                        'adj_params': f"QuantileDeltaMapping(group=Grouper(name='time'), kind='{kind_c}')"})
         
-        # define and add new attrs
-        attrs_to_add = dict(product = "station-based-fire-weather-projections",
-                            title = f'Canadian Forest Fire Weather Index System (CFFWIS) projections based on CanLEAD-CanRCM4-{sys.argv[3]}, '\
-                                    +'bias-adjusted to station observations', 
-                            creation_date = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"),
-                            obs_lat_lon = (o_lat, o_lon), 
-                            model_lat_lon = (m_lat, m_lon),
-                            years_training_data = yidx,
-                            history = f'Generated by {sys.argv[0]}. All NaNs in observation and model datasets cross-masked '\
-                                      +'to avoid fire season start or end discrepancies. Quantile delta mapping (QDM) training '\
-                                      +'is completed with different ensemble member than adjustment. QDM history: '\
-                                      +f'{qdm_hist}. Quantiles: {quantiles}.', # xclim version is recorded already in 'qdm_hist'
-                            git_id = tracking_id,
-                            git_repo = 'https://github.com/ECCC-CCCS/CanLEAD-FWI-v1/',
-                            )
-        adjusted.attrs = attrs_to_add # add new attrs
-                
-        # copy only desired attrs from input model data
-        mod_attrs_keep = ['Conventions', 'institute_id', 'institution', 'contact', 'frequency', 
-                          'data_licence', 'index_package_information', 'references', 'overwintering',
-                          'fire_season', 'project_id'] 
-        for attr_name in mod_attrs_keep:
-            adjusted.attrs[attr_name] = data_model.attrs[attr_name] 
-            
-        # add desired attrs from input obs data, pre-pend 'obs'
-        for attr_name in ['description', 'data_source', 'station_name', 'station_code']:
-            adjusted.attrs['obs_' + attr_name] = data_obs.attrs[attr_name] 
-                    
-        # replace all variable-specifc attrs lost during QDM (including for lat, lon, time, CFFWIS component, time_bnds)
-        for var in adjusted.variables: 
-            adjusted[var].attrs = data_model[var].attrs 
-        adjusted[fwi_component].attrs['long_name'] = "Bias-Adjusted " + adjusted[fwi_component].attrs['long_name']  
+        # count of all non-nan data used for adjustment, as in apply_qm
+        count_non_nans = xr.concat([mod_count[fwi_component], obs_count[fwi_component].assign_coords(realization='obs')], dim='realization')
+        count_non_nans = count_non_nans.reindex(dayofyear=range(1, 366), fill_value=-9999).transpose('realization', 'dayofyear')
+        nan_components[fwi_component] = count_non_nans.rename(fwi_component).drop_vars(['lat', 'lon'], errors='ignore')
         
-        # set encoding
-        encoding_mod = {fwi_component: {'dtype': 'float32',
-                                        'zlib': True, # compress outputs
-                                        'complevel': 3, # 1 to 9, where 1 is fastest, and 9 is maximum compression
-                                        '_FillValue': 1e+20 # missing value depreciated, not added
-                                        } }
-        # add encoding for lat, lon, time
-        for var in ['lat','lon','time','time_bnds']: 
-            encoding_mod[var] = {'dtype': 'float64',
-                                 '_FillValue': None}  
-            if var in ['time', 'time_bnds']: 
-                encoding_mod[var]['units'] = data_model.time.encoding['units']
-                encoding_mod[var]['calendar'] = data_model.time.encoding['calendar']
-        encoding_mod['realization'] = {'dtype': 'S1'} # add string encoding for realization coord
-                
-        # save QDM-adjusted model
-        adjusted.to_netcdf(f'{out_path}{s}_{provider_name}_{fwi_component}_{version}_QDM.nc', encoding=encoding_mod)
-               
+        high_adj = save_adjusted(s, provider_name, fwi_component, adjusted, factors_all, qdm_hist, data_obs, data_model, 
+                                 quantiles, high_adj, yidx, (o_lat, o_lon), (m_lat, m_lon))
+    
     # save count_non_nans after all fwi components are run
     encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 5} for var in fwi_components} # to save space, encode as float32, zlib compress
     xr.merge(nan_components.values()).to_netcdf(f'{out_path}adj_factors_nans/{s}_{provider_name}_count_nans.nc', encoding=encoding) 
     
-    return high_adj # return high_adj df, will get fed back in for next station to record adj_factors
+    return high_adj
 
 ### Set params and run the functions above to apply ### 
 
 # Import list of all stations that pass completeness checks
-all_stations = pd.concat([pd.read_csv(fl, index_col=0).reset_index() for fl in glob.glob(f'{fwipaths.input_data}/station_observations/quality_report_*.csv')])
-all_stations.rename(columns={'index': 'stn_id'}, inplace=True)
-all_stations = all_stations[all_stations.pass_quality_criteria == 'yes']
-all_stations = all_stations.reset_index(drop=True)
+all_stations = passed_stations(f'{fwipaths.input_data}/station_observations')
 
-# Subset to run group
+# Subset to run group (or one station, see run_stations.py)
 i1 = int(sys.argv[1]) 
 step = int(sys.argv[2])
 stations = all_stations[i1:i1+step] 
 
 # Get the version from run file
 version = f'CanLEAD-FWI-{sys.argv[3]}-v1' 
+batch = 'batch' in sys.argv[4:] # run QDM for all CFFWIS components and realizations of a station at once (see qdm_batch.py)
 
 # Set and make output directory
 out_path = f'{fwipaths.output_data}/{version}/station_outputs/qdm_adjusted_data/' 
@@ -303,6 +416,7 @@ if not os.path.exists(f'{out_path}adj_factors_nans'):
     os.makedirs(f'{out_path}adj_factors_nans')
         
 adjustment_factors = pd.DataFrame(columns=['FFMC','DMC','DC','ISI','BUI','FWI','DSR']) # initialize dataset to track high adjustment factors
+stores = {} # station stores (all stations of a provider in one file, see station_store.py), opened once
 
 # Run QDM for all stations 
 for ii in tqdm(stations.index): 
@@ -314,18 +428,19 @@ for ii in tqdm(stations.index):
     else: 
       fwi_components = ['FFMC','DC','DMC','ISI','BUI','FWI','DSR'] # rest of P_Ts have DSR (for at least some stations)
 
-    # obs data
+    # obs data, from the store of the provider if present, else from the station file
     fl = f'{fwipaths.input_data}station_observations/{s}_{provider_name}_obs_data.nc' 
-    obs = xr.open_dataset(fl)
+    obs = open_station(s, store_path(f'{fwipaths.input_data}station_observations', provider_name), fl, stores)
     # model_data
     fl2 = f'{fwipaths.output_data}/{version}/station_outputs/model_data/{s}_{provider_name}_{version}_model_data.nc' 
-    model = xr.open_dataset(fl2)
+    model = open_station(s, store_path(f'{fwipaths.output_data}/{version}/station_outputs/model_data', provider_name, version), fl2, stores)
     
     # run QDM, which saves adjusted_model automatically, and returns only dateframe of adjustment factors
-    adjustment_factors = apply_qm(s, provider_name, data_obs=obs, data_model=model,
-                                  quantiles=np.linspace(0.01, 0.99, 99),
-                                  high_adj=adjustment_factors,
-                                  fwi_components=fwi_components)
+    run = apply_qm_batch if batch else apply_qm
+    adjustment_factors = run(s, provider_name, data_obs=obs, data_model=model,
+                             quantiles=np.linspace(0.01, 0.99, 99),
+                             high_adj=adjustment_factors,
+                             fwi_components=fwi_components)
                
     # save fire season mask into adjusted folder                   
     model.drop_vars(['FFMC','DC','DMC','ISI','BUI','FWI','DSR']).to_netcdf(f'{out_path}{s}_{provider_name}_fire_season_mask_{version}.nc', encoding={'fire_season_mask': {'dtype': 'bool', '_FillValue': None}})
@@ -0,0 +1,131 @@
+'''
+Run run_qdm.py or validate_qdm_AB.py for all stations that pass the quality criteria over a local pool of processes,
+instead of splitting the station list by hand into jobs (start index and step). Each station runs in its own process
+(the script with the row of the station and a step of 1), and a new station is started as soon as one is done, so that
+stations with long records do not hold up a whole slice. Stations with the most years of data are started first.
+
+The outcome of each station (done or failed, log file, highest adjustment factors) is kept in a json record in the
+adj_factors_nans folder of the script outputs, keyed by station ID and provider (e.g. 1010_BC, as station IDs are only
+unique within a provider), and the highest adjustment factors of all completed stations are merged into one csv
+(adjustment_factors_all.csv). On later runs, only stations without a completed run are run, so that failed stations can
+be re-run individually (--stations) or all together (--retry).
+
+Run as: python run_stations.py run_qdm.py EWEMBI [--jobs 8] [--stations 1010_BC 1020_NAT] [--retry] [--force] [--dry-run] [--args batch]
+'''
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import pandas as pd
+sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/'))
+from filepaths import fwipaths
+from read_obs_data import passed_stations
+
+here = os.path.dirname(os.path.abspath(__file__))
+output_folders = {'run_qdm.py': 'qdm_adjusted_data', 'validate_qdm_AB.py': 'validate_qdm_AB'} # output folder of each script, in station_outputs
+
+def run_station(script, row, data_version, args, log_fl):
+    # run the script for one station (row of passed_stations, step of 1), and log output
+    command = [sys.executable, os.path.join(here, script), str(row), '1', data_version] + args
+    with open(log_fl, 'w') as log:
+        log.write(' '.join(command) + '\n')
+        log.flush()
+        return subprocess.run(command, cwd=here, stdout=log, stderr=subprocess.STDOUT).returncode
+
+def merge_adjustment_factors(record):
+    # highest adjustment factors of all completed stations, one row per station (station ID and provider)
+    rows = {s: outcome['adjustment_factors'] for s, outcome in record.items() if outcome['status'] == 'done'}
+    return pd.DataFrame.from_dict(rows, orient='index', columns=['FFMC','DMC','DC','ISI','BUI','FWI','DSR'])
+
+def run(script, data_version, stations, record, record_fl, out_path, jobs, args):
+    '''
+    Run stations (rows of passed_stations) over a pool of jobs threads, each running the script for one station in
+    its own process. The record is updated and saved after each station, so that completed stations are kept if the
+    run stops.
+    '''
+    logdir = f'{out_path}adj_factors_nans/logs/'
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    done, failed = [], []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        for row in stations.index:
+            s, provider_name = str(stations.loc[row, 'stn_id']), stations.loc[row, 'P_T']
+            key = f'{s}_{provider_name}' # station IDs are only unique within a provider
+            log_fl = f'{logdir}{key}.log'
+            running[pool.submit(run_station, script, row, data_version, args, log_fl)] = (row, key, provider_name, log_fl)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                row, key, provider_name, log_fl = running.pop(future)
+                returncode = future.result()
+                fl = f'{out_path}adj_factors_nans/adjustment_factors_{row}-{row+1}.csv' # as saved by the script for one station
+                outcome = dict(P_T=provider_name, finished=datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"), log=log_fl)
+                if returncode == 0 and os.path.exists(fl):
+                    adj = pd.read_csv(fl, index_col=0)
+                    outcome.update(status='done', adjustment_factors={var: (None if pd.isna(v) else float(v)) for var, v in adj.iloc[0].items()})
+                    os.remove(fl) # kept in the record, by station ID and provider instead of row
+                    done.append(key)
+                    print(f'done  {key}')
+                else:
+                    outcome.update(status='failed', returncode=returncode)
+                    failed.append(key)
+                    print(f'FAIL  {key} (exit code {returncode}, see {log_fl})')
+                record[key] = outcome
+                with open(record_fl, 'w') as f:
+                    json.dump(record, f, indent=1)
+    return done, failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run QDM for all stations over a local pool of processes.')
+    parser.add_argument('script', choices=list(output_folders), help='script to run for each station')
+    parser.add_argument('version', help="CanLEAD version, 'EWEMBI' or 'S14FD'")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of stations to run at once')
+    parser.add_argument('--stations', nargs='+', help='stations to run, as station ID and provider (e.g. 1010_BC), to re-run failed stations individually')
+    parser.add_argument('--retry', action='store_true', help='run only stations that failed in previous runs')
+    parser.add_argument('--force', action='store_true', help='run all stations, even if completed')
+    parser.add_argument('--dry-run', action='store_true', help='print the stations to run without running')
+    parser.add_argument('--args', nargs='+', default=[], help="further arguments of the script (e.g. 'batch' for run_qdm.py)")
+    options = parser.parse_args()
+
+    version = f'CanLEAD-FWI-{options.version}-v1'
+    out_path = f'{fwipaths.output_data}/{version}/station_outputs/{output_folders[options.script]}/'
+    if not os.path.exists(f'{out_path}adj_factors_nans'):
+        os.makedirs(f'{out_path}adj_factors_nans')
+    record_fl = f'{out_path}adj_factors_nans/station_runs.json'
+    record = json.load(open(record_fl)) if os.path.exists(record_fl) else {}
+
+    # select stations to run, with the most years of data first
+    all_stations = passed_stations(f'{fwipaths.input_data}/station_observations')
+    ids = all_stations.stn_id.astype(str) + '_' + all_stations.P_T.astype(str) # record keys, station IDs are only unique within a provider
+    if options.stations:
+        unknown = [s for s in options.stations if s not in ids.values]
+        assert not unknown, f'Stations not in quality reports (or not passing quality criteria): {unknown}'
+        selected = ids.isin(options.stations)
+    elif options.retry:
+        selected = ids.map(lambda s: record.get(s, {}).get('status') == 'failed')
+    else:
+        selected = pd.Series(True, index=ids.index)
+    if not (options.force or options.stations): # named stations are run even if completed
+        selected &= ids.map(lambda s: record.get(s, {}).get('status') != 'done')
+    stations = all_stations[selected.values].sort_values('years_good_data', ascending=False, kind='stable')
+
+    if options.dry_run:
+        for row in stations.index:
+            s = ids[row]
+            print(f'{s:16s} {stations.loc[row, "years_good_data"]} years  {record.get(s, {}).get("status", "not run")}')
+        print(f'{len(stations)} of {len(all_stations)} stations to run')
+        sys.exit(0)
+
+    done, failed = run(options.script, options.version, stations, record, record_fl, out_path, options.jobs, options.args)
+
+    # highest adjustment factors of all completed stations (from this and previous runs) in one file
+    merge_adjustment_factors(record).to_csv(f'{out_path}adj_factors_nans/adjustment_factors_all.csv')
+    print(f'{len(done)} done, {len(failed)} failed, {sum(outcome["status"] == "done" for outcome in record.values())} of {len(all_stations)} stations completed')
+    if failed:
+        print('Re-run failed stations with --retry, or one at a time with --stations')
+        sys.exit(1)
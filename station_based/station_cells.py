@@ -0,0 +1,101 @@
+'''
+Extract model data at the grid cells nearest to stations (used by pull_station_data.py), in batches of stations that fit
+within a memory budget. The netCDF backend reads a pointwise selection (isel with indexers along a 'station' dim) as an
+outer selection, i.e. the block of all unique lats x all unique lons of the stations, so batches are sized by that block,
+and stations are grouped into compact lat-lon tiles so that the block is small.
+'''
+
+import os
+import numpy as np
+import xarray as xr
+
+def nearest_cells(ds, lats, lons):
+    '''
+    Index of the model grid cell nearest to each station (as with sel(method='nearest')), found once for all realizations.
+
+    Parameters
+    ----------
+    ds : xarray dataset
+        Model data, with 'lat' and 'lon' dims.
+    lats, lons : list
+        Latitude and longitude of each station.
+
+    Returns
+    -------
+    ilat, ilon : numpy array
+        Integer lat and lon index of each station.
+    '''
+    return ds.indexes['lat'].get_indexer(lats, method='nearest'), ds.indexes['lon'].get_indexer(lons, method='nearest')
+
+def read_cells(ilat, ilon):
+    # number of grid cells read for a set of stations (block of unique lats x unique lons)
+    return len(np.unique(ilat)) * len(np.unique(ilon))
+
+def station_batches(ilat, ilon, cell_size, station_size, max_memory):
+    '''
+    Split stations into batches, so that the block read from one file plus the extracted data of the batch fits within
+    max_memory. Stations are ordered by lat-lon tile (of about the size of the largest block that fits), and added to
+    a batch as long as it fits. A batch has at least one station.
+
+    Parameters
+    ----------
+    ilat, ilon : numpy array
+        Integer lat and lon index of each station (see nearest_cells).
+    cell_size : int
+        Bytes of one grid cell of one file (all variables and time steps).
+    station_size : int
+        Bytes of the extracted data of one station, for all files.
+    max_memory : float
+        Memory budget in bytes.
+
+    Returns
+    -------
+    batches : list
+        Arrays of station positions (in ilat and ilon), one per batch.
+    '''
+    tile = max(1, int(np.sqrt(max_memory / cell_size))) # side of a square block that fits
+    order = np.lexsort((ilon, ilat, ilon // tile, ilat // tile)) # by tile, then by cell within tile
+    batches, batch = [], []
+    for i in order:
+        candidate = batch + [i]
+        if batch and read_cells(ilat[candidate], ilon[candidate]) * cell_size + len(candidate) * station_size > max_memory:
+            batches.append(np.array(batch))
+            candidate = [i]
+        batch = candidate
+    if batch:
+        batches.append(np.array(batch))
+    return batches
+
+def extract_stations(files, ilat, ilon, stations):
+    '''
+    Pull the model data at stations from each realization file. The block of unique lats x unique lons of the stations
+    is read once per file (the read a pointwise isel would do), and the station cells are then selected from the block in
+    memory, so that at most one block is held at a time. Returns a dataset with (realization, time, station) dims,
+    concatenated along realization. Dataset attrs that differ between realizations (e.g. realization name) are dropped,
+    as with xr.merge.
+
+    Parameters
+    ----------
+    files : list
+        Realization files, with time_bnds.
+    ilat, ilon : numpy array
+        Integer lat and lon index of each station (see nearest_cells).
+    stations : list
+        Station IDs, as 'station' coordinate.
+
+    Returns
+    -------
+    cube : xarray dataset
+        Model data at stations, time_bnds dropped.
+    '''
+    ulat, lat_pos = np.unique(ilat, return_inverse=True)
+    ulon, lon_pos = np.unique(ilon, return_inverse=True)
+    cube = []
+    for r in files:
+        r_name = os.path.basename(r)[:10] # get realization ID from file name
+        with xr.open_dataset(r) as mod_ds:
+            block = mod_ds.drop_vars('time_bnds').isel(lat=ulat, lon=ulon).load() # drop time bands, we don't want to index by realization
+        points = block.isel(lat=xr.DataArray(lat_pos, dims='station'), lon=xr.DataArray(lon_pos, dims='station')) # station cells, in memory
+        del block
+        cube.append(points.assign_coords(station=stations, realization=r_name).expand_dims('realization')) # add realization as dimension
+    return xr.concat(cube, dim='realization', combine_attrs='drop_conflicts')
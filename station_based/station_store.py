@@ -0,0 +1,142 @@
+'''
+Station-dimension store of station observations or extracted model data, to save and open all stations of a provider
+as one netCDF file instead of one file per station. Per-station datasets (with length 1 lat and lon dims, as saved by
+pull_station_data.py) are concatenated along a 'station' dim, with lat and lon as coordinates of each station. Dataset
+attrs that differ between stations (e.g. station_name, latitude, elevation, years_with_obs_data) are saved as variables
+along 'station'. Stations cover different periods, so the time axis is the union of all periods, and the first time index
+and number of time steps of each station are saved, to return each station with its own period (ragged time coverage).
+'''
+
+import json
+import numpy as np
+import xarray as xr
+
+def store_path(path, provider_name, version=None):
+    # file name of the store of all stations of a provider, for obs (version=None) or model data
+    if version is None:
+        return f'{path}/{provider_name}_obs_data.nc'
+    return f'{path}/{provider_name}_{version}_model_data.nc'
+
+def _same_attrs(a, b):
+    # compare attrs, which can be arrays
+    try:
+        return bool(np.array_equal(a, b)) if (np.ndim(a) or np.ndim(b)) else bool(a == b)
+    except (TypeError, ValueError):
+        return False
+
+def to_station_store(datasets):
+    '''
+    Combine per-station datasets into one dataset with a 'station' dim.
+
+    Parameters
+    ----------
+    datasets : dict
+        {station: xarray dataset}, each with length 1 lat and lon dims (e.g. station_dataset[s]['obs_data']).
+
+    Returns
+    -------
+    store : xarray dataset
+        All stations along 'station' (station IDs as strings), on the union of time steps. Save with to_netcdf.
+    '''
+    stations = list(datasets.keys())
+    first = datasets[stations[0]]
+    dims = {var: ' '.join(first[var].dims) for var in first.data_vars} # dim order of each variable in per-station datasets
+
+    # attrs equal for all stations are kept as dataset attrs, others are saved as variables along 'station'
+    keys = list(dict.fromkeys(key for ds in datasets.values() for key in ds.attrs))
+    station_attrs = [key for key in keys if not all(key in ds.attrs and _same_attrs(ds.attrs[key], first.attrs[key]) for ds in datasets.values())]
+
+    # lat and lon of each station as coordinates along 'station', variable attrs from first station (same for all). 
+    # Variables without lat and lon (e.g. time_bnds) are the same for all stations, and are kept once
+    store = xr.concat([ds.isel(lat=0, lon=0) for ds in datasets.values()], 
+                      dim=xr.DataArray([str(s) for s in stations], dims='station', name='station'), 
+                      data_vars=[var for var in first.data_vars if 'lat' in first[var].dims], 
+                      join='outer', coords='different', compat='equals', combine_attrs='override')
+
+    # time coverage of each station, as index of first time step and number of time steps
+    times = store.indexes['time']
+    store['time_start'] = ('station', np.array([times.get_loc(ds.time.values[0]) for ds in datasets.values()], dtype='int32'))
+    store['time_count'] = ('station', np.array([ds.sizes['time'] for ds in datasets.values()], dtype='int32'))
+    store['time_start'].attrs['long_name'] = 'Index of first time step of station'
+    store['time_count'].attrs['long_name'] = 'Number of time steps of station'
+
+    for key in station_attrs:
+        values = [ds.attrs.get(key) for ds in datasets.values()]
+        if any(np.ndim(v) == 1 for v in values): # arrays of different length (e.g. years_with_obs_data), as contiguous ragged array
+            values = [np.atleast_1d(v) if v is not None else np.array([]) for v in values]
+            store[key] = (f'{key}_element', np.concatenate(values))
+            store[f'{key}_count'] = ('station', np.array([len(v) for v in values], dtype='int32'))
+            store[key].attrs['sample_dimension'] = f'{key}_count'
+        elif any(isinstance(v, str) for v in values): # missing values are saved as empty strings
+            store[key] = ('station', np.array([v if v is not None else '' for v in values], dtype=object))
+        else: # missing values are saved as NaN
+            store[key] = ('station', np.array([np.asarray(v).item() if v is not None else np.nan for v in values]))
+
+    store.attrs = {key: first.attrs[key] for key in keys if key not in station_attrs}
+    store.attrs['station_attrs'] = ' '.join(station_attrs)
+    store.attrs['station_dims'] = json.dumps(dims) # to restore the dim order of per-station datasets
+    return store
+
+def station_ids(store):
+    # station IDs in the store, as strings
+    return store['station'].values.tolist()
+
+def select_station(store, station):
+    '''
+    Return the dataset of one station from a store (see to_station_store), as saved per station by pull_station_data.py:
+    with length 1 lat and lon dims, the period of the station only, and station attrs as dataset attrs.
+
+    Parameters
+    ----------
+    store : xarray dataset
+        Station store, e.g. xr.open_dataset(store_path(...)).
+    station : String or int
+        Station ID.
+
+    Returns
+    -------
+    ds : xarray dataset
+        Dataset of the station.
+    '''
+    station = str(station)
+    k = station_ids(store).index(station)
+    station_attrs = store.attrs['station_attrs'].split()
+    dims = json.loads(store.attrs['station_dims'])
+
+    attrs = {key: value for key, value in store.attrs.items() if key not in ['station_attrs', 'station_dims']}
+    ragged = [key for key in station_attrs if f'{key}_count' in store]
+    for key in station_attrs:
+        if key in ragged:
+            counts = store[f'{key}_count'].values
+            start = int(counts[:k].sum())
+            attrs[key] = store[key].values[start:start + counts[k]]
+            continue
+        value = store[key].values[k]
+        if isinstance(value, str):
+            value = str(value) # as read from file attrs, not numpy string
+        if not (isinstance(value, str) and value == '') and not (isinstance(value, float) and np.isnan(value)): # skip missing
+            attrs[key] = value
+
+    start, count = int(store['time_start'].values[k]), int(store['time_count'].values[k])
+    ds = store.drop_vars(['time_start', 'time_count'] + station_attrs + [f'{key}_count' for key in ragged])
+    ds = ds.isel(station=k, time=slice(start, start + count)).drop_vars('station')
+    ds = ds.expand_dims(lat=[ds['lat'].values], lon=[ds['lon'].values])
+    for var in dims:
+        if 'lat' not in dims[var]: # e.g. time_bnds
+            ds[var] = ds[var].isel(lat=0, lon=0, drop=True)
+        ds[var] = ds[var].transpose(*dims[var].split())
+    ds.attrs = attrs
+    return ds
+
+def open_station(station, store_file, station_file, stores):
+    '''
+    Open the dataset of one station: from the store of its provider if present, else from its per-station file. 
+    Stores are opened once and kept in stores ({store_file: dataset}), to select all stations from the same open file.
+    '''
+    import os
+    
+    if not os.path.exists(store_file):
+        return xr.open_dataset(station_file)
+    if store_file not in stores:
+        stores[store_file] = xr.open_dataset(store_file)
+    return select_station(stores[store_file], station)
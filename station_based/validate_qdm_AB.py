@@ -6,7 +6,6 @@
 
 import os
 import sys
-import glob
 import datetime
 import numpy as np
 import pandas as pd
@@ -17,6 +16,8 @@ from xclim.sdba import construct_moving_yearly_window, unpack_moving_yearly_wind
 from xclim.sdba.processing import to_additive_space, from_additive_space, jitter
 sys.path.append(os.path.expanduser('~/fwi_updates/CanLEAD-FWI-v1/')) 
 from filepaths import fwipaths
+from station_store import open_station, store_path
+from read_obs_data import passed_stations
 import subprocess
 tracking_id = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
 
@@ -304,12 +305,9 @@ def apply_qm(s, provider_name, data_obs=None, data_model=None, quantiles=None, h
 ### Set params and run the functions above to apply ### 
 
 # Import list of all stations that pass completeness checks
-all_stations = pd.concat([pd.read_csv(fl, index_col=0).reset_index() for fl in glob.glob(f'{fwipaths.input_data}/station_observations/quality_report_*.csv')])
-all_stations.rename(columns={'index': 'stn_id'}, inplace=True)
-all_stations = all_stations[all_stations.pass_quality_criteria == 'yes']
-all_stations = all_stations.reset_index(drop=True)
+all_stations = passed_stations(f'{fwipaths.input_data}/station_observations')
 
-# Subset to run group
+# Subset to run group (or one station, see run_stations.py)
 i1 = int(sys.argv[1]) 
 step = int(sys.argv[2])
 stations = all_stations[i1:i1+step] 
@@ -325,6 +323,7 @@ if not os.path.exists(f'{out_path}adj_factors_nans'):
     os.makedirs(f'{out_path}adj_factors_nans')
         
 adjustment_factors = pd.DataFrame(columns=['FFMC','DMC','DC','ISI','BUI','FWI','DSR']) # initialize dataset to track high adjustment factors
+stores = {} # station stores (all stations of a provider in one file, see station_store.py), opened once
 
 # Run QDM for all stations 
 for ii in tqdm(stations.index): 
@@ -336,12 +335,12 @@ for ii in tqdm(stations.index):
     else: 
       fwi_components = ['FFMC','DC','DMC','ISI','BUI','FWI','DSR'] # rest of P_Ts have DSR (for at least some stations)
 
-    # obs data
+    # obs data, from the store of the provider if present, else from the station file
     fl = f'{fwipaths.input_data}station_observations/{s}_{provider_name}_obs_data.nc' 
-    obs = xr.open_dataset(fl)
+    obs = open_station(s, store_path(f'{fwipaths.input_data}station_observations', provider_name), fl, stores)
     # model_data
     fl2 = f'{fwipaths.output_data}/{version}/station_outputs/model_data/{s}_{provider_name}_{version}_model_data.nc' 
-    model = xr.open_dataset(fl2)
+    model = open_station(s, store_path(f'{fwipaths.output_data}/{version}/station_outputs/model_data', provider_name, version), fl2, stores)
     
     # run QDM, which saves adjusted_model automatically, and returns only dateframe of adjustment factors
     adjustment_factors = apply_qm(s, provider_name, data_obs=obs, data_model=model,
@@ -0,0 +1,28 @@
+'''
+Synthetic metric files for the checks in tests: small grids of float32 values over 1950-2100, with some NaN values and a
+cell with no data, as in annual, seasonal and monthly metric files.
+'''
+
+import numpy as np
+import xarray as xr
+
+def synthetic(frequency='annual', seed=0, realizations=None):
+    '''
+    Dataset with an 'FWI' variable of (time, lat, lon), or (realization, time, lat, lon) if realizations (list of labels) 
+    are given. frequency is 'annual', 'seasonal' (QS-DEC, whole years of seasons) or 'monthly'.
+    '''
+    freq = {'annual': 'YS', 'seasonal': 'QS-DEC', 'monthly': 'MS'}[frequency]
+    time = xr.date_range('1949-12-01' if frequency == 'seasonal' else '1950-01-01', '2100-12-31', freq=freq, calendar='noleap', use_cftime=True)
+    if frequency == 'seasonal':
+        time = time[time.year >= 1950] # whole years of seasons, labelled by year of the season start
+    rng = np.random.default_rng(seed)
+    shape = (len(time), 3, 4) if realizations is None else (len(realizations), len(time), 3, 4)
+    values = rng.gamma(2, 5, shape).astype('float32')
+    values[rng.random(values.shape) < 0.02] = np.nan
+    values[..., 0, 0] = np.nan # cell with no data
+    dims = ('time', 'lat', 'lon') if realizations is None else ('realization', 'time', 'lat', 'lon')
+    coords = {'time': time, 'lat': [50., 51, 52], 'lon': [-100., -99, -98, -97]}
+    if realizations is not None:
+        coords['realization'] = list(realizations)
+    return xr.Dataset({'FWI': (dims, values, {'cell_methods': 'time: mean within years', 'units': '1'})},
+                      coords=coords, attrs={'frequency': 'yr'})
@@ -0,0 +1,42 @@
+'''
+Checks of climatological means from cumulative sums (PrefixClimatology in config_stats.py) against the rolling means
+they replace, on synthetic annual and seasonal data. Run from the main folder with: python -m pytest tests
+'''
+
+import os
+import sys
+import numpy as np
+import xarray as xr
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config_stats import take_climatological_mean
+from synthetic import synthetic
+
+def rolling_climatology(ds, frequency):
+    # 30 year means as previously found in take_climatological_mean, with rolling means over years
+    if frequency == 'seasonal':
+        ds = ds.assign_coords(year=('time', ds.time.dt.year.data), season=('time', ds.time.dt.season.data))
+        ds = ds.set_index(time=('year', 'season')).unstack('time')
+    else:
+        ds = ds.assign_coords(time=ds.time.dt.year.values).rename({'time': 'year'})
+    ds = ds.rolling(year=30, center=False).mean(keep_attrs=True)
+    ds = ds.sel(year=ds.year.isin(np.arange(1980, 2101, 10))).rename({'year': 'period'})
+    ds['period'] = [f'{ii-29}-{ii}' for ii in ds.period.values]
+    return ds
+
+def test_climatological_mean_annual():
+    ds = synthetic('annual')
+    new = take_climatological_mean(ds, 'annual')
+    old = rolling_climatology(ds, 'annual')
+    assert list(new.period.values) == list(old.period.values)
+    new = new.FWI.transpose(*old.FWI.dims)
+    np.testing.assert_array_equal(np.isnan(new.values), np.isnan(old.FWI.values))
+    np.testing.assert_allclose(new.values, old.FWI.values, rtol=1e-5)
+    assert new.attrs['cell_methods'] == 'time: mean within years time: mean over years'
+
+def test_climatological_mean_seasonal():
+    ds = synthetic('seasonal', seed=1)
+    new = take_climatological_mean(ds, 'seasonal')
+    old = rolling_climatology(ds, 'seasonal')
+    new = new.FWI.sel(season=old.season).transpose(*old.FWI.dims)
+    np.testing.assert_array_equal(np.isnan(new.values), np.isnan(old.FWI.values))
+    np.testing.assert_allclose(new.values, old.FWI.values, rtol=1e-5)
@@ -0,0 +1,87 @@
+'''
+Checks of the out-of-core and incremental ensemble statistics in config_ensemble.py (stream_ensemble and EnsembleState)
+against ensemble_statistics of all members in memory, on synthetic 30-year means with NaN, ties and zeros in 1971-2000.
+Run from the main folder with: python -m pytest tests
+'''
+
+import os
+import sys
+import numpy as np
+import xarray as xr
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config_ensemble import ensemble_statistics, stream_ensemble, EnsembleState
+
+periods = ['1971-2000', '2001-2030', '2071-2100']
+
+def member(k, seed):
+    # 30-year means of one realization, rounded to get ties between members
+    rng = np.random.default_rng(seed)
+    ds = xr.Dataset(coords={'period': periods, 'lat': np.arange(50., 57.), 'lon': np.arange(-100., -91.)})
+    for var in ['FWI', 'DC']:
+        values = np.round(rng.gamma(2, 5, (3, 7, 9)), 1).astype('float32')
+        values[:, 0, 0] = np.nan # cell with no data
+        values[0, 1, 1] = 0 # no fire season in 1971-2000, percent delta is NaN
+        if k == 2:
+            values[1, 2, 2] = np.nan # one member with NaN
+        ds[var] = (('period', 'lat', 'lon'), values, {'long_name': var})
+    return ds.expand_dims(realization=[f'r1_r{k}i1p1'])
+
+def write_members(path, n=6):
+    files = []
+    for k in range(1, n + 1):
+        files.append(str(path / f'r1_r{k}i1p1_rcp85_FWI_30yr_mean.nc'))
+        member(k, k).to_netcdf(files[-1])
+    return files
+
+def full_statistics(files):
+    members = []
+    for fl in files:
+        with xr.open_dataset(fl) as ds:
+            members.append(ds.load())
+    alldat = xr.concat(members, dim='realization')
+    return ensemble_statistics(alldat), alldat
+
+def assert_stats_close(stats, expected):
+    for data_type in expected:
+        for var in ['FWI', 'DC']:
+            a = stats[data_type][var].transpose(*expected[data_type][var].dims).values
+            np.testing.assert_allclose(a, expected[data_type][var].values, rtol=1e-5, atol=1e-3)
+        assert list(stats[data_type].ensemble_statistic.values) == list(expected[data_type].ensemble_statistic.values)
+
+def test_stream_ensemble(tmp_path):
+    files = write_members(tmp_path)
+    expected, _ = full_statistics(files)
+    streamed = stream_ensemble(files, ensemble_statistics, max_memory=6 * 5 * 48 * 9) # tiles of 3 x 3 cells
+    assert_stats_close(streamed, expected)
+
+def test_ensemble_state(tmp_path):
+    files = write_members(tmp_path)
+    state = EnsembleState.from_files(files[:5])
+    with xr.open_dataset(files[5]) as ds:
+        state.add(ds)
+    expected, alldat = full_statistics(files)
+    assert_stats_close(state.statistics(), expected)
+    std = alldat.sel(period='1971-2000').std(dim='realization', skipna=False)
+    for var in ['FWI', 'DC']:
+        np.testing.assert_allclose(state.std()[var].transpose(*std[var].dims).values, std[var].values, rtol=1e-5, atol=1e-4)
+    assert state.verify(files)
+
+    # saved and reopened
+    state.save(str(tmp_path / 'state.nc'))
+    state = EnsembleState.open(str(tmp_path / 'state.nc'))
+
+    # remove a member (the one with extra NaN)
+    state.remove('r1_r2i1p1')
+    assert 'r1_r2i1p1' not in state.members
+    expected, _ = full_statistics([fl for fl in files if 'r1_r2i1p1' not in fl])
+    assert_stats_close(state.statistics(), expected)
+
+    # replace a member by new data
+    new = member(4, 100)
+    state.replace(new)
+    replaced = [fl for fl in files if 'r1_r2i1p1' not in fl]
+    new.to_netcdf(replaced[2]) # r1_r4i1p1
+    expected, _ = full_statistics(replaced)
+    assert_stats_close(state.statistics(), expected)
+    assert state.verify(replaced)
+    assert not state.verify(files) # members differ
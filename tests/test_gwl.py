@@ -0,0 +1,78 @@
+'''
+Checks of GWL climatologies from cumulative sums (config_gwl.py) against the per-window means they replace, on synthetic
+data. Run from the main folder with: python -m pytest tests
+'''
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config_stats import take_climatological_mean_pseudo_rcps
+from config_gwl import window_means, gwl_climatology, window_index, nearest_windows, find_nearest, read_tas_anomalies, cmip5_columns
+from synthetic import synthetic
+
+reals = ['r1_r1i1p1', 'r1_r2i1p1', 'r2_r10i1p1']
+
+def select_windows(rng, dims=('realization', 'rcp', 'period'), shape=(3, 2, 5)):
+    # random 30 year windows in 1951-2100, as source windows of (realization, rcp, period)
+    first = rng.integers(1951, 2072, shape)
+    return xr.DataArray(first, dims=dims), xr.DataArray(first + 29, dims=dims)
+
+@pytest.mark.parametrize('frequency', ['annual', 'seasonal', 'monthly'])
+def test_window_means(frequency):
+    # as in gwl_translation_constructed_scenarios.py, against the mean of each window selected from the data
+    cube = synthetic(frequency, seed=2, realizations=reals)
+    first, last = select_windows(np.random.default_rng(3))
+    new = window_means(cube, first, last, frequency)
+    for i in range(len(reals)):
+        for j in range(first.sizes['rcp']):
+            for k in range(first.sizes['period']):
+                window = cube.isel(realization=i).sel(time=slice(str(first.values[i, j, k]), str(last.values[i, j, k])))
+                old = take_climatological_mean_pseudo_rcps(window, frequency).FWI
+                out = new.FWI.isel(realization=i, rcp=j, period=k)
+                out = out.sel({dim: old[dim] for dim in ['season', 'month'] if dim in old.dims}).transpose(*old.dims)
+                assert out.dtype == old.dtype
+                np.testing.assert_array_equal(np.isnan(out.values), np.isnan(old.values))
+                np.testing.assert_allclose(out.values, old.values, rtol=1e-5)
+                assert out.attrs['cell_methods'] == old.attrs['cell_methods']
+
+def write_tas_anomalies(fl, seed=4):
+    # csv of annual GWL of each realization (1850-2100), in the format of tasAnom_PI_Ayr_CanESM2_historical-rcp85_185001-210012.csv
+    rng = np.random.default_rng(seed)
+    years = np.arange(1850, 2101)
+    warming = np.clip(years - 1950, 0, None)[:, None] * rng.uniform(0.03, 0.05, len(reals)) + rng.normal(0, 0.15, (len(years), len(reals)))
+    df = pd.DataFrame({cmip5_columns[0]: 0., 'year': years}) # year is the second column
+    for col in cmip5_columns[1:]:
+        df[col] = 0.
+    for real, values in zip(reals, warming.T):
+        df[f'CanESM2-LE_{real}'] = values
+    df.to_csv(fl, index=False)
+
+def test_gwl_climatology(tmp_path):
+    # as in gwl_climatology.py, against the mean over the window of each realization from find_nearest
+    tas_file, index_file = f'{tmp_path}/tas.csv', f'{tmp_path}/gwl_window_index.csv'
+    write_tas_anomalies(tas_file)
+    index = window_index(index_file, tas_file, [1.5, 2])
+    index = window_index(index_file, tas_file, [1.5, 2, 3]) # index is extended for new GWLs
+    assert sorted(pd.read_csv(index_file)['gwl'].unique()) == [1.5, 2, 3]
+    tas = read_tas_anomalies(tas_file)
+    pd.testing.assert_frame_equal(index.sort_values(['gwl', 'realization']).reset_index(drop=True), 
+                                  nearest_windows(tas, [1.5, 2, 3]).sort_values(['gwl', 'realization']).reset_index(drop=True))
+
+    cube = synthetic('annual', seed=5, realizations=reals)
+    ds = gwl_climatology(cube, [1.5, 2, 3], index)
+    assert ds.FWI.dims[:2] == ('realization', 'gwl')
+    for i, real in enumerate(reals):
+        for j, gwl in enumerate([1.5, 2, 3]):
+            first, last = find_nearest(tas[real[:6]], gwl, 30)
+            old = take_climatological_mean_pseudo_rcps(cube.isel(realization=i).sel(time=slice(first, last)), 'annual').FWI
+            out = ds.FWI.isel(realization=i, gwl=j).transpose(*old.dims)
+            np.testing.assert_array_equal(np.isnan(out.values), np.isnan(old.values))
+            np.testing.assert_allclose(out.values, old.values, rtol=1e-5)
+            assert ds.source_rcp_period.values[i, j] == f'{first}-{last}'
+
+    with pytest.raises(ValueError): # GWL not reached in all realizations
+        gwl_climatology(cube, [9], window_index(index_file, tas_file, [9]))
@@ -0,0 +1,29 @@
+'''
+Checks of the output names of apply_mask_attrs.py (masked_files in config_stats.py), used as outputs of the masking 
+nodes of run_pipeline.py. Run from the main folder with: python -m pytest tests
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config_stats import masked_files
+
+def touch(fl):
+    os.makedirs(os.path.dirname(fl), exist_ok=True)
+    open(fl, 'w').close()
+
+def test_masked_files(tmp_path):
+    summary = f'{tmp_path}/summary_stats/'
+    touch(f'{summary}RCP85/exceedances_high/no_mask/r1_r1i1p1_CanLEAD-FWI-EWEMBI-v1_annual_exceedances_high.nc')
+    touch(f'{summary}RCP85/MJJAS_mean_fillna/no_mask/r1_r1i1p1_CanLEAD-FWI-EWEMBI-v1_MJJAS_mean_fillna.nc')
+    touch(f'{summary}constructed_RCP26/fire_season_length/no_mask/r1_r1i1p1_rcp26_CanLEAD-FWI-EWEMBI-v1_fire_season_length.nc')
+    
+    assert masked_files(summary, 'RCP85') == {
+        f'{summary}RCP85/MJJAS_mean_fillna/no_mask/r1_r1i1p1_CanLEAD-FWI-EWEMBI-v1_MJJAS_mean_fillna.nc': 
+            f'{summary}RCP85/MJJAS_mean_fillna/r1_r1i1p1_rcp85_CanLEAD-FWI-EWEMBI-v1_MJJAS_mean_fillna.nc',
+        f'{summary}RCP85/exceedances_high/no_mask/r1_r1i1p1_CanLEAD-FWI-EWEMBI-v1_annual_exceedances_high.nc': 
+            f'{summary}RCP85/exceedances_high/r1_r1i1p1_rcp85_CanLEAD-FWI-EWEMBI-v1_exceedances_high.nc'}
+    assert masked_files(summary, 'constructed_RCP26') == {
+        f'{summary}constructed_RCP26/fire_season_length/no_mask/r1_r1i1p1_rcp26_CanLEAD-FWI-EWEMBI-v1_fire_season_length.nc': 
+            f'{summary}constructed_RCP26/fire_season_length/r1_r1i1p1_rcp26_CanLEAD-FWI-EWEMBI-v1_fire_season_length.nc'}
+    assert masked_files(summary, 'constructed_RCP45') == {}
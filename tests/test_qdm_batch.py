@@ -0,0 +1,77 @@
+'''
+Checks of the batched quantile delta mapping (qdm_batch.py in station_based) against the xclim steps of QM_routine in
+run_qdm.py (QuantileDeltaMapping.train, adjustment in 30-year moving windows, jitter and logit transform for FFMC), on
+synthetic daily series with NaN and ties. Run from the main folder with: python -m pytest tests
+'''
+
+import os
+import sys
+import numpy as np
+import xarray as xr
+import pytest
+from xclim import sdba
+from xclim.sdba import construct_moving_yearly_window, unpack_moving_yearly_window
+from xclim.sdba.processing import to_additive_space, from_additive_space, jitter
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'station_based'))
+import qdm_batch
+
+quantiles = np.linspace(0.01, 0.99, 99)
+time = xr.cftime_range('1951-01-01', '2010-12-31', freq='D', calendar='noleap') # 60 years, four 30-year windows with step 10
+
+def series(seed, scale, ffmc=False):
+    # daily values rounded to get ties, with NaNs out of a fire season, as float32 like the station data
+    rng = np.random.default_rng(seed)
+    if ffmc: # FFMC, with values at the 0 and 101 bounds to jitter
+        values = np.clip(np.round(rng.normal(85 * scale, 12, time.size)), 0, 101)
+    else:
+        values = np.round(rng.gamma(2, 5 * scale, time.size), 1)
+        values[rng.random(time.size) < 0.05] = 0 # zeros, tied with each other
+    values[(time.dayofyear < 90) | (time.dayofyear > 300)] = np.nan
+    return xr.DataArray(values.astype('float32'), dims='time', coords={'time': time}, attrs={'units': ''})
+
+def xclim_qdm(obs, hist, sim, kind, ffmc=False):
+    # steps of QM_routine in run_qdm.py, for one series
+    hist = xr.where(obs.notnull(), hist, np.NaN)
+    obs = xr.where(hist.notnull(), obs, np.NaN)
+    hist.attrs['units'] = ''
+    obs.attrs['units'] = ''
+    if ffmc:
+        sim = jitter(sim, lower='0.25', upper='100.75', minimum='0', maximum='101')
+        hist = jitter(hist, lower='0.25', upper='100.75', minimum='0', maximum='101')
+        obs = jitter(obs, lower='0.25', upper='100.75', minimum='0', maximum='101')
+        sim = to_additive_space(sim, lower_bound='0', upper_bound='101', trans='logit')
+        hist = to_additive_space(hist, lower_bound='0', upper_bound='101', trans='logit')
+        obs = to_additive_space(obs, lower_bound='0', upper_bound='101', trans='logit')
+    mod_win = construct_moving_yearly_window(sim, window=30, step=10)
+    QM = sdba.QuantileDeltaMapping.train(obs, hist, nquantiles=quantiles, group='time', kind=kind)
+    out = unpack_moving_yearly_window(QM.adjust(mod_win, extrapolation="constant", interp="linear"), append_ends=True)
+    if ffmc:
+        out = from_additive_space(out, lower_bound='0', upper_bound='101', trans='logit', units='dimensionless')
+    return QM.ds.af.squeeze().values, out.values
+
+def batch_qdm(obs, hist, sim, kind, ffmc=False):
+    # steps of apply_qm_batch in run_qdm.py, for one series
+    obs, hist, sim = obs.values[np.newaxis], hist.values[np.newaxis], sim.values[np.newaxis]
+    hist = np.where(~np.isnan(obs), hist, np.nan).astype(hist.dtype)
+    obs = np.where(~np.isnan(hist), obs, np.nan).astype(obs.dtype)
+    if ffmc:
+        sim, hist, obs = qdm_batch.jitter(sim), qdm_batch.jitter(hist), qdm_batch.jitter(obs)
+        sim, hist, obs = qdm_batch.to_logit(sim), qdm_batch.to_logit(hist), qdm_batch.to_logit(obs)
+    af, hist_q, qnts = qdm_batch.qdm_train(obs, hist, quantiles, kind)
+    out = qdm_batch.qdm_adjust_moving(sim, qnts, af, kind, window=30, step=10)
+    if ffmc:
+        out = qdm_batch.from_logit(out)
+    return af[0], out[0]
+
+@pytest.mark.parametrize('kind, ffmc', [('*', False), ('+', False), ('+', True)])
+def test_qdm_batch(kind, ffmc):
+    obs, hist, sim = series(0, 1, ffmc), series(1, 1.2 if not ffmc else 0.95, ffmc), series(2, 1.3 if not ffmc else 0.97, ffmc)
+    obs, hist = obs.sel(time=slice('1951', '1980')), hist.sel(time=slice('1951', '1980')) # training period
+    np.random.seed(0) # same jitter noise for both, drawn in the same order
+    af, out = xclim_qdm(obs, hist, sim, kind, ffmc)
+    np.random.seed(0)
+    af_batch, out_batch = batch_qdm(obs, hist, sim, kind, ffmc)
+    np.testing.assert_allclose(af_batch, af, rtol=1e-5)
+    assert out_batch.shape == out.shape
+    np.testing.assert_allclose(out_batch, out, rtol=1e-5, atol=1e-5)
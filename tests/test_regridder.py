@@ -0,0 +1,33 @@
+'''
+Checks of saved regridding weights (get_regridder in config_noon.py): weights are reused for the same grids, masks and
+options, and not between runs with different options. Run from the main folder with: python -m pytest tests
+'''
+
+import os
+import sys
+import numpy as np
+import xarray as xr
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config_noon import get_regridder
+
+def grids():
+    ds_in = xr.Dataset({'mask': (('lat', 'lon'), np.ones((6, 8), dtype=int))}, coords={'lat': np.arange(50., 56.), 'lon': np.arange(-100., -92.)})
+    ds_out = xr.Dataset(coords={'lat': np.arange(50.2, 55, 0.5), 'lon': np.arange(-99.8, -93, 0.5)})
+    ds_out['mask'] = xr.DataArray(np.ones((ds_out.sizes['lat'], ds_out.sizes['lon']), dtype=int), dims=('lat', 'lon'))
+    ds_out['mask'][0, :] = 0 # masked destination cells
+    return ds_in, ds_out
+
+def test_weights_keyed_by_options(tmp_path):
+    ds_in, ds_out = grids()
+    data = xr.DataArray(np.arange(48.).reshape(6, 8) + 1, dims=('lat', 'lon'), coords={'lat': ds_in.lat, 'lon': ds_in.lon})
+    weights_dir = f'{tmp_path}/weights/'
+    zero = get_regridder(ds_in, ds_out, weights_dir)(data)
+    nan = get_regridder(ds_in, ds_out, weights_dir, unmapped_to_nan=True)(data)
+    assert len(os.listdir(weights_dir)) == 2 # one weights file per option
+    assert (zero[0] == 0).all() and nan[0].isnull().all()
+    np.testing.assert_array_equal(zero[1:].values, nan[1:].values)
+
+    # reused weights give the same result, for each option
+    xr.testing.assert_identical(get_regridder(ds_in, ds_out, weights_dir)(data), zero)
+    xr.testing.assert_identical(get_regridder(ds_in, ds_out, weights_dir, unmapped_to_nan=True)(data), nan)
+    assert len(os.listdir(weights_dir)) == 2
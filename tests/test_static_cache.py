@@ -0,0 +1,40 @@
+'''
+Checks of the memory-mapped cache of static parameters (cache_static_parameters in config_noon.py): values are read
+back unchanged, and the cache is no longer valid when its source file changes. Run from the main folder with: 
+python -m pytest tests
+'''
+
+import os
+import sys
+import xarray as xr
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config_noon import cache_static_parameters, open_static_parameters, static_cache_valid
+from synthetic import synthetic
+
+def test_static_cache(tmp_path):
+    source = str(tmp_path / 'source.nc')
+    synthetic('monthly').isel(time=slice(0, 24)).to_netcdf(source)
+    cache_dir = f'{tmp_path}/cache/'
+    assert not static_cache_valid(cache_dir, [source])
+    
+    with xr.open_dataset(source) as ds:
+        cache_static_parameters(ds, cache_dir, time_block=5, sources=[source])
+        cached = open_static_parameters(cache_dir)
+        xr.testing.assert_identical(cached, ds.load())
+    assert static_cache_valid(cache_dir, [source])
+    
+    # source rewritten (different size and modification time), cache must be rebuilt
+    synthetic('monthly', seed=1).isel(time=slice(0, 36)).to_netcdf(source)
+    os.utime(source, (os.path.getatime(source), os.path.getmtime(source) + 10))
+    assert not static_cache_valid(cache_dir, [source])
+    
+    # rebuilt in place from the new source
+    with xr.open_dataset(source) as ds:
+        cache_static_parameters(ds, cache_dir, time_block=5, sources=[source])
+        xr.testing.assert_identical(open_static_parameters(cache_dir), ds.load())
+    assert static_cache_valid(cache_dir, [source])
+    assert sorted(os.listdir(tmp_path)) == ['cache', 'source.nc'] # no temporary folder left
+    
+    # incomplete cache (no manifest) is not valid
+    os.remove(f'{cache_dir}_manifest.json')
+    assert not static_cache_valid(cache_dir, [source])
@@ -0,0 +1,38 @@
+'''
+Checks of the Parquet cache of raw station data (read_cached_station_data in station_based/read_obs_data.py): data match
+the csv files, and the cache is rebuilt when the csv read options change. Run from the main folder with: 
+python -m pytest tests
+'''
+
+import os
+import sys
+import json
+import pandas as pd
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'station_based'))
+from read_obs_data import read_cached_station_data
+
+def write_csv(path):
+    fl = str(path / 'YK_Daily.csv')
+    pd.DataFrame({'Name': ['A', 'A', 'B'], 'DateObs': ['19900501', '19900502', '19910501'], 
+                  'FFMC': [85.0, -1.0, 80.5]}).to_csv(fl, index=False)
+    return [fl]
+
+def test_read_without_cache(tmp_path, monkeypatch):
+    files = write_csv(tmp_path)
+    monkeypatch.setitem(sys.modules, 'pyarrow', None) # as if pyarrow is not installed
+    stn_data = read_cached_station_data('YK', files, dict(na_values='-1'), 'DateObs', f'{tmp_path}/cache/')
+    pd.testing.assert_frame_equal(stn_data, pd.read_csv(files[0], na_values='-1'))
+    assert not os.path.exists(f'{tmp_path}/cache/')
+
+def test_cache_read_options(tmp_path):
+    pytest.importorskip('pyarrow')
+    files = write_csv(tmp_path)
+    cache_path = f'{tmp_path}/cache/'
+    for read_options in [{}, dict(na_values='-1')]: # changed options rebuild the cache
+        expected = pd.read_csv(files[0], **read_options)
+        for _ in range(2): # made, then read from cache
+            stn_data = read_cached_station_data('YK', files, read_options, 'DateObs', cache_path)
+            pd.testing.assert_frame_equal(stn_data, expected, check_dtype=False)
+        with open(f'{cache_path}YK/_manifest.json') as fl:
+            assert json.load(fl)['read_options'] == read_options
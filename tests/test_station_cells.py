@@ -0,0 +1,70 @@
+'''
+Checks of the extraction of model data at station cells (station_cells.py in station_based): extracted values match the
+cells of each station, and the block read from each file stays within the memory budget of the batch. Run from the main
+folder with: python -m pytest tests
+'''
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.backends.netCDF4_ import NetCDF4ArrayWrapper
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'station_based'))
+from station_cells import nearest_cells, read_cells, station_batches, extract_stations
+
+def write_realizations(path, n=2, nlat=40, nlon=50, ntime=20):
+    # small model files with time_bnds, one per realization, named as r{group}_r{member}i1p1...
+    time = pd.date_range('2000-01-01', periods=ntime)
+    lat, lon = np.linspace(41, 80, nlat), np.linspace(-140, -50, nlon)
+    files = []
+    for k in range(n):
+        rng = np.random.default_rng(k)
+        ds = xr.Dataset({'FWI': (('time', 'lat', 'lon'), rng.gamma(2, 5, (ntime, nlat, nlon)).astype('float32')),
+                         'fire_season_mask': (('time', 'lat', 'lon'), rng.random((ntime, nlat, nlon)) > 0.5),
+                         'time_bnds': (('time', 'bnds'), np.stack([time, time + pd.Timedelta('1D')], axis=1))},
+                        coords={'time': time, 'lat': lat, 'lon': lon})
+        files.append(str(path / f'r1_r{k+1}i1p1_CanLEAD-FWI-EWEMBI-v1.nc'))
+        ds.to_netcdf(files[-1])
+    return files
+
+def test_extract_stations(tmp_path, monkeypatch):
+    files = write_realizations(tmp_path)
+    rng = np.random.default_rng(0)
+    lats, lons = rng.uniform(41, 80, 40), rng.uniform(-140, -50, 40)
+    stations = [str(1000 + i) for i in range(40)]
+    with xr.open_dataset(files[0]) as ds:
+        ilat, ilon = nearest_cells(ds, lats, lons)
+        np.testing.assert_array_equal(ds.lat.values[ilat], ds.sel(lat=lats, method='nearest').lat.values)
+        cell_size = (ds.FWI.dtype.itemsize + ds.fire_season_mask.dtype.itemsize) * ds.sizes['time']
+
+    # record the shape of every read from the files
+    reads = []
+    getitem = NetCDF4ArrayWrapper._getitem
+    def recorded(self, key):
+        out = getitem(self, key)
+        reads.append(out.shape)
+        return out
+    monkeypatch.setattr(NetCDF4ArrayWrapper, '_getitem', recorded)
+
+    max_memory = 60 * cell_size + 40 * cell_size * len(files) # fits a few stations per batch
+    batches = station_batches(ilat, ilon, cell_size, cell_size * len(files), max_memory)
+    assert sorted(np.concatenate(batches)) == list(range(40)) # each station in one batch
+    assert len(batches) > 1
+    for batch in batches:
+        assert len(batch) == 1 or read_cells(ilat[batch], ilon[batch]) * cell_size + len(batch) * cell_size * len(files) <= max_memory
+        reads.clear()
+        cube = extract_stations(files, ilat[batch], ilon[batch], [stations[j] for j in batch])
+
+        # peak read: the block of unique lats x unique lons of the batch, for all time steps
+        data_reads = [shape for shape in reads if len(shape) == 3]
+        assert max(np.prod(shape) for shape in data_reads) == read_cells(ilat[batch], ilon[batch]) * 20
+
+        # extracted values are those of the station cells
+        assert list(cube.station.values) == [stations[j] for j in batch]
+        assert list(cube.realization.values) == ['r1_r1i1p1_', 'r1_r2i1p1_']
+        for k, fl in enumerate(files):
+            with xr.open_dataset(fl) as ds:
+                for var in ['FWI', 'fire_season_mask']:
+                    expected = ds[var].values[:, ilat[batch], ilon[batch]]
+                    np.testing.assert_array_equal(cube[var].isel(realization=k).transpose('time', 'station').values, expected)